@@ -1,21 +1,41 @@
 ﻿import os
 from typing import Dict, List
 
-from tools import call_llm, call_rag_app
+from tools import acall_llm, acall_rag_app, call_llm, call_rag_app
+from tracing import traced
 
+GENERAL_SYSTEM_PROMPT = "你是智能客服助手，请用简洁、礼貌的方式回答问题。"
 
-def spec_assistant(question: str, history: List[Dict[str, str]]) -> str:
+
+def _spec_prompt(question: str) -> str:
+    return (
+        "请根据实例规格族知识库回答用户关于实例规格/参数的提问。\n"
+        f"用户问题：{question}"
+    )
+
+
+@traced("spec_assistant")
+def spec_assistant(question: str, history: List[Dict[str, str]], stream: bool = False) -> str:
     """Answer instance spec questions via RAG."""
     app_id = os.environ.get("RAG_APP_ID", "")
     if not app_id:
         return "未设置 RAG_APP_ID，无法查询实例规格详情。"
-    prompt = (
-        "请根据实例规格族知识库回答用户关于实例规格/参数的提问。\n"
-        f"用户问题：{question}"
-    )
-    return call_rag_app(app_id, prompt)
+    return call_rag_app(app_id, _spec_prompt(question), stream=stream)
+
+
+@traced("spec_assistant")
+async def aspec_assistant(question: str, history: List[Dict[str, str]], stream: bool = False) -> str:
+    app_id = os.environ.get("RAG_APP_ID", "")
+    if not app_id:
+        return "未设置 RAG_APP_ID，无法查询实例规格详情。"
+    return await acall_rag_app(app_id, _spec_prompt(question), stream=stream)
+
+
+@traced("general_assistant")
+def general_assistant(question: str, history: List[Dict[str, str]], stream: bool = False) -> str:
+    return call_llm(GENERAL_SYSTEM_PROMPT, question, history=history, stream=stream)
 
 
-def general_assistant(question: str, history: List[Dict[str, str]]) -> str:
-    system_prompt = "你是智能客服助手，请用简洁、礼貌的方式回答问题。"
-    return call_llm(system_prompt, question, history=history)
+@traced("general_assistant")
+async def ageneral_assistant(question: str, history: List[Dict[str, str]], stream: bool = False) -> str:
+    return await acall_llm(GENERAL_SYSTEM_PROMPT, question, history=history, stream=stream)
@@ -0,0 +1,147 @@
+﻿"""checkpoint 基准：长会话中每轮写入 checkpointer 的字节数、put 次数、put 耗时与回合耗时。
+
+用法：
+    python benchmarks/bench_checkpoints.py --turns 200
+    python benchmarks/bench_checkpoints.py --turns 200 --answer-chars 1200 --json checkpoints.json
+
+上游全部换成离线桩（零延迟），会话状态写入临时目录中的 SQLite；按回合序号分段统计，
+观察每轮写入量是否随会话长度增长。
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUESTIONS = (
+    "ecs.g7.large 的规格参数是多少",
+    "你们支持开发票吗",
+    "我想买一台云服务器做 web 网站",
+    "2-4核 8G 内存",
+    "预算每月 500元",
+    "部署在杭州",
+    "查一下账户余额",
+    "能帮我对比一下刚才这几个规格吗",
+)
+
+
+class CountingSerde:
+    """包装 checkpointer 的序列化器，累计序列化出的字节数。"""
+
+    def __init__(self, inner: Any) -> None:
+        self.inner = inner
+        self.bytes = 0
+        self.calls = 0
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        value_type, value = self.inner.dumps_typed(obj)
+        self.bytes += len(value)
+        self.calls += 1
+        return value_type, value
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        return self.inner.loads_typed(data)
+
+
+def _segment(samples: List[Dict[str, float]]) -> Dict[str, float]:
+    count = len(samples)
+    return {
+        "bytes_per_turn": round(sum(item["bytes"] for item in samples) / count),
+        "puts_per_turn": round(sum(item["puts"] for item in samples) / count, 2),
+        "put_ms_per_turn": round(sum(item["put_ms"] for item in samples) / count, 2),
+        "ms_per_turn": round(sum(item["ms"] for item in samples) / count, 2),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--segments", type=int, default=4, help="把回合按序号均分成几段分别统计")
+    parser.add_argument("--answer-chars", type=int, default=600, help="桩的自由文本回答补齐到的字符数")
+    parser.add_argument(
+        "--durability",
+        choices=("exit", "async", "sync"),
+        default=None,
+        help="checkpoint 写入时机，默认取 SESSION_DURABILITY",
+    )
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    from session_store import SESSION_DURABILITY, SqliteCheckpointSaver
+    from stubs import StubBackends
+    from workflow import build_app
+
+    args.durability = args.durability or SESSION_DURABILITY
+    StubBackends(answer_chars=args.answer_chars).install()
+    samples: List[Dict[str, float]] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "sessions.sqlite3")
+        saver = SqliteCheckpointSaver(db_path)
+        serde = CountingSerde(saver.serde)
+        saver.serde = serde
+        puts = {"count": 0, "seconds": 0.0}
+        put = saver.put
+
+        def _counting_put(*put_args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return put(*put_args, **kwargs)
+            finally:
+                puts["count"] += 1
+                puts["seconds"] += time.perf_counter() - started
+
+        saver.put = _counting_put
+        app = build_app(warm_up_regions=[], checkpointer=saver)
+        config = {"configurable": {"thread_id": "bench-long"}}
+        for turn in range(args.turns):
+            before_bytes, before_puts, before_seconds = serde.bytes, puts["count"], puts["seconds"]
+            started = time.perf_counter()
+            app.invoke({"question": QUESTIONS[turn % len(QUESTIONS)]}, config=config, durability=args.durability)
+            samples.append(
+                {
+                    "ms": (time.perf_counter() - started) * 1000,
+                    "bytes": serde.bytes - before_bytes,
+                    "puts": puts["count"] - before_puts,
+                    "put_ms": (puts["seconds"] - before_seconds) * 1000,
+                }
+            )
+        state = app.get_state(config).values
+        saver.close()
+        db_bytes = sum(
+            os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir) if name.startswith("sessions")
+        )
+
+    size = max(1, len(samples) // args.segments)
+    segments = [samples[start : start + size] for start in range(0, len(samples), size)]
+    report: Dict[str, Any] = {
+        "turns": args.turns,
+        "answer_chars": args.answer_chars,
+        "durability": args.durability,
+        "total": _segment(samples),
+        "segments": [
+            {"turns": f"{index * size + 1}-{index * size + len(segment)}", **_segment(segment)}
+            for index, segment in enumerate(segments)
+        ],
+        "final_history_messages": len(state.get("history", [])),
+        "db_bytes": db_bytes,
+    }
+
+    print(f"turns={args.turns} answer_chars={args.answer_chars} durability={args.durability} db_bytes={db_bytes}")
+    print(f"{'turns':<12}{'bytes/turn':>12}{'puts/turn':>11}{'put_ms/turn':>13}{'ms/turn':>9}")
+    for item in report["segments"] + [{"turns": "all", **report["total"]}]:
+        print(
+            f"{item['turns']:<12}{item['bytes_per_turn']:>12}{item['puts_per_turn']:>11}"
+            f"{item['put_ms_per_turn']:>13}{item['ms_per_turn']:>9}"
+        )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,144 @@
+﻿"""需求抽取对比：规则抽取 / 规则+LLM 补缺 / 纯 LLM 在标注样本上的准确率与延迟。
+
+用法：
+    python benchmarks/bench_extraction.py
+    python benchmarks/bench_extraction.py --stub --llm-latency lognormal:0.6:0.4
+
+未设置 DASHSCOPE_API_KEY 且未加 --stub 时只评测规则抽取；--stub 使用离线桩，
+此时 LLM 的准确率只反映桩的正则，参考意义在于延迟与调用次数。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from catalog import _monthly_budget, _resolve_arch, _resolve_region, _scene_class, parse_range  # noqa: E402
+from requirement_rules import extract_by_rules  # noqa: E402
+
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "extraction_samples.jsonl")
+
+
+def _same(field: str, predicted: str, expected: str) -> bool:
+    """按字段语义比较：数值比较解析后的区间，地域/架构比较归一化后的 ID。"""
+    predicted, expected = (predicted or "").strip(), (expected or "").strip()
+    if not predicted or not expected:
+        return predicted == expected
+    if field in ("vCPU", "内存"):
+        return parse_range(predicted) == parse_range(expected)
+    if field == "预算":
+        return _monthly_budget(predicted) == _monthly_budget(expected)
+    if field == "地域":
+        return (_resolve_region(predicted) or predicted.lower()) == (_resolve_region(expected) or expected.lower())
+    if field == "架构":
+        return _resolve_arch(predicted) == _resolve_arch(expected)
+    if field == "场景":
+        return predicted.lower() == expected.lower() or _scene_class(predicted) == _scene_class(expected) != ""
+    return predicted == expected
+
+
+def load_samples(path: str = SAMPLES_PATH) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8-sig") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def _known_requirements(expected_field: str) -> Dict[str, str]:
+    """构造“已收集需求”，使下一个追问字段恰好是 expected_field。"""
+    from shopping_flow import REQUIRED_FIELDS
+
+    known: Dict[str, str] = {}
+    for field in REQUIRED_FIELDS:
+        if field == expected_field:
+            break
+        known[field] = "已填写"
+    return known
+
+
+def evaluate(samples: List[Dict[str, Any]], extract: Callable[[Dict[str, Any]], Dict[str, str]]) -> Dict[str, Any]:
+    field_hits: Dict[str, List[bool]] = {}
+    exact = 0
+    latencies: List[float] = []
+    for sample in samples:
+        started = time.perf_counter()
+        predicted = {key: value for key, value in extract(sample).items() if (value or "").strip()}
+        latencies.append(time.perf_counter() - started)
+        labels = {key: value for key, value in sample["labels"].items() if value}
+        fields = set(labels) | set(predicted)
+        for field in fields:
+            field_hits.setdefault(field, []).append(_same(field, predicted.get(field, ""), labels.get(field, "")))
+        exact += all(_same(field, predicted.get(field, ""), labels.get(field, "")) for field in fields)
+    values = np.array(latencies) * 1000
+    return {
+        "exact_match": round(exact / len(samples), 3),
+        "field_accuracy": {field: round(sum(hits) / len(hits), 3) for field, hits in sorted(field_hits.items())},
+        "latency_ms": {
+            "mean": round(float(values.mean()), 3),
+            "p95": round(float(np.percentile(values, 95)), 3),
+        },
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", default=SAMPLES_PATH)
+    parser.add_argument("--stub", action="store_true", help="用离线桩代替 DashScope")
+    parser.add_argument("--llm-latency", default="lognormal:0.6:0.4", help="--stub 时的 LLM 延迟，见 stubs.latency_sampler")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples)
+    report: Dict[str, Any] = {
+        "samples": len(samples),
+        "rules": evaluate(samples, lambda sample: extract_by_rules(sample["question"], sample["expected_field"]).values),
+    }
+
+    if args.stub:
+        from stubs import StubBackends
+
+        StubBackends(args.llm_latency, 0.0, 0.0).install()
+    if args.stub or os.environ.get("DASHSCOPE_API_KEY"):
+        import shopping_flow
+
+        # 按样本统计是否求助了 LLM；call_llm_parsed 内部换主模型重试不重复计数。
+        llm_calls = {"count": 0}
+        call_llm_parsed = shopping_flow.call_llm_parsed
+
+        def _counting_call_llm_parsed(*call_args: Any, **call_kwargs: Any) -> Any:
+            llm_calls["count"] += 1
+            return call_llm_parsed(*call_args, **call_kwargs)
+
+        shopping_flow.call_llm_parsed = _counting_call_llm_parsed
+
+        def _extract(sample: Dict[str, Any]) -> Dict[str, str]:
+            return shopping_flow._extract_requirements(sample["question"], [], _known_requirements(sample["expected_field"]))
+
+        for name, enabled in (("hybrid", True), ("llm", False)):
+            shopping_flow.RULE_EXTRACTOR_ENABLED = enabled
+            llm_calls["count"] = 0
+            report[name] = evaluate(samples, _extract)
+            report[name]["llm_calls"] = llm_calls["count"]
+            report[name]["llm_skip_rate"] = round(1 - llm_calls["count"] / len(samples), 3)
+        report["backend"] = "stub" if args.stub else "dashscope"
+
+    print(f"samples={len(samples)} backend={report.get('backend', 'rules-only')}")
+    print(f"{'extractor':<10}{'exact':>8}{'mean_ms':>10}{'p95_ms':>10}{'llm_skip':>10}")
+    for name in ("rules", "hybrid", "llm"):
+        if name not in report:
+            continue
+        item = report[name]
+        skip = item.get("llm_skip_rate", 1.0)
+        print(f"{name:<10}{item['exact_match']:>8}{item['latency_ms']['mean']:>10}{item['latency_ms']['p95']:>10}{skip:>10}")
+        print("          " + "  ".join(f"{field}={accuracy}" for field, accuracy in item["field_accuracy"].items()))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,89 @@
+﻿"""会话存储内存基准：模拟大量会话各写入若干轮 checkpoint，记录进程 RSS 变化。
+
+用法：
+    python benchmarks/bench_session_store.py --sessions 100000 --backend sqlite
+    python benchmarks/bench_session_store.py --sessions 100000 --backend memory
+
+sqlite 后端的 RSS 应在热缓存填满后保持平稳；memory 后端（MemorySaver）随会话数线性增长。
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langgraph.checkpoint.base import empty_checkpoint  # noqa: E402
+from langgraph.checkpoint.base.id import uuid6  # noqa: E402
+
+from session_store import SqliteCheckpointSaver, create_checkpointer  # noqa: E402
+
+
+def _rss_mib() -> float:
+    with open("/proc/self/statm") as handle:
+        pages = int(handle.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _history(turn: int) -> list:
+    history = []
+    for index in range(turn + 1):
+        history.append({"role": "user", "content": f"第 {index} 轮：帮我看看杭州 2-4 核 8G 的 ECS 规格"})
+        history.append({"role": "assistant", "content": "推荐 ecs.g7.large（2 vCPU / 8 GiB），参考价约 300 元/月。" * 3})
+    return history
+
+
+def _put_turn(saver, thread_id: str, turn: int, parent_id):
+    checkpoint = empty_checkpoint()
+    checkpoint["id"] = str(uuid6())
+    checkpoint["channel_values"] = {
+        "question": "帮我看看杭州 2-4 核 8G 的 ECS 规格",
+        "history": _history(turn),
+        "requirements": {"场景": "Web", "vCPU": "2-4", "内存": "8GB", "地域": "cn-hangzhou"},
+        "reply": "推荐 ecs.g7.large",
+    }
+    checkpoint["channel_versions"] = {name: turn + 1 for name in checkpoint["channel_values"]}
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    if parent_id:
+        config["configurable"]["checkpoint_id"] = parent_id
+    saved = saver.put(config, checkpoint, {"source": "loop", "step": turn}, checkpoint["channel_versions"])
+    return saved["configurable"]["checkpoint_id"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=3, help="每个会话写入的 checkpoint 数")
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--report-every", type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_sessions_")
+    if args.backend == "sqlite":
+        saver = SqliteCheckpointSaver(os.path.join(workdir, "sessions.sqlite3"))
+    else:
+        saver = create_checkpointer("memory")
+
+    baseline = _rss_mib()
+    started = time.perf_counter()
+    print(f"backend={args.backend} sessions={args.sessions} turns={args.turns} baseline_rss={baseline:.1f}MiB")
+    for index in range(1, args.sessions + 1):
+        parent_id = None
+        for turn in range(args.turns):
+            parent_id = _put_turn(saver, f"session-{index}", turn, parent_id)
+        if index % args.report_every == 0 or index == args.sessions:
+            elapsed = time.perf_counter() - started
+            print(
+                f"sessions={index:>7} rss={_rss_mib():8.1f}MiB "
+                f"delta={_rss_mib() - baseline:8.1f}MiB elapsed={elapsed:6.1f}s"
+            )
+    if isinstance(saver, SqliteCheckpointSaver):
+        print(f"db_size={os.path.getsize(saver.path) / (1024 * 1024):.1f}MiB cache={saver.cache_stats()}")
+        saver.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
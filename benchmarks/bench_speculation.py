@@ -0,0 +1,143 @@
+﻿"""推测预取基准：导购最后一轮（给出推荐）的延迟，对比关闭与开启推测预取。
+
+用法：
+    python benchmarks/bench_speculation.py --sessions 32 --think-time 2
+    python benchmarks/bench_speculation.py --hit-ratio 0.5 --mode sync --json speculation.json
+
+每个会话按导购脚本逐轮回答，轮与轮之间停顿 --think-time 秒模拟用户阅读与输入；
+最后一轮回答地域，其中 --hit-ratio 比例的会话回答“杭州”（与推测一致），其余回答“北京”。
+同一进程先关闭推测跑一遍，再开启推测跑一遍；上游为离线桩，RAG 缓存关闭。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+GUIDE_TURNS = ("我想买一台云服务器做 web 网站", "2-4核 8G 内存", "预算每月 500元")
+PREDICTED_ANSWER = "部署在杭州"
+OTHER_ANSWER = "部署在北京"
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0}
+    values = np.array(samples) * 1000
+    return {"p50": round(float(np.percentile(values, 50)), 1), "p95": round(float(np.percentile(values, 95)), 1)}
+
+
+def _questions(index: int, hit_ratio: float, sessions: int) -> List[str]:
+    hit = index < round(hit_ratio * sessions)
+    return list(GUIDE_TURNS) + [PREDICTED_ANSWER if hit else OTHER_ANSWER]
+
+
+def run_async(app: Any, run: str, sessions: int, hit_ratio: float, think_time: float) -> List[float]:
+    from workflow import ainvoke_reply
+
+    final: List[float] = []
+
+    async def _session(index: int) -> None:
+        config = {"configurable": {"thread_id": f"{run}-{index}"}}
+        questions = _questions(index, hit_ratio, sessions)
+        for turn, question in enumerate(questions):
+            started = time.perf_counter()
+            await ainvoke_reply(app, question, config)
+            if turn == len(questions) - 1:
+                final.append(time.perf_counter() - started)
+            else:
+                await asyncio.sleep(think_time)
+
+    async def _all() -> None:
+        await asyncio.gather(*(_session(index) for index in range(sessions)))
+
+    asyncio.run(_all())
+    return final
+
+
+def run_sync(app: Any, run: str, sessions: int, hit_ratio: float, think_time: float) -> List[float]:
+    from workflow import invoke_reply
+
+    final: List[float] = []
+
+    def _session(index: int) -> None:
+        config = {"configurable": {"thread_id": f"{run}-{index}"}}
+        questions = _questions(index, hit_ratio, sessions)
+        for turn, question in enumerate(questions):
+            started = time.perf_counter()
+            invoke_reply(app, question, config)
+            if turn == len(questions) - 1:
+                final.append(time.perf_counter() - started)
+            else:
+                time.sleep(think_time)
+
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        for future in [pool.submit(_session, index) for index in range(sessions)]:
+            future.result()
+    return final
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("async", "sync"), default="async")
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--think-time", type=float, default=2.0, help="两轮之间用户停顿的秒数")
+    parser.add_argument("--hit-ratio", type=float, default=0.8, help="最后一轮回答与推测一致的会话比例")
+    parser.add_argument("--llm-latency", default="lognormal:0.6:0.4", help="见 stubs.latency_sampler")
+    parser.add_argument("--rag-latency", default="lognormal:1.2:0.4")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    from stubs import StubBackends
+
+    backends = StubBackends(args.llm_latency, args.rag_latency, 0.0, seed=args.seed).install()
+    import shopping_flow
+    from session_store import create_checkpointer
+    from speculation import speculation_stats
+    from workflow import build_app
+
+    app = build_app(warm_up_regions=[], checkpointer=create_checkpointer("memory"))
+    runner = run_async if args.mode == "async" else run_sync
+    report: Dict[str, Any] = {"config": vars(args), "runs": {}}
+    for run, enabled in (("off", False), ("on", True)):
+        shopping_flow.SPECULATIVE_RECOMMEND_ENABLED = enabled
+        before = backends.snapshot()
+        stats_before = speculation_stats()
+        final = runner(app, run, args.sessions, args.hit_ratio, args.think_time)
+        after = backends.snapshot()
+        stats = speculation_stats()
+        report["runs"][run] = {
+            "final_turn_ms": _percentiles(final),
+            "rag_calls_per_session": round((after["rag"] - before["rag"]) / args.sessions, 2),
+            "speculation": {
+                name: stats.get(name, 0) - stats_before.get(name, 0)
+                for name in ("started", "hits", "misses", "joined", "unstarted", "failed", "replaced", "expired")
+            },
+        }
+
+    print(
+        f"mode={args.mode} sessions={args.sessions} think_time={args.think_time}s "
+        f"hit_ratio={args.hit_ratio} rag_latency={args.rag_latency}"
+    )
+    print(f"{'speculation':<13}{'final p50':>11}{'final p95':>11}{'rag/session':>13}  counts")
+    for run, item in report["runs"].items():
+        counts = " ".join(f"{name}={value}" for name, value in item["speculation"].items() if value)
+        print(
+            f"{run:<13}{item['final_turn_ms']['p50']:>11}{item['final_turn_ms']['p95']:>11}"
+            f"{item['rag_calls_per_session']:>13}  {counts or '-'}"
+        )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,128 @@
+﻿"""启动耗时基准：各模块的导入耗时、命令行出现提示符的时间，以及短批量任务的总耗时。
+
+用法：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --json startup.json
+
+每项测量都在新的子进程中进行，结果取中位数；导入耗时来自 python -X importtime。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("tools", "planning", "workflow", "main")
+PROMPT_MARK = "已进入客服模式"
+
+
+def _env() -> Dict[str, str]:
+    env = dict(os.environ, PYTHONUNBUFFERED="1", PYTHONPATH=ROOT)
+    env.pop("OPENAPI_WARMUP_REGIONS", None)
+    return env
+
+
+def import_time_ms(module: str) -> float:
+    """导入 module 的累计耗时（含其依赖）。"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"importtime 输出中没有 {module}")
+
+
+def time_to_prompt_ms() -> float:
+    """启动交互式命令行，直到打印出提示语的耗时。"""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py")],
+        cwd=ROOT,
+        env=_env(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        for line in process.stdout:
+            if PROMPT_MARK in line:
+                return (time.perf_counter() - started) * 1000
+        raise RuntimeError("命令行没有打印提示语")
+    finally:
+        process.kill()
+        process.wait()
+
+
+def batch_run_ms(turns_path: str, output_path: str, db_path: str) -> float:
+    """用离线桩（零延迟）跑一个小批量回放，测量进程从启动到退出的总耗时。"""
+    started = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT, "main.py"),
+            "--batch", turns_path,
+            "--output", output_path,
+            "--stub", "--stub-latency", "0",
+        ],
+        cwd=ROOT,
+        env=dict(_env(), SESSION_DB_PATH=db_path, RAG_CACHE_TTL="0"),
+        capture_output=True,
+        check=True,
+    )
+    return (time.perf_counter() - started) * 1000
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    return {"median": round(statistics.median(samples), 1), "min": round(min(samples), 1), "max": round(max(samples), 1)}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    report: Dict[str, Any] = {"python": sys.version.split()[0], "repeat": args.repeat, "import_ms": {}}
+    for module in MODULES:
+        report["import_ms"][module] = _summary([import_time_ms(module) for _ in range(args.repeat)])
+    report["time_to_prompt_ms"] = _summary([time_to_prompt_ms() for _ in range(args.repeat)])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        turns_path = os.path.join(workdir, "turns.jsonl")
+        with open(turns_path, "w", encoding="utf-8") as handle:
+            for question in ("你好", "你们支持开发票吗"):
+                handle.write(json.dumps({"session_id": "bench", "question": question}, ensure_ascii=False) + "\n")
+        report["batch_2_turns_ms"] = _summary(
+            [
+                batch_run_ms(turns_path, os.path.join(workdir, f"out{index}.jsonl"), os.path.join(workdir, "s.db"))
+                for index in range(args.repeat)
+            ]
+        )
+
+    print(f"python={report['python']} repeat={args.repeat}")
+    print(f"{'measure':<22}{'median_ms':>11}{'min_ms':>10}{'max_ms':>10}")
+    rows = [(f"import {module}", item) for module, item in report["import_ms"].items()]
+    rows += [("time to prompt", report["time_to_prompt_ms"]), ("batch (2 turns)", report["batch_2_turns_ms"])]
+    for name, item in rows:
+        print(f"{name:<22}{item['median']:>11}{item['min']:>10}{item['max']:>10}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,312 @@
+﻿"""离线回合基准：用离线桩替代 DashScope/OpenAPI，回放脚本化多轮对话，统计延迟与上游调用。
+
+用法：
+    python benchmarks/bench_turns.py --concurrency 8 --sessions 64
+    python benchmarks/bench_turns.py --mode sync --llm-latency lognormal:0.6:0.4 --json result.json
+    python benchmarks/bench_turns.py --failure-rate 0.05 --stall-rate 0.02 --stall-seconds 30
+    python benchmarks/bench_turns.py --stub-llm-qps 40   # 对比设置 UPSTREAM_RATE_LLM 前后的限流错误
+
+先逐个场景串行跑一遍（桩延迟置零），得到每轮的上游调用数与提示词字符数；
+再按 --concurrency 并发回放 --sessions 个会话，得到回合延迟分位数与吞吐。
+--failure-rate/--stall-rate/--stub-llm-qps 只作用于负载阶段，用来观察重试、对冲、熔断与客户端配额的效果。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from stubs import StubBackends  # noqa: E402
+from workflow import ainvoke_reply, invoke_reply  # noqa: E402
+
+SCENARIOS: Dict[str, List[str]] = {
+    # 完整导购：逐步补齐需求直到给出推荐。
+    "shopping": [
+        "我想买一台云服务器做 web 网站",
+        "2-4核 8G 内存",
+        "预算每月 500元",
+        "部署在杭州",
+    ],
+    # 资源查询与规格问答混合。
+    "resource_spec": [
+        "查一下账户余额",
+        "杭州有哪些 ECS 实例",
+        "查一下我的实例，顺便介绍 ecs.c7.xlarge 的规格参数",
+    ],
+    "general": [
+        "你好",
+        "你们支持开发票吗",
+    ],
+    # 长对话：多轮规格问答与闲聊，历史里累积大量长回答。
+    "long_chat": [
+        "ecs.g7.large 的规格参数是多少",
+        "ecs.c7.xlarge 的规格参数呢",
+        "你们支持开发票吗",
+        "ecs.r7.2xlarge 适合什么场景，规格参数是多少",
+        "发票多久能开出来",
+        "ecs.g8i.xlarge 的规格参数",
+        "能帮我对比一下刚才这几个规格吗",
+        "ecs.c8y.large 是什么架构，规格参数是多少",
+        "谢谢，还有别的建议吗",
+        "ecs.g7.2xlarge 的规格参数",
+        "最后再总结一下我们聊过的规格",
+        "好的，谢谢",
+    ],
+}
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    values = np.array(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(p50, 1), "p95": round(p95, 1), "p99": round(p99, 1), "mean": round(values.mean(), 1)}
+
+
+def _delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    return {key: after[key] - before[key] for key in after}
+
+
+def _run_turn(app: Any, question: str, session_id: str) -> None:
+    invoke_reply(app, question, {"configurable": {"thread_id": session_id}})
+
+
+async def _arun_turn(app: Any, question: str, session_id: str) -> None:
+    await ainvoke_reply(app, question, {"configurable": {"thread_id": session_id}})
+
+
+def calibrate(app: Any, backends: StubBackends, scenarios: List[str], mode: str) -> Dict[str, Any]:
+    """串行回放每个场景，按轮统计上游调用数与提示词字符数。"""
+    from tools import invalidate_openapi_cache
+
+    samplers = (backends.llm_latency, backends.rag_latency, backends.openapi_latency, backends.model_latency)
+    faults = (backends.failure_rate, backends.stall_rate, backends.llm_qps)
+    backends.llm_latency = backends.rag_latency = backends.openapi_latency = lambda: 0.0
+    backends.model_latency = {}
+    backends.failure_rate = backends.stall_rate = backends.llm_qps = 0.0
+    result: Dict[str, Any] = {}
+    try:
+        for name in scenarios:
+            invalidate_openapi_cache()
+            per_turn = []
+            for index, question in enumerate(SCENARIOS[name]):
+                before = backends.snapshot()
+                if mode == "async":
+                    asyncio.run(_arun_turn(app, question, f"calibrate-{name}"))
+                else:
+                    _run_turn(app, question, f"calibrate-{name}")
+                per_turn.append({"turn": index + 1, **_delta(before, backends.snapshot())})
+            turns = len(per_turn)
+            result[name] = {
+                "turns": per_turn,
+                "llm_calls_per_turn": round(sum(item["llm"] for item in per_turn) / turns, 2),
+                "rag_calls_per_turn": round(sum(item["rag"] for item in per_turn) / turns, 2),
+                "openapi_calls_per_turn": round(sum(item["openapi"] for item in per_turn) / turns, 2),
+                "prompt_chars_per_turn": round(sum(item["prompt_chars"] for item in per_turn) / turns, 1),
+            }
+    finally:
+        backends.llm_latency, backends.rag_latency, backends.openapi_latency, backends.model_latency = samplers
+        backends.failure_rate, backends.stall_rate, backends.llm_qps = faults
+    return result
+
+
+def _session_plan(scenarios: List[str], sessions: int) -> List[str]:
+    return [scenarios[index % len(scenarios)] for index in range(sessions)]
+
+
+def load_sync(app: Any, plan: List[str], concurrency: int, errors: List[str]) -> Dict[str, List[float]]:
+    latencies: Dict[str, List[float]] = {name: [] for name in set(plan)}
+
+    def _session(index: int, name: str) -> None:
+        for question in SCENARIOS[name]:
+            started = time.perf_counter()
+            try:
+                _run_turn(app, question, f"load-{index}")
+            except Exception as exc:
+                errors.append(type(exc).__name__)
+            latencies[name].append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(_session, index, name) for index, name in enumerate(plan)]:
+            future.result()
+    return latencies
+
+
+async def load_async(app: Any, plan: List[str], concurrency: int, errors: List[str]) -> Dict[str, List[float]]:
+    latencies: Dict[str, List[float]] = {name: [] for name in set(plan)}
+    limit = asyncio.Semaphore(concurrency)
+
+    async def _session(index: int, name: str) -> None:
+        async with limit:
+            for question in SCENARIOS[name]:
+                started = time.perf_counter()
+                try:
+                    await _arun_turn(app, question, f"load-{index}")
+                except Exception as exc:
+                    errors.append(type(exc).__name__)
+                latencies[name].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(_session(index, name) for index, name in enumerate(plan)))
+    return latencies
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("async", "sync"), default="async")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=48, help="负载阶段回放的会话数（按场景轮流分配）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔的场景名")
+    parser.add_argument("--llm-latency", default="lognormal:0.6:0.4", help="见 stubs.latency_sampler")
+    parser.add_argument("--fast-llm-latency", default="lognormal:0.25:0.4", help="快速模型（DASHSCOPE_FAST_MODEL）的延迟")
+    parser.add_argument("--rag-latency", default="lognormal:1.2:0.4")
+    parser.add_argument("--openapi-latency", default="uniform:0.05:0.15")
+    parser.add_argument("--answer-chars", type=int, default=600, help="桩的自由文本回答补齐到的字符数")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="负载阶段上游调用返回 503 的比例")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="负载阶段上游调用额外卡顿的比例")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="卡顿时长（秒）")
+    parser.add_argument("--stub-llm-qps", type=float, default=0.0, help="模拟服务端 LLM 配额（次/秒），超出返回 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件，便于回归对比")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知场景：{', '.join(unknown)}")
+
+    from tools import FAST_MODEL
+
+    backends = StubBackends(
+        args.llm_latency,
+        args.rag_latency,
+        args.openapi_latency,
+        seed=args.seed,
+        answer_chars=args.answer_chars,
+        failure_rate=args.failure_rate,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        model_latency={FAST_MODEL: args.fast_llm_latency},
+        llm_qps=args.stub_llm_qps,
+    ).install()
+    from resilience import upstream_stats
+    from session_store import create_checkpointer
+    from speculation import speculation_stats
+    from workflow import build_app
+
+    app = build_app(warm_up_regions=[], checkpointer=create_checkpointer("memory"))
+    calibration = calibrate(app, backends, scenarios, args.mode)
+
+    plan = _session_plan(scenarios, args.sessions)
+    before = backends.snapshot()
+    models_before = dict(backends.model_calls)
+    errors: List[str] = []
+    started = time.perf_counter()
+    if args.mode == "async":
+        latencies = asyncio.run(load_async(app, plan, args.concurrency, errors))
+    else:
+        latencies = load_sync(app, plan, args.concurrency, errors)
+    elapsed = time.perf_counter() - started
+    calls = _delta(before, backends.snapshot())
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    report = {
+        "config": {
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "sessions": args.sessions,
+            "llm_latency": args.llm_latency,
+            "fast_llm_latency": args.fast_llm_latency,
+            "rag_latency": args.rag_latency,
+            "openapi_latency": args.openapi_latency,
+            "seed": args.seed,
+            "answer_chars": args.answer_chars,
+            "failure_rate": args.failure_rate,
+            "stall_rate": args.stall_rate,
+            "stall_seconds": args.stall_seconds,
+            "stub_llm_qps": args.stub_llm_qps,
+            "env": {
+                name: os.environ.get(name, "")
+                for name in (
+                    "TURN_PLANNER_MODE",
+                    "CATALOG_ANSWER_MODE",
+                    "MODEL_TIERING",
+                    "UPSTREAM_RETRIES",
+                    "UPSTREAM_HEDGE",
+                    "UPSTREAM_RATE_LLM",
+                    "UPSTREAM_TPM_LLM",
+                )
+            },
+        },
+        "scenarios": {
+            name: {**calibration[name], "latency_ms": _percentiles(latencies.get(name, []))}
+            for name in scenarios
+        },
+        "overall": {
+            "turns": len(all_latencies),
+            "failed_turns": len(errors),
+            "elapsed_s": round(elapsed, 2),
+            "throughput_turns_per_s": round(len(all_latencies) / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": _percentiles(all_latencies),
+            "upstream_calls_per_turn": {
+                key: round(value / max(1, len(all_latencies)), 2) for key, value in calls.items()
+            },
+            "llm_calls_by_model": {
+                model: count - models_before.get(model, 0) for model, count in sorted(backends.model_calls.items())
+            },
+        },
+        "upstreams": upstream_stats(),
+        "speculation": speculation_stats(),
+    }
+
+    print(f"mode={args.mode} concurrency={args.concurrency} sessions={args.sessions}")
+    print(f"{'scenario':<14}{'llm/turn':>9}{'rag/turn':>9}{'api/turn':>9}{'chars/turn':>11}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, item in report["scenarios"].items():
+        latency = item["latency_ms"]
+        print(
+            f"{name:<14}{item['llm_calls_per_turn']:>9}{item['rag_calls_per_turn']:>9}"
+            f"{item['openapi_calls_per_turn']:>9}{item['prompt_chars_per_turn']:>11}"
+            f"{latency['p50']:>9}{latency['p95']:>9}{latency['p99']:>9}"
+        )
+    overall = report["overall"]
+    print(
+        f"overall: turns={overall['turns']} throughput={overall['throughput_turns_per_s']}/s "
+        f"p50={overall['latency_ms']['p50']}ms p95={overall['latency_ms']['p95']}ms p99={overall['latency_ms']['p99']}ms"
+    )
+    print("llm calls by model: " + ", ".join(f"{model}={count}" for model, count in overall["llm_calls_by_model"].items()))
+    if args.failure_rate or args.stall_rate or args.stub_llm_qps:
+        print(
+            f"injected: failures={calls['failures']} stalls={calls['stalls']} "
+            f"throttled={calls['throttled']} failed_turns={len(errors)}"
+        )
+        for name, item in report["upstreams"].items():
+            print(
+                f"  {name:<8} calls={item['calls']} retries={item['retries']} timeouts={item['timeouts']} "
+                f"hedges={item['hedges']}/{item['hedge_wins']} short_circuits={item['short_circuits']} state={item['state']}"
+            )
+    for name, item in report["upstreams"].items():
+        quota = item.get("quota")
+        if quota:
+            waits = ", ".join(f"{cls} p50={wait['p50_ms']}ms p95={wait['p95_ms']}ms" for cls, wait in quota["queue_wait"].items())
+            print(f"  {name:<8} quota throttled={item['throttled']} queue_wait: {waits or '-'}")
+    speculation = report["speculation"]
+    if speculation.get("started"):
+        # 负载阶段回合之间没有停顿，推测任务大多要等（joined）；停顿的影响见 bench_speculation.py。
+        print(
+            f"speculation: started={speculation['started']} hits={speculation.get('hits', 0)} "
+            f"misses={speculation.get('misses', 0)} joined={speculation.get('joined', 0)} hit_rate={speculation['hit_rate']}"
+        )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,112 @@
+﻿"""worker 池基准：对比单进程与多 worker 进程处理同一批会话的吞吐与回合延迟。
+
+用法：
+    python benchmarks/bench_workers.py --workers 0,2,4 --sessions 64 --concurrency 32
+    python benchmarks/bench_workers.py --stub-latency lognormal:0.3:0.4 --json workers.json
+
+上游全部换成离线桩，默认零延迟，使回合耗时集中在 LangGraph 状态处理、提示词构建与 JSON 解析上（受 GIL 限制的部分）；
+每种配置使用独立的 SQLite 会话库。workers=0 表示在本进程内执行。同一会话的回合串行执行。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUESTIONS = (
+    "我想买一台云服务器做 web 网站",
+    "2-4核 8G 内存",
+    "预算每月 500元",
+    "部署在杭州",
+    "ecs.g7.large 的规格参数是多少",
+    "你们支持开发票吗",
+)
+
+
+async def _replay(turn: Callable[[str, str], Awaitable[Any]], sessions: int, concurrency: int) -> List[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def _session(index: int) -> None:
+        async with semaphore:
+            for question in QUESTIONS:
+                started = time.perf_counter()
+                await turn(f"bench-{index}", question)
+                latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(_session(index) for index in range(sessions)))
+    return latencies
+
+
+async def run(workers: int, sessions: int, concurrency: int, stub_latency: str) -> Dict[str, Any]:
+    from worker_pool import WorkerPool
+
+    if workers:
+        pool = WorkerPool(workers, stub_latency=stub_latency)
+        await pool.start()
+        turn = pool.ainvoke
+    else:
+        from session_store import SqliteCheckpointSaver
+        from stubs import install_stub_backends
+        from workflow import ainvoke_reply, build_app
+
+        install_stub_backends(stub_latency, stub_latency, stub_latency)
+        app = build_app(warm_up_regions=[], checkpointer=SqliteCheckpointSaver(os.environ["SESSION_DB_PATH"]))
+
+        async def turn(session_id: str, question: str) -> Any:
+            return await ainvoke_reply(app, question, {"configurable": {"thread_id": session_id}})
+
+    try:
+        started = time.perf_counter()
+        latencies = sorted(await _replay(turn, sessions, concurrency))
+        elapsed = time.perf_counter() - started
+    finally:
+        if workers:
+            await pool.close()
+    return {
+        "workers": workers,
+        "turns": len(latencies),
+        "elapsed_s": round(elapsed, 2),
+        "turns_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="0,2,4", help="逗号分隔的 worker 数，0 表示单进程")
+    parser.add_argument("--sessions", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=32, help="同时进行的会话数")
+    parser.add_argument("--stub-latency", default="0", help="离线桩的上游延迟，见 stubs.latency_sampler")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    results = []
+    for workers in [int(item) for item in args.workers.split(",") if item.strip()]:
+        with tempfile.TemporaryDirectory() as workdir:
+            # worker 子进程继承这些环境变量。
+            os.environ["SESSION_DB_PATH"] = os.path.join(workdir, "sessions.sqlite3")
+            os.environ["RAG_CACHE_TTL"] = "0"
+            results.append(asyncio.run(run(workers, args.sessions, args.concurrency, args.stub_latency)))
+
+    print(f"cpus={os.cpu_count()} sessions={args.sessions} concurrency={args.concurrency} stub_latency={args.stub_latency}")
+    print(f"{'workers':>8}{'turns':>7}{'elapsed_s':>11}{'turns/s':>9}{'p50_ms':>9}{'p95_ms':>9}")
+    for item in results:
+        print(
+            f"{item['workers']:>8}{item['turns']:>7}{item['elapsed_s']:>11}{item['turns_per_s']:>9}"
+            f"{item['p50_ms']:>9}{item['p95_ms']:>9}"
+        )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as handle:
+            json.dump({"cpus": os.cpu_count(), "results": results}, handle, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,195 @@
+﻿import csv
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from helpers import REGION_ALIASES
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "instance_catalog.csv")
+CATALOG_COLUMNS = ("instance_type", "family", "vcpu", "memory_gib", "arch", "region_id", "price_month")
+NUMERIC_COLUMNS = {"vcpu", "memory_gib", "price_month"}
+
+# 场景关键词 -> 优先的规格族类别（c=计算型，g=通用型，r=内存型）。
+SCENE_FAMILY_CLASSES = {
+    "web": "g",
+    "通用": "g",
+    "网站": "g",
+    "数据库": "r",
+    "缓存": "r",
+    "redis": "r",
+    "内存": "r",
+    "大数据": "r",
+    "计算": "c",
+    "推理": "c",
+    "ai": "c",
+    "游戏": "c",
+    "视频": "c",
+}
+ARCH_ALIASES = {
+    "arm": "arm64",
+    "倚天": "arm64",
+    "yitian": "arm64",
+    "x86": "x86_64",
+    "intel": "x86_64",
+    "amd": "x86_64",
+}
+
+Range = Tuple[float, float]
+
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+_catalog: Optional["InstanceCatalog"] = None
+
+
+def parse_range(text: str, single_is_upper: bool = False) -> Optional[Range]:
+    """把“2-4 核”“至少 8G”“500 元以内”等描述解析为闭区间，无法解析返回 None。
+
+    single_is_upper 为 True 时，单个数字视为上限（如预算“每月 500 元”）。
+    """
+    if not text:
+        return None
+    numbers = [float(value) for value in _NUMBER_PATTERN.findall(str(text))]
+    if not numbers:
+        return None
+    if len(numbers) >= 2:
+        return min(numbers[:2]), max(numbers[:2])
+    value = numbers[0]
+    if any(hint in text for hint in ("至少", "以上", "不少于", "起", ">")):
+        return value, math.inf
+    if single_is_upper or any(hint in text for hint in ("以内", "以下", "不超过", "最多", "<")):
+        return 0.0, value
+    return value, value
+
+
+def _monthly_budget(text: str) -> Optional[Range]:
+    budget = parse_range(text, single_is_upper=True)
+    if budget and ("年" in text):
+        budget = (budget[0] / 12, budget[1] / 12)
+    return budget
+
+
+def _resolve_region(text: str) -> str:
+    lowered = (text or "").strip().lower()
+    if lowered in REGION_ALIASES.values():
+        return lowered
+    for alias, region_id in REGION_ALIASES.items():
+        if alias in lowered:
+            return region_id
+    return ""
+
+
+def _resolve_arch(text: str) -> str:
+    lowered = (text or "").lower()
+    for alias, arch in ARCH_ALIASES.items():
+        if alias in lowered:
+            return arch
+    return ""
+
+
+def _scene_class(text: str) -> str:
+    lowered = (text or "").lower()
+    for keyword, family_class in SCENE_FAMILY_CLASSES.items():
+        if keyword in lowered:
+            return family_class
+    return ""
+
+
+class InstanceCatalog:
+    """按列存储的实例规格目录，每行是一个（规格, 地域）组合。"""
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+        self.size = len(columns["instance_type"])
+        self.family_class = np.array([family[:1] for family in columns["family"]])
+
+    @classmethod
+    def load(cls, path: str) -> "InstanceCatalog":
+        raw: Dict[str, List[str]] = {name: [] for name in CATALOG_COLUMNS}
+        with open(path, encoding="utf-8") as handle:
+            for row in csv.DictReader(handle):
+                for name in CATALOG_COLUMNS:
+                    raw[name].append(row[name])
+        columns = {
+            name: np.array(values, dtype=float if name in NUMERIC_COLUMNS else str)
+            for name, values in raw.items()
+        }
+        return cls(columns)
+
+    def filter(
+        self,
+        vcpu: Optional[Range] = None,
+        memory: Optional[Range] = None,
+        budget: Optional[Range] = None,
+        region_id: str = "",
+        arch: str = "",
+    ) -> np.ndarray:
+        """返回满足全部条件的行掩码。"""
+        mask = np.ones(self.size, dtype=bool)
+        if vcpu:
+            mask &= (self.columns["vcpu"] >= vcpu[0]) & (self.columns["vcpu"] <= vcpu[1])
+        if memory:
+            mask &= (self.columns["memory_gib"] >= memory[0]) & (self.columns["memory_gib"] <= memory[1])
+        if budget:
+            mask &= self.columns["price_month"] <= budget[1]
+        if region_id:
+            mask &= self.columns["region_id"] == region_id
+        if arch:
+            mask &= self.columns["arch"] == arch
+        return mask
+
+    def shortlist(self, requirements: Dict[str, str], limit: int = 5) -> List[Dict[str, Any]]:
+        """按需求过滤并排序：场景匹配的规格族优先，其次价格从低到高。"""
+        region_id = _resolve_region(requirements.get("地域", ""))
+        mask = self.filter(
+            vcpu=parse_range(requirements.get("vCPU", "")),
+            memory=parse_range(requirements.get("内存", "")),
+            budget=_monthly_budget(requirements.get("预算", "")),
+            region_id=region_id,
+            arch=_resolve_arch(requirements.get("架构", "")),
+        )
+        indices = np.flatnonzero(mask)
+        if not indices.size:
+            return []
+        family_class = _scene_class(requirements.get("场景", ""))
+        scene_miss = (self.family_class[indices] != family_class) if family_class else np.zeros(indices.size)
+        order = indices[np.lexsort((self.columns["price_month"][indices], scene_miss))]
+        candidates: List[Dict[str, Any]] = []
+        seen = set()
+        for index in order:
+            instance_type = str(self.columns["instance_type"][index])
+            # 未指定地域时同一规格只保留最便宜的地域。
+            if instance_type in seen:
+                continue
+            seen.add(instance_type)
+            candidates.append({name: self.columns[name][index].item() for name in CATALOG_COLUMNS})
+            if len(candidates) >= limit:
+                break
+        return candidates
+
+
+def load_catalog() -> Optional[InstanceCatalog]:
+    """加载 INSTANCE_CATALOG_PATH 指向的本地目录（默认 data/instance_catalog.csv），文件不存在返回 None。"""
+    global _catalog
+    if _catalog is None:
+        path = os.environ.get("INSTANCE_CATALOG_PATH", DEFAULT_CATALOG_PATH)
+        if not os.path.exists(path):
+            return None
+        _catalog = InstanceCatalog.load(path)
+    return _catalog
+
+
+def shortlist_candidates(requirements: Dict[str, str], limit: int = 5) -> List[Dict[str, Any]]:
+    catalog = load_catalog()
+    if catalog is None:
+        return []
+    return catalog.shortlist(requirements, limit)
+
+
+def format_candidates(candidates: List[Dict[str, Any]]) -> str:
+    return "\n".join(
+        f"- {item['instance_type']}（{item['vcpu']:g} vCPU / {item['memory_gib']:g} GiB / "
+        f"{item['arch']} / {item['region_id']} / 参考价约 {item['price_month']:g} 元/月）"
+        for item in candidates
+    )
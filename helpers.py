@@ -1,5 +1,10 @@
-﻿import os
-from typing import Dict, List
+﻿import functools
+import json
+import os
+import re
+from collections import deque
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
 
 REGION_ALIASES = {
     "hangzhou": "cn-hangzhou",
@@ -19,21 +24,172 @@ REGION_ALIASES = {
 }
 
 HISTORY_MAX_MESSAGES = 12
+# 每类调用可带入的历史 token 预算：路由/抽取只需少量上下文，最终回答与汇总给得更多。
+HISTORY_TOKEN_BUDGETS = {
+    "router": int(os.environ.get("HISTORY_BUDGET_ROUTER", "300")),
+    "plan": int(os.environ.get("HISTORY_BUDGET_PLAN", "400")),
+    "extract": int(os.environ.get("HISTORY_BUDGET_EXTRACT", "400")),
+    "answer": int(os.environ.get("HISTORY_BUDGET_ANSWER", "1500")),
+    "summary": int(os.environ.get("HISTORY_BUDGET_SUMMARY", "2000")),
+}
+SUMMARY_ROLE = "summary"
+TRUNCATED_MARK = "…（已截断）"
+MIN_TRUNCATED_TOKENS = 32
 EXIT_COMMANDS = {"exit", "quit", "bye", "退出", "再见", "结束"}
 RESET_COMMANDS = {"reset", "restart", "重置", "重新开始", "清空"}
 
+_WIDE_CHARS = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+# 各启发式分类共用的关键词表：信号名 -> 关键词。地域信号由 REGION_ALIASES 生成（region:<别名或 region id>）。
+INTENT_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "spec": ("ecs.", "规格", "参数", "详情"),
+    "balance": ("余额", "账户", "账单"),
+    "instance": ("实例",),
+    "ecs": ("ecs",),
+    "buy": ("推荐", "购买", "选型", "导购"),
+    "carry_over": (
+        "沿用", "继续", "基于", "在之前基础上", "在刚才基础上", "之前", "上次", "刚才", "同样", "不变", "其余不变", "照旧",
+    ),
+    # 指代上文内容（“这几个”“上面的”），需要结合历史才能理解。
+    "reference": ("这几个", "这几款", "这些", "上面", "上述", "前面", "它们", "那个", "那几个", "那些"),
+    "modify": ("改为", "改成", "改到", "调整", "变为", "换成", "提高", "降低", "上调", "下调", "更新"),
+    "requirement": ("场景", "业务", "用途", "预算", "内存", "vcpu", "cpu", "核", "地域", "区域"),
+    # 以下用于解析路由模型的输出。
+    "label_shopping": ("shopping", "导购", "选型", "推荐"),
+    "label_resource": ("resource", "资源", "余额", "实例", "规格"),
+    "label_general": ("general", "其他", "通用"),
+    "label_guide": ("ecs", "guide", "导购"),
+    "label_other": ("other", "其他"),
+}
+INTENT_CACHE_SIZE = 4096
+# 只在前后不是字母数字时才算命中的信号（等价于正则的 \b关键词\b）。
+WHOLE_WORD_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "ecs_word": ("ecs",),
+}
+
+
+class KeywordMatcher:
+    """Aho-Corasick 多模式匹配：把关键词表编译成确定性自动机，对文本只扫描一遍即可得到全部命中的信号。"""
+
+    def __init__(
+        self,
+        keywords: Dict[str, Iterable[str]],
+        whole_words: Optional[Dict[str, Iterable[str]]] = None,
+        ascii_words: Optional[Dict[str, Iterable[str]]] = None,
+    ):
+        """whole_words 要求前后不是字母数字（含中文，等价于 \\b）；ascii_words 只要求前后不是 ASCII 字母数字，
+        用于夹在中文里的英文关键词（如“用于web服务”）。"""
+        entries: Dict[Tuple[str, str], List[str]] = {}
+        for boundary, table in (("", keywords), ("word", whole_words or {}), ("ascii", ascii_words or {})):
+            for signal, words in table.items():
+                for word in words:
+                    entries.setdefault((word.lower(), boundary), []).append(signal)
+        goto: List[Dict[str, int]] = [{}]
+        outputs: List[List[Tuple[int, Tuple[str, ...], str]]] = [[]]
+        for (word, boundary), signals in entries.items():
+            state = 0
+            for char in word:
+                if char not in goto[state]:
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            outputs[state].append((len(word), tuple(signals), boundary))
+        # 按层（BFS）计算失败指针，并把失败状态的转移与输出并入各状态，扫描时每个字符只查一次表。
+        fail = [0] * len(goto)
+        delta: List[Dict[str, int]] = [dict(goto[0])] + [{} for _ in goto[1:]]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            outputs[state] = outputs[state] + outputs[fail[state]]
+            for char, target in goto[state].items():
+                fail[target] = delta[fail[state]].get(char, 0)
+                queue.append(target)
+        self._transitions = [transitions.get for transitions in delta]
+        self._outputs = [tuple(output) for output in outputs]
+        self._accepting = frozenset(state for state, output in enumerate(outputs) if output)
+
+    def scan(self, text: str) -> Dict[str, int]:
+        """返回 {信号: 首次命中关键词的起始位置}。"""
+        found: Dict[str, int] = {}
+        if not text:
+            return found
+        lowered = text.lower()
+        transitions = self._transitions
+        accepting = self._accepting
+        state = 0
+        for index, char in enumerate(lowered):
+            state = transitions[state](char, 0)
+            if state not in accepting:
+                continue
+            for length, signals, boundary in self._outputs[state]:
+                start = index - length + 1
+                if boundary and not _BOUNDARY_CHECKS[boundary](lowered, start, index + 1):
+                    continue
+                for signal in signals:
+                    # 同一信号的多个关键词可能先结束的起点反而靠后，取最小起点。
+                    if found.get(signal, start) >= start:
+                        found[signal] = start
+        return found
+
+
+def _is_word_boundary(text: str, start: int, end: int) -> bool:
+    before = text[start - 1] if start > 0 else ""
+    after = text[end] if end < len(text) else ""
+    return not (before.isalnum() or before == "_") and not (after.isalnum() or after == "_")
+
+
+def _is_ascii_boundary(text: str, start: int, end: int) -> bool:
+    before = text[start - 1] if start > 0 else ""
+    after = text[end] if end < len(text) else ""
+    return not (_is_ascii_word_char(before) or _is_ascii_word_char(after))
+
+
+def _is_ascii_word_char(char: str) -> bool:
+    return char.isascii() and (char.isalnum() or char == "_")
+
+
+_BOUNDARY_CHECKS = {"word": _is_word_boundary, "ascii": _is_ascii_boundary}
+
+
+def _region_precedence() -> Dict[str, Tuple[int, str]]:
+    """关键词 -> (优先级, region id)：先按 REGION_ALIASES 中别名的顺序，再按 region id 本身。"""
+    precedence: Dict[str, Tuple[int, str]] = {}
+    for word, region_id in [*REGION_ALIASES.items(), *((region_id, region_id) for region_id in REGION_ALIASES.values())]:
+        precedence.setdefault(word, (len(precedence), region_id))
+    return precedence
+
+
+# 每个别名与 region id 各自一个信号，文本里出现多个地域时按这里的优先级取，而不是按出现位置。
+_REGION_PRECEDENCE = _region_precedence()
+
+
+def _region_keywords() -> Dict[str, Tuple[str, ...]]:
+    return {f"region:{word}": (word,) for word in _REGION_PRECEDENCE}
+
+
+_intent_matcher = KeywordMatcher({**INTENT_KEYWORDS, **_region_keywords()}, WHOLE_WORD_KEYWORDS)
+
+
+@functools.lru_cache(maxsize=INTENT_CACHE_SIZE)
+def intent_signals(text: str) -> Mapping[str, int]:
+    """一次扫描返回文本命中的全部意图信号（信号 -> 首次出现位置），信号见 INTENT_KEYWORDS 与 region:<别名或 region id>。
+
+    同一轮里路由、导购、资源规划会对同一句话各判断一次，结果按文本缓存，只扫描一遍。
+    """
+    return MappingProxyType(_intent_matcher.scan(text or ""))
+
+
+def region_from_signals(signals: Mapping[str, int]) -> str:
+    """取命中的地域中优先级最高的一个（见 _REGION_PRECEDENCE），未命中返回空字符串。"""
+    regions = [_REGION_PRECEDENCE[signal[len("region:"):]] for signal in signals if signal.startswith("region:")]
+    return min(regions)[1] if regions else ""
+
 
 def resolve_region_id(question: str) -> str:
     """从问题中解析 region id，未命中返回默认地域。"""
-    default_region = os.environ.get("DEFAULT_REGION_ID", "")
-    lowered = question.lower()
-    for alias, region_id in REGION_ALIASES.items():
-        if alias in lowered:
-            return region_id
-    for region_id in REGION_ALIASES.values():
-        if region_id in lowered:
-            return region_id
-    return default_region
+    return region_from_signals(intent_signals(question)) or os.environ.get("DEFAULT_REGION_ID", "")
 
 
 def trim_history(history: List[Dict[str, str]], max_messages: int = HISTORY_MAX_MESSAGES) -> List[Dict[str, str]]:
@@ -43,6 +199,66 @@ def trim_history(history: List[Dict[str, str]], max_messages: int = HISTORY_MAX_
     return history[-max_messages:]
 
 
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个计，其余字符按 4 个 1 个计。"""
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATED_MARK
+
+
+def fit_history(history: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """按 token 预算从最新消息往前保留历史；放不下的长消息截断，摘要（role=summary）最后按剩余预算带上。"""
+    if not history or budget <= 0:
+        return []
+    summary = [msg for msg in history if msg.get("role") == SUMMARY_ROLE]
+    kept: List[Dict[str, str]] = []
+    remaining = budget
+    for msg in reversed([msg for msg in history if msg.get("role") != SUMMARY_ROLE]):
+        content = msg.get("content") or ""
+        cost = estimate_tokens(content)
+        if cost > remaining:
+            # 放不下的消息截断到剩余预算（太少则丢弃），更早的消息不再保留。
+            if not kept or remaining >= MIN_TRUNCATED_TOKENS:
+                kept.append({"role": msg.get("role", ""), "content": _truncate_to_tokens(content, remaining)})
+            remaining = 0
+            break
+        kept.append(msg)
+        remaining -= cost
+    kept.reverse()
+    if summary and remaining > 0:
+        kept.insert(0, {"role": SUMMARY_ROLE, "content": _truncate_to_tokens(summary[-1]["content"], remaining)})
+    return kept
+
+
+def parse_json_object(text: str) -> Dict[str, Any]:
+    """解析模型输出中的 JSON 对象，兼容前后夹带说明文字。"""
+    try:
+        data = json.loads(text)
+    except Exception:
+        match = re.search(r"\{.*\}", text or "", re.S)
+        if not match:
+            return {}
+        try:
+            data = json.loads(match.group(0))
+        except Exception:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
 def is_exit_command(text: str) -> bool:
     """判断是否为退出指令。"""
     return text.strip().lower() in EXIT_COMMANDS
@@ -0,0 +1,106 @@
+﻿import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, List, Optional, Tuple
+
+from helpers import SUMMARY_ROLE
+from resilience import traffic_class
+from tools import call_llm
+from tracing import traced
+
+HISTORY_VERBATIM_MESSAGES = int(os.environ.get("HISTORY_VERBATIM_MESSAGES", "12"))
+HISTORY_SUMMARY_ENABLED = os.environ.get("HISTORY_SUMMARY", "on") != "off"
+SUMMARY_WORKERS = int(os.environ.get("HISTORY_SUMMARY_WORKERS", "2"))
+SUMMARY_MAX_CHARS = 300
+
+ROLLING_SUMMARY_PROMPT = (
+    "你是对话摘要器。请把“已有摘要”与“新增对话”合并成一段新的摘要，"
+    f"保留用户的需求、已确认的条件、查询过的资源与给出的结论，不超过 {SUMMARY_MAX_CHARS} 字。"
+    "只输出摘要本身。"
+)
+
+History = List[Dict[str, str]]
+
+
+def _format_messages(messages: History) -> str:
+    names = {"user": "用户", "assistant": "助手"}
+    return "\n".join(f"{names.get(msg.get('role', ''), msg.get('role', ''))}：{msg.get('content', '')}" for msg in messages)
+
+
+@traced("rolling_summary")
+def summarize_history(summary: str, messages: History) -> str:
+    """把滑出窗口的旧消息并入已有摘要。"""
+    user_prompt = f"已有摘要：{summary or '（无）'}\n\n新增对话：\n{_format_messages(messages)}"
+    # 后台任务，配额紧张时让位于交互式回合。
+    with traffic_class("background"):
+        return call_llm(ROLLING_SUMMARY_PROMPT, user_prompt, stage="summary").strip()[: SUMMARY_MAX_CHARS * 2]
+
+
+class RollingSummarizer:
+    """在后台线程中增量更新各会话的摘要；每个会话同一时间最多一个任务，结果在下一轮取回。"""
+
+    def __init__(self, workers: int = SUMMARY_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="history-summary")
+        self._jobs: Dict[str, Tuple[Future, int]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id: str, summary: str, pending: History) -> None:
+        if not pending:
+            return
+        with self._lock:
+            if session_id in self._jobs:
+                return
+            messages = list(pending)
+            future = self._pool.submit(copy_context().run, summarize_history, summary, messages)
+            self._jobs[session_id] = (future, len(messages))
+
+    def collect(self, session_id: str) -> Optional[Tuple[str, int]]:
+        """返回已完成任务的 (新摘要, 已并入的待摘要消息数)；未完成或失败返回 None。"""
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job is None or not job[0].done():
+                return None
+            del self._jobs[session_id]
+        future, consumed = job
+        if future.exception() is not None or not future.result():
+            return None
+        return future.result(), consumed
+
+    def discard(self, session_id: str) -> None:
+        """丢弃会话进行中的任务结果（如用户重置了对话）。"""
+        with self._lock:
+            self._jobs.pop(session_id, None)
+
+
+summarizer = RollingSummarizer()
+
+
+def model_history(summary: str, pending: History, history: History) -> History:
+    """交给模型的历史：摘要 + 尚未并入摘要的旧消息 + 近期原文，具体保留多少由各调用的 token 预算决定。"""
+    messages: History = [{"role": SUMMARY_ROLE, "content": summary}] if summary else []
+    return messages + list(pending) + list(history)
+
+
+def roll_history(
+    session_id: str,
+    summary: str,
+    pending: History,
+    history: History,
+) -> Tuple[str, History, History]:
+    """取回后台摘要结果，把超出原文窗口的消息移入待摘要队列并提交后台任务。
+
+    返回 (summary, pending, history)。未开启摘要时只保留原文窗口。
+    """
+    if not HISTORY_SUMMARY_ENABLED:
+        return "", [], history[-HISTORY_VERBATIM_MESSAGES:]
+    result = summarizer.collect(session_id)
+    if result is not None:
+        summary, consumed = result
+        pending = pending[consumed:]
+    overflow = history[:-HISTORY_VERBATIM_MESSAGES] if len(history) > HISTORY_VERBATIM_MESSAGES else []
+    if overflow:
+        pending = list(pending) + overflow
+        history = history[len(overflow):]
+    summarizer.submit(session_id, summary, pending)
+    return summary, pending, history
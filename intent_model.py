@@ -0,0 +1,291 @@
+﻿import argparse
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from helpers import intent_signals
+
+INTENT_MODEL_ENABLED = os.environ.get("INTENT_MODEL", "off") != "off"
+INTENT_MODEL_PATH = os.environ.get(
+    "INTENT_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "intent_model.npz"),
+)
+INTENT_MODEL_THRESHOLD = float(os.environ.get("INTENT_MODEL_THRESHOLD", "0.9"))
+ROUTE_LOG_PATH = os.environ.get("ROUTE_LOG_PATH", "")
+
+FEATURE_DIM = 1 << 12
+NGRAM_RANGE = (1, 3)
+REQUIREMENTS_TOKEN = "\x00has_requirements"
+HEADS = ("flow", "agents")
+
+
+def _features(text: str, has_requirements: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """字符 n-gram 哈希特征，返回 (特征下标, L2 归一化后的取值)。"""
+    lowered = f"\x02{(text or '').strip().lower()}\x03"
+    grams = [
+        lowered[start:start + size]
+        for size in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1)
+        for start in range(len(lowered) - size + 1)
+    ]
+    if has_requirements:
+        grams.append(REQUIREMENTS_TOKEN)
+    indices, counts = np.unique(
+        np.fromiter((zlib.crc32(gram.encode("utf-8")) % FEATURE_DIM for gram in grams), dtype=np.int64, count=len(grams)),
+        return_counts=True,
+    )
+    values = counts.astype(np.float32)
+    return indices, values / np.linalg.norm(values)
+
+
+def _feature_matrix(samples: Sequence[Tuple[str, bool]]) -> np.ndarray:
+    matrix = np.zeros((len(samples), FEATURE_DIM), dtype=np.float32)
+    for row, (text, has_requirements) in enumerate(samples):
+        indices, values = _features(text, has_requirements)
+        matrix[row, indices] = values
+    return matrix
+
+
+class LinearIntentClassifier:
+    """多分类逻辑回归（softmax），输入为字符 n-gram 哈希特征。"""
+
+    def __init__(self, labels: Sequence[str], weights: np.ndarray, bias: np.ndarray):
+        self.labels = list(labels)
+        self.weights = weights
+        self.bias = bias
+
+    @classmethod
+    def fit(
+        cls,
+        samples: Sequence[Tuple[str, bool]],
+        labels: Sequence[str],
+        epochs: int = 1000,
+        learning_rate: float = 4.0,
+        l2: float = 1e-4,
+    ) -> "LinearIntentClassifier":
+        classes = sorted(set(labels))
+        features = _feature_matrix(samples)
+        targets = np.zeros((len(labels), len(classes)), dtype=np.float32)
+        targets[np.arange(len(labels)), [classes.index(label) for label in labels]] = 1.0
+        weights = np.zeros((FEATURE_DIM, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        for _ in range(epochs):
+            probs = _softmax(features @ weights + bias)
+            error = (probs - targets) / len(labels)
+            weights -= learning_rate * (features.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return cls(classes, weights, bias)
+
+    def predict(self, text: str, has_requirements: bool = False) -> Tuple[str, float]:
+        """返回 (标签, 概率)。"""
+        indices, values = _features(text, has_requirements)
+        probs = _softmax(values @ self.weights[indices] + self.bias)
+        best = int(probs.argmax())
+        return self.labels[best], float(probs[best])
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        return {
+            f"{prefix}_labels": np.array(self.labels),
+            f"{prefix}_weights": self.weights,
+            f"{prefix}_bias": self.bias,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Any, prefix: str) -> "LinearIntentClassifier":
+        return cls(
+            [str(label) for label in arrays[f"{prefix}_labels"]],
+            arrays[f"{prefix}_weights"],
+            arrays[f"{prefix}_bias"],
+        )
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return shifted / shifted.sum(axis=-1, keepdims=True)
+
+
+def save_models(models: Dict[str, LinearIntentClassifier], path: str) -> None:
+    arrays: Dict[str, np.ndarray] = {"feature_dim": np.array(FEATURE_DIM)}
+    for head, model in models.items():
+        arrays.update(model.to_arrays(head))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as handle:
+        np.savez_compressed(handle, **arrays)
+
+
+def load_models(path: str) -> Dict[str, LinearIntentClassifier]:
+    with np.load(path) as arrays:
+        if int(arrays["feature_dim"]) != FEATURE_DIM:
+            raise ValueError(f"{path} 的特征维度与当前代码不一致，请重新训练。")
+        return {
+            head: LinearIntentClassifier.from_arrays(arrays, head)
+            for head in HEADS
+            if f"{head}_labels" in arrays.files
+        }
+
+
+_models: Optional[Dict[str, LinearIntentClassifier]] = None
+_models_lock = threading.Lock()
+
+
+def _loaded_models() -> Dict[str, LinearIntentClassifier]:
+    global _models
+    if _models is None:
+        with _models_lock:
+            if _models is None:
+                try:
+                    _models = load_models(INTENT_MODEL_PATH)
+                except (OSError, ValueError, KeyError):
+                    _models = {}
+    return _models
+
+
+def predict(head: str, text: str, has_requirements: bool = False) -> Optional[Tuple[str, float]]:
+    """未开启或没有该模型时返回 None。"""
+    if not INTENT_MODEL_ENABLED:
+        return None
+    model = _loaded_models().get(head)
+    if model is None:
+        return None
+    return model.predict(text, has_requirements)
+
+
+def confident_label(head: str, text: str, has_requirements: bool = False) -> str:
+    """本地模型的置信度达到 INTENT_MODEL_THRESHOLD 时返回标签，否则返回空字符串，交给 LLM 决策。
+
+    模型只看当前这句话；承接或指代上文的问题（“刚才”“这几个”）需要结合历史，一律交给 LLM。
+    """
+    if not INTENT_MODEL_ENABLED:
+        return ""
+    signals = intent_signals(text)
+    if "carry_over" in signals or "reference" in signals:
+        return ""
+    result = predict(head, text, has_requirements)
+    if result is None or result[1] < INTENT_MODEL_THRESHOLD:
+        return ""
+    return result[0]
+
+
+_route_log_lock = threading.Lock()
+
+
+def record_route(head: str, question: str, label: str, has_requirements: bool = False) -> None:
+    """设置了 ROUTE_LOG_PATH 时，把 LLM 做出的路由决策追加到 JSONL，用作训练数据。"""
+    if not ROUTE_LOG_PATH or not label:
+        return
+    line = json.dumps(
+        {"head": head, "question": question, "has_requirements": has_requirements, "label": label},
+        ensure_ascii=False,
+    )
+    with _route_log_lock:
+        directory = os.path.dirname(ROUTE_LOG_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(ROUTE_LOG_PATH, "a", encoding="utf-8") as handle:
+            handle.write(line + "\n")
+
+
+def _read_samples(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
+    for path in paths:
+        with open(path, encoding="utf-8-sig") as handle:
+            rows.extend(json.loads(line) for line in handle if line.strip())
+    return [row for row in rows if row.get("head") in HEADS and row.get("label")]
+
+
+def _split(rows: List[Dict[str, Any]], holdout: float, seed: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    order = np.random.default_rng(seed).permutation(len(rows))
+    cut = int(len(rows) * (1 - holdout))
+    return [rows[index] for index in order[:cut]], [rows[index] for index in order[cut:]]
+
+
+def train(rows: List[Dict[str, Any]]) -> Dict[str, LinearIntentClassifier]:
+    models: Dict[str, LinearIntentClassifier] = {}
+    for head in HEADS:
+        head_rows = [row for row in rows if row["head"] == head]
+        if len({row["label"] for row in head_rows}) < 2:
+            continue
+        models[head] = LinearIntentClassifier.fit(
+            [(row["question"], bool(row.get("has_requirements"))) for row in head_rows],
+            [row["label"] for row in head_rows],
+        )
+    return models
+
+
+def evaluate(
+    models: Dict[str, LinearIntentClassifier],
+    rows: List[Dict[str, Any]],
+    threshold: float = INTENT_MODEL_THRESHOLD,
+) -> Dict[str, Dict[str, float]]:
+    """与 LLM 路由的一致率：overall 为全部样本，covered 为置信度过阈值、会跳过 LLM 的样本。"""
+    report: Dict[str, Dict[str, float]] = {}
+    for head, model in models.items():
+        head_rows = [row for row in rows if row["head"] == head]
+        if not head_rows:
+            continue
+        agree = covered = covered_agree = 0
+        started = time.perf_counter()
+        for row in head_rows:
+            label, prob = model.predict(row["question"], bool(row.get("has_requirements")))
+            agree += label == row["label"]
+            if prob >= threshold:
+                covered += 1
+                covered_agree += label == row["label"]
+        elapsed = time.perf_counter() - started
+        report[head] = {
+            "samples": len(head_rows),
+            "agreement": round(agree / len(head_rows), 3),
+            "coverage": round(covered / len(head_rows), 3),
+            "covered_agreement": round(covered_agree / covered, 3) if covered else 0.0,
+            "latency_us": round(elapsed / len(head_rows) * 1e6, 1),
+        }
+    return report
+
+
+def _print_report(report: Dict[str, Dict[str, float]], threshold: float) -> None:
+    print(f"threshold={threshold}")
+    print(f"{'head':<8}{'samples':>9}{'agree':>8}{'coverage':>10}{'covered_agree':>15}{'latency_us':>12}")
+    for head, item in report.items():
+        print(
+            f"{head:<8}{item['samples']:>9}{item['agreement']:>8}{item['coverage']:>10}"
+            f"{item['covered_agreement']:>15}{item['latency_us']:>12}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="本地意图分类器：从路由日志训练，并评估与 LLM 路由的一致率")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="训练并保存模型")
+    train_parser.add_argument("--data", nargs="+", default=[os.path.join("data", "route_samples.jsonl")])
+    train_parser.add_argument("--out", default=INTENT_MODEL_PATH)
+    train_parser.add_argument("--holdout", type=float, default=0.2, help="留出评估的比例；最终模型用全部数据训练")
+    train_parser.add_argument("--seed", type=int, default=0)
+    eval_parser = commands.add_parser("eval", help="在路由日志上评估已保存的模型")
+    eval_parser.add_argument("--data", nargs="+", required=True)
+    eval_parser.add_argument("--model", default=INTENT_MODEL_PATH)
+    for sub in (train_parser, eval_parser):
+        sub.add_argument("--threshold", type=float, default=INTENT_MODEL_THRESHOLD)
+    args = parser.parse_args()
+
+    rows = _read_samples(args.data)
+    if args.command == "train":
+        if args.holdout > 0:
+            fit_rows, held_out = _split(rows, args.holdout, args.seed)
+            print(f"holdout ({len(held_out)} samples):")
+            _print_report(evaluate(train(fit_rows), held_out, args.threshold), args.threshold)
+        models = train(rows)
+        save_models(models, args.out)
+        print(f"saved {', '.join(models)} -> {args.out}")
+        return 0
+    _print_report(evaluate(load_models(args.model), rows, args.threshold), args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
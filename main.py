@@ -1,13 +1,176 @@
 ﻿import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List
 
 from helpers import is_exit_command
-from workflow import build_app
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "16"))
 
 
 def _print_tip() -> None:
     print("已进入客服模式，可多轮对话。输入 exit/quit/退出 结束，输入 reset 重置导购状态。")
 
 
+def _build_app() -> Any:
+    from workflow import build_app
+
+    return build_app()
+
+
+def _start_app_build() -> "Future[Any]":
+    """在后台导入 workflow（LangGraph、各流程模块）并编译对话图，提示语不必等它完成。"""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="app-build")
+    future = executor.submit(_build_app)
+    executor.shutdown(wait=False)
+    return future
+
+
+def _answer(app, question: str, session_id: str) -> None:
+    """边生成边打印；没有增量输出的回复（如追问、OpenAPI 结果）在结束时整体打印。"""
+    from workflow import stream_reply
+
+    streamed = False
+    config = {"configurable": {"thread_id": session_id}}
+    for kind, text in stream_reply(app, question, config):
+        if kind == "token":
+            print(text, end="", flush=True)
+            streamed = True
+        elif streamed:
+            print()
+        elif text:
+            print(text)
+
+
+def _read_batch_turns(path: str) -> Dict[str, List[str]]:
+    """读取 JSONL 的 (session_id, question)，按会话分组并保留会话内的先后顺序。"""
+    sessions: Dict[str, List[str]] = {}
+    with open(path, encoding="utf-8-sig") as handle:
+        for number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            session_id, question = str(row.get("session_id") or ""), str(row.get("question") or "").strip()
+            if not session_id or not question:
+                raise ValueError(f"{path} 第 {number} 行缺少 session_id 或 question")
+            sessions.setdefault(session_id, []).append(question)
+    return sessions
+
+
+def _read_batch_progress(path: str) -> Dict[str, Any]:
+    """从已有输出中恢复 run_id 与各会话已成功完成的回合数。"""
+    run_id = ""
+    done: Dict[str, int] = {}
+    if not os.path.exists(path):
+        return {"run_id": run_id, "done": done}
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 进程中断时最后一行可能不完整。
+                continue
+            run_id = run_id or record.get("run_id", "")
+            if "error" not in record:
+                done[record["session_id"]] = max(done.get(record["session_id"], 0), int(record["turn"]))
+    return {"run_id": run_id, "done": done}
+
+
+async def run_batch(
+    app: Any,
+    input_path: str,
+    output_path: str,
+    concurrency: int = BATCH_CONCURRENCY,
+    resume: bool = False,
+) -> Dict[str, Any]:
+    """并发回放多个会话，同一会话的回合按顺序执行，每轮结果写一行 JSONL。
+
+    每次回放使用新的 run_id 作为会话 ID 前缀，不会接上历史会话的状态；resume 时沿用输出文件中的
+    run_id，并从每个会话第一个未成功的回合继续（依赖持久化的会话存储）。某轮失败后跳过该会话的剩余回合。
+    """
+    from workflow import ainvoke_reply
+
+    sessions = _read_batch_turns(input_path)
+    progress = _read_batch_progress(output_path) if resume else {"run_id": "", "done": {}}
+    run_id = progress["run_id"] or uuid.uuid4().hex[:12]
+    done: Dict[str, int] = progress["done"]
+    limit = asyncio.Semaphore(max(1, concurrency))
+    stats = {"turns": 0, "failed": 0, "skipped": sum(min(done.get(sid, 0), len(qs)) for sid, qs in sessions.items())}
+
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as output:
+        if resume and output.tell():
+            # 中断时最后一行可能没有换行，续写前补上，避免与新记录粘在一起。
+            with open(output_path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    output.write("\n")
+
+        async def _session(session_id: str, questions: List[str]) -> None:
+            config = {"configurable": {"thread_id": f"batch-{run_id}:{session_id}"}}
+            async with limit:
+                for index in range(done.get(session_id, 0), len(questions)):
+                    record: Dict[str, Any] = {
+                        "run_id": run_id,
+                        "session_id": session_id,
+                        "turn": index + 1,
+                        "question": questions[index],
+                    }
+                    started = time.perf_counter()
+                    try:
+                        record["reply"] = await ainvoke_reply(app, questions[index], config)
+                    except Exception as exc:
+                        record["error"] = f"{type(exc).__name__}: {exc}"
+                    record["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                    stats["turns"] += 1
+                    if "error" in record:
+                        stats["failed"] += 1
+                        return
+
+        started = time.perf_counter()
+        await asyncio.gather(*(_session(session_id, questions) for session_id, questions in sessions.items()))
+        elapsed = time.perf_counter() - started
+
+    from tools import close_http_session
+
+    await close_http_session()
+    return {
+        "run_id": run_id,
+        "sessions": len(sessions),
+        **stats,
+        "elapsed_s": round(elapsed, 2),
+        "turns_per_s": round(stats["turns"] / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def _batch_main(args: argparse.Namespace) -> int:
+    from resilience import UPSTREAM_TPM, set_quota, traffic_class
+
+    for name in ("llm", "rag", "openapi"):
+        rate = getattr(args, f"{name}_rate")
+        if rate is not None:
+            set_quota(name, rate, UPSTREAM_TPM.get(name, 0.0))
+    if args.stub:
+        from stubs import install_stub_backends
+
+        install_stub_backends(args.stub_latency, args.stub_latency, args.stub_latency)
+    from workflow import build_app
+
+    output_path = args.output or f"{os.path.splitext(args.batch)[0]}.replies.jsonl"
+    app = build_app(warm_up_regions=[])
+    # 与交互式流量共用配额时，批量回放的调用排在后面。
+    with traffic_class("batch"):
+        report = asyncio.run(run_batch(app, args.batch, output_path, args.concurrency, args.resume))
+    print(json.dumps({**report, "output": output_path}, ensure_ascii=False), file=sys.stderr)
+    return 1 if report["failed"] else 0
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="多智能体客服（资源查询 + 智能导购）")
     parser.add_argument("question", nargs="?", help="输入给系统的问题")
@@ -17,20 +180,27 @@ def main() -> int:
         default=None,
         help="会话 ID（用于区分不同用户的记忆）",
     )
+    batch = parser.add_argument_group("批量回放")
+    batch.add_argument("--batch", metavar="TURNS_JSONL", help="回放 JSONL 中的 {session_id, question}，不进入交互模式")
+    batch.add_argument("--output", help="结果 JSONL，默认与输入同名加 .replies.jsonl")
+    batch.add_argument("--resume", action="store_true", help="从已有输出续跑，跳过已成功的回合")
+    batch.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="同时回放的会话数")
+    batch.add_argument("--llm-rate", type=float, help="LLM 每秒调用上限（默认读 UPSTREAM_RATE_LLM）")
+    batch.add_argument("--rag-rate", type=float, help="RAG 每秒调用上限")
+    batch.add_argument("--openapi-rate", type=float, help="OpenAPI 每秒调用上限")
+    batch.add_argument("--stub", action="store_true", help="使用离线桩替代 DashScope/OpenAPI")
+    batch.add_argument("--stub-latency", default="0.2", help="桩的单次调用延迟（见 stubs.latency_sampler）")
     args = parser.parse_args()
 
-    app = build_app()
+    if args.batch:
+        return _batch_main(args)
+
+    app_future = _start_app_build()
     session_id = args.session_id or "cli"
     _print_tip()
 
     if args.question:
-        result = app.invoke(
-            {"question": args.question},
-            config={"configurable": {"thread_id": session_id}},
-        )
-        reply = result.get("reply", "")
-        if reply:
-            print(reply)
+        _answer(app_future.result(), args.question, session_id)
 
     while True:
         question = input("你：").strip()
@@ -39,13 +209,7 @@ def main() -> int:
         if is_exit_command(question):
             print("已结束本次对话。")
             break
-        result = app.invoke(
-            {"question": question},
-            config={"configurable": {"thread_id": session_id}},
-        )
-        reply = result.get("reply", "")
-        if reply:
-            print(reply)
+        _answer(app_future.result(), question, session_id)
     return 0
 
 
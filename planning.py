@@ -1,30 +1,80 @@
 ﻿import json
-import re
-from typing import Dict, List
+import os
+from typing import Dict, List, Optional, TypedDict
 
-from tools import call_llm
+from helpers import intent_signals, parse_json_object
+from intent_model import confident_label, record_route
+from resource_flow import RESOURCE_AGENT_NAMES, AgentStep, agent_label, local_agent_order, normalize_agent_steps
+from shopping_flow import EXTRACTION_FIELDS, SHOPPING_ROUTES, _extraction_base, normalize_extraction
+from tools import acall_llm_parsed, call_llm_parsed
+from tracing import current_span, traced
 
 FLOW_NAMES = {"ShoppingFlow", "ResourceFlow", "GeneralFlow"}
+TURN_PLANNER_MODE = os.environ.get("TURN_PLANNER_MODE", "combined")
 
 
+class TurnPlan(TypedDict, total=False):
+    """一轮对话的决策结果；缺失的字段由各流程自行决策。"""
+
+    flow: str
+    shopping_route: str
+    resource_agents: List[AgentStep]
+    requirements: Dict[str, str]
+
+
+ROUTE_SYSTEM_PROMPT = (
+    "你是客服任务路由器。根据对话历史、已收集需求和用户输入，判断下一步流程。\n"
+    "只允许输出以下之一：ShoppingFlow、ResourceFlow、GeneralFlow。\n"
+    "含义：ShoppingFlow=导购/选型/需求收集；"
+    "ResourceFlow=资源查询/余额/实例/规格详情；"
+    "GeneralFlow=其他常规问题。"
+)
+
+
+@traced("route_task")
 def route_task(question: str, history: List[Dict[str, str]], requirements: Dict[str, str]) -> str:
     """Top-level router for shopping vs resource queries."""
-    system_prompt = (
-        "你是客服任务路由器。根据对话历史、已收集需求和用户输入，判断下一步流程。\n"
-        "只允许输出以下之一：ShoppingFlow、ResourceFlow、GeneralFlow。\n"
-        "含义：ShoppingFlow=导购/选型/需求收集；"
-        "ResourceFlow=资源查询/余额/实例/规格详情；"
-        "GeneralFlow=其他常规问题。"
-    )
+    has_requirements = any(value for value in requirements.values())
+    local = confident_label("flow", question, has_requirements)
+    if local in FLOW_NAMES:
+        current_span().set(router="local")
+        return local
     payload = {"requirements": requirements, "question": question}
     try:
-        route_text = call_llm(
-            system_prompt,
+        route = call_llm_parsed(
+            ROUTE_SYSTEM_PROMPT,
             json.dumps(payload, ensure_ascii=False),
+            _normalize_flow,
             history=history,
+            stage="router",
         )
-        route = _normalize_flow(route_text)
-        if route in FLOW_NAMES:
+        if route:
+            record_route("flow", question, route, has_requirements)
+            return route
+    except Exception:
+        pass
+    return heuristic_flow(question, requirements)
+
+
+@traced("route_task")
+async def aroute_task(question: str, history: List[Dict[str, str]], requirements: Dict[str, str]) -> str:
+    """Async variant of route_task."""
+    has_requirements = any(value for value in requirements.values())
+    local = confident_label("flow", question, has_requirements)
+    if local in FLOW_NAMES:
+        current_span().set(router="local")
+        return local
+    payload = {"requirements": requirements, "question": question}
+    try:
+        route = await acall_llm_parsed(
+            ROUTE_SYSTEM_PROMPT,
+            json.dumps(payload, ensure_ascii=False),
+            _normalize_flow,
+            history=history,
+            stage="router",
+        )
+        if route:
+            record_route("flow", question, route, has_requirements)
             return route
     except Exception:
         pass
@@ -32,26 +82,129 @@ def route_task(question: str, history: List[Dict[str, str]], requirements: Dict[
 
 
 def _normalize_flow(text: str) -> str:
-    lowered = (text or "").strip().lower()
-    if "shopping" in lowered or "导购" in lowered or "选型" in lowered or "推荐" in lowered:
+    signals = intent_signals(text)
+    if "label_shopping" in signals:
         return "ShoppingFlow"
-    if "resource" in lowered or "资源" in lowered or "余额" in lowered or "实例" in lowered or "规格" in lowered:
+    if "label_resource" in signals:
         return "ResourceFlow"
-    if "general" in lowered or "其他" in lowered or "通用" in lowered:
+    if "label_general" in signals:
         return "GeneralFlow"
     return ""
 
 
 def heuristic_flow(question: str, requirements: Dict[str, str]) -> str:
-    lowered = question.lower()
+    signals = intent_signals(question)
     has_requirements = any(value for value in requirements.values())
-    mentions_spec = "ecs." in lowered or "规格" in question or "参数" in question or "详情" in question
-    mentions_resource = "余额" in question or "实例" in question or "账户" in question or "账单" in question
-    mentions_buy = "推荐" in question or "购买" in question or "选型" in question or "导购" in question
-    if mentions_resource or mentions_spec:
+    if "balance" in signals or "instance" in signals or "spec" in signals:
         return "ResourceFlow"
-    if has_requirements or mentions_buy:
+    if has_requirements or "buy" in signals:
         return "ShoppingFlow"
-    if re.search(r"\becs\b", lowered):
+    if "ecs_word" in signals:
         return "ResourceFlow"
     return "GeneralFlow"
+
+
+TURN_PLAN_SYSTEM_PROMPT = (
+    "你是客服回合规划器，需要一次性给出本轮的全部决策，并输出 JSON。\n"
+    "字段说明：\n"
+    "- flow：ShoppingFlow、ResourceFlow、GeneralFlow 之一。"
+    "ShoppingFlow=导购/选型/需求收集；ResourceFlow=资源查询/余额/实例/规格详情；GeneralFlow=其他常规问题。\n"
+    "- shopping_route：flow 为 ShoppingFlow 时，判断是否进入 ECS 导购，取值 ECSGuideAssistant 或 Other。\n"
+    "- resource_agents：flow 为 ResourceFlow 时，列出要调用的 assistant，"
+    f"元素必须是以下之一：{'、'.join(RESOURCE_AGENT_NAMES)}。相互独立的 assistant 会并行执行；"
+    "若需要使用前面 assistant 的结果，写成 {\"agent\": 名称, \"depends_on\": [名称]}。\n"
+    f"- requirements：从用户输入中抽取导购信息，必须包含字段：{', '.join(EXTRACTION_FIELDS)}；"
+    "未提到的字段输出空字符串，不要编造。\n"
+    "只输出 JSON 对象本身，不要输出其他文字。"
+)
+
+
+def _parse_turn_plan(text: str) -> Optional[TurnPlan]:
+    data = parse_json_object(text)
+    if data.get("flow") not in FLOW_NAMES:
+        return None
+    plan: TurnPlan = {"flow": data["flow"]}
+    if data.get("shopping_route") in SHOPPING_ROUTES:
+        plan["shopping_route"] = data["shopping_route"]
+    agents = data.get("resource_agents")
+    if isinstance(agents, list):
+        steps = normalize_agent_steps(agents)
+        if steps:
+            plan["resource_agents"] = steps
+    extracted = data.get("requirements")
+    if isinstance(extracted, dict):
+        plan["requirements"] = normalize_extraction(extracted)
+    return plan
+
+
+def _local_turn_plan(question: str, requirements: Dict[str, str]) -> Optional[TurnPlan]:
+    """本地意图分类器足够确定、且本轮不需要抽取导购需求时，直接给出回合决策，跳过规划器的 LLM 调用。
+
+    导购流程还需要规划器顺带完成的需求抽取，仍交给 LLM。
+    """
+    flow = confident_label("flow", question, any(value for value in requirements.values()))
+    if flow == "GeneralFlow":
+        current_span().set(router="local")
+        return {"flow": flow}
+    if flow == "ResourceFlow":
+        agents = local_agent_order(question)
+        if agents:
+            current_span().set(router="local")
+            return {"flow": flow, "resource_agents": agents}
+    return None
+
+
+def _record_turn_plan(question: str, requirements: Dict[str, str], plan: TurnPlan) -> None:
+    record_route("flow", question, plan["flow"], any(value for value in requirements.values()))
+    if plan["flow"] == "ResourceFlow" and plan.get("resource_agents"):
+        record_route("agents", question, agent_label(plan["resource_agents"]))
+
+
+@traced("plan_turn")
+def plan_turn(question: str, history: List[Dict[str, str]], requirements: Dict[str, str]) -> TurnPlan:
+    """用一次 LLM 调用完成本轮全部路由决策，解析失败时退回 route_task。"""
+    if TURN_PLANNER_MODE == "combined":
+        local = _local_turn_plan(question, requirements)
+        if local:
+            return local
+        # 与 guide_assistant 相同的抽取基线：需求已齐且不是沿用时，本轮抽取从空白开始。
+        payload = {"requirements": _extraction_base(question, requirements), "question": question}
+        try:
+            plan = call_llm_parsed(
+                TURN_PLAN_SYSTEM_PROMPT,
+                json.dumps(payload, ensure_ascii=False),
+                _parse_turn_plan,
+                history=history,
+                stage="plan",
+            )
+            if plan:
+                _record_turn_plan(question, requirements, plan)
+                return plan
+        except Exception:
+            pass
+    return {"flow": route_task(question, history, requirements)}
+
+
+@traced("plan_turn")
+async def aplan_turn(question: str, history: List[Dict[str, str]], requirements: Dict[str, str]) -> TurnPlan:
+    """Async variant of plan_turn."""
+    if TURN_PLANNER_MODE == "combined":
+        local = _local_turn_plan(question, requirements)
+        if local:
+            return local
+        # 与 guide_assistant 相同的抽取基线：需求已齐且不是沿用时，本轮抽取从空白开始。
+        payload = {"requirements": _extraction_base(question, requirements), "question": question}
+        try:
+            plan = await acall_llm_parsed(
+                TURN_PLAN_SYSTEM_PROMPT,
+                json.dumps(payload, ensure_ascii=False),
+                _parse_turn_plan,
+                history=history,
+                stage="plan",
+            )
+            if plan:
+                _record_turn_plan(question, requirements, plan)
+                return plan
+        except Exception:
+            pass
+    return {"flow": await aroute_task(question, history, requirements)}
@@ -0,0 +1,254 @@
+﻿import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from catalog import ARCH_ALIASES
+from helpers import KeywordMatcher, intent_signals, region_from_signals
+
+RULE_FIELDS = ("场景", "vCPU", "内存", "预算", "地域", "架构")
+RULE_CONFIDENCE_THRESHOLD = 0.8
+
+# 场景关键词 -> 统一的场景名称。
+SCENE_LABELS = {
+    "web": "Web",
+    "网站": "Web",
+    "官网": "Web",
+    "博客": "Web",
+    "小程序": "Web",
+    "api": "Web",
+    "数据库": "数据库",
+    "mysql": "数据库",
+    "redis": "缓存",
+    "缓存": "缓存",
+    "大数据": "大数据",
+    "数据分析": "大数据",
+    "推理": "AI 推理",
+    "ai": "AI 推理",
+    "模型": "AI 推理",
+    "游戏": "游戏",
+    "视频": "视频处理",
+    "转码": "视频处理",
+    "开发测试": "开发测试",
+    "测试": "开发测试",
+    "通用计算": "通用计算",
+    "计算": "通用计算",
+}
+# 出现这些词但没有识别出取值时，说明用户提到了该字段，需要交给 LLM。
+FIELD_MENTIONS = {
+    "场景": ("场景", "用途", "用于", "用来", "业务"),
+    "vCPU": ("核", "cpu", "vcpu"),
+    "内存": ("内存", "memory", "gb", "gib"),
+    "预算": ("预算", "元", "块", "钱", "价格", "费用", "¥", "rmb"),
+    "地域": ("地域", "区域", "地区", "机房", "region"),
+    "架构": ("架构", "arm", "x86", "倚天", "intel", "amd"),
+}
+
+_RANGE = r"(\d+(?:\.\d+)?)\s*(?:-|~|～|到|至)\s*(\d+(?:\.\d+)?)"
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_LOWER_PREFIXES = ("至少", "不少于", "不低于")
+_LOWER_SUFFIXES = ("以上", "起")
+_UPPER_PREFIXES = ("最多", "不超过", "不高于")
+_UPPER_SUFFIXES = ("以内", "以下", "之内")
+
+_CPU_MEMORY_SHORT = re.compile(r"(\d+)\s*c\s*(\d+)\s*g", re.I)
+_CPU_RANGE = re.compile(_RANGE + r"\s*(?:核|个?vcpu|个?cpu)", re.I)
+_CPU_SINGLE = re.compile(_NUMBER + r"\s*(?:核|个?vcpu|个?cpu)", re.I)
+_MEMORY = re.compile(r"(?:" + _RANGE + r"|" + _NUMBER + r")\s*(?:g|gb|gib)(?![a-z])", re.I)
+# 内存容量与硬盘、带宽等都用 G 作单位，数字归属于离它最近的关键词（前后各看 _ATTACH_WINDOW 个字符，不跨标点）。
+_MEMORY_WORDS = ("内存", "ram", "memory")
+_NON_MEMORY_WORDS = ("硬盘", "磁盘", "云盘", "系统盘", "数据盘", "存储", "ssd", "带宽", "流量", "显存")
+_ATTACH_WINDOW = 6
+_CLAUSE_BREAK = re.compile(r"[,，;；、。/|]")
+# 金额可以带“万/千/k”倍数；其他倍数（百、亿、w 等）不换算，只降低置信度交给 LLM。
+_AMOUNT = r"(\d+(?:\.\d+)?)\s*(万|千|k(?![a-z]))?"
+_MULTIPLIERS = {"万": 10000, "千": 1000, "k": 1000}
+_UNHANDLED_MULTIPLIER = re.compile(r"\s*(?:百|十|亿|w(?![a-z]))")
+_AMOUNT_RANGE = _AMOUNT + r"\s*(?:-|~|～|到|至)\s*" + _AMOUNT
+_BUDGET_RANGE = re.compile(_AMOUNT_RANGE + r"\s*(?:元|块|rmb)", re.I)
+_BUDGET_SINGLE = re.compile(r"(?:¥|￥)\s*" + _AMOUNT + r"|" + _AMOUNT + r"\s*(?:元|块|rmb)", re.I)
+_BUDGET_BARE = re.compile(r"预算[^\d]{0,6}" + r"(?:" + _AMOUNT_RANGE + r"|" + _AMOUNT + r")")
+_BARE_VALUE = re.compile(r"^\s*(?:" + _RANGE + r"|" + _NUMBER + r")\s*$")
+_REGION_ID = re.compile(r"\b((?:cn|ap|us|eu|me)-[a-z]+(?:-\d+)?)\b")
+
+
+class RuleExtraction(NamedTuple):
+    """规则抽取结果：values 为识别出的字段，confidence 为各字段置信度，unresolved 为提到但未能识别的字段。"""
+
+    values: Dict[str, str]
+    confidence: Dict[str, float]
+    unresolved: List[str]
+
+    def confident(self, threshold: float = RULE_CONFIDENCE_THRESHOLD) -> Dict[str, str]:
+        return {field: value for field, value in self.values.items() if self.confidence.get(field, 0.0) >= threshold}
+
+    @property
+    def score(self) -> float:
+        """整体置信度：有未识别字段时为 0，否则取各字段置信度的最小值（没有识别出字段时为 1）。"""
+        if self.unresolved:
+            return 0.0
+        return min(self.confidence.values(), default=1.0)
+
+
+def _format_number(value: str) -> str:
+    number = float(value)
+    return f"{number:.12g}"
+
+
+def _bound_prefix(text: str, start: int, end: int) -> str:
+    """根据数字前后的“至少/以内”等修饰词，返回取值前缀。"""
+    before, after = text[max(0, start - 4):start], text[end:end + 4].lstrip()
+    if any(hint in before for hint in _LOWER_PREFIXES) or any(after.startswith(hint) for hint in _LOWER_SUFFIXES):
+        return "至少"
+    if any(hint in before for hint in _UPPER_PREFIXES) or any(after.startswith(hint) for hint in _UPPER_SUFFIXES):
+        return "最多"
+    return ""
+
+
+def _match_value(pattern: "re.Pattern[str]", text: str) -> Optional[Tuple[str, int]]:
+    match = pattern.search(text)
+    if not match:
+        return None
+    numbers = [group for group in match.groups() if group]
+    if len(numbers) >= 2:
+        return f"{_format_number(numbers[0])}-{_format_number(numbers[1])}", match.end()
+    return f"{_bound_prefix(text, match.start(), match.end())}{_format_number(numbers[0])}", match.end()
+
+
+def _match_budget(pattern: "re.Pattern[str]", text: str) -> Optional[Tuple[str, bool]]:
+    """返回 (金额或区间, 是否可信)；数字后跟着没有换算的倍数时不可信。"""
+    match = pattern.search(text)
+    if not match:
+        return None
+    groups = match.groups()
+    amounts = [(groups[index], groups[index + 1]) for index in range(0, len(groups), 2) if groups[index]]
+    scales = [_MULTIPLIERS.get((unit or "").lower(), 1) for _, unit in amounts]
+    if len(amounts) >= 2 and scales[0] == 1 and float(amounts[0][0]) < float(amounts[1][0]):
+        # “1-2万”：倍数只写在后一个数字上时两端共用。
+        scales[0] = scales[1]
+    numbers = [_format_number(str(float(number) * scale)) for (number, _), scale in zip(amounts, scales)]
+    trusted = not _UNHANDLED_MULTIPLIER.match(text, match.end())
+    if len(numbers) >= 2:
+        return f"{numbers[0]}-{numbers[1]}", trusted
+    return f"{_bound_prefix(text, match.start(), match.end())}{numbers[0]}", trusted
+
+
+def _keyword_distance(text: str, words: Tuple[str, ...], start: int, end: int) -> int:
+    """[start, end) 与最近一个关键词之间隔着的字符数，窗口内没有时返回 -1。"""
+    distances = []
+    for word in words:
+        before = text.rfind(word, max(0, start - _ATTACH_WINDOW - len(word)), start)
+        if before >= 0 and not _CLAUSE_BREAK.search(text, before + len(word), start):
+            distances.append(start - before - len(word))
+        after = text.find(word, end, end + _ATTACH_WINDOW + len(word))
+        if after >= 0 and not _CLAUSE_BREAK.search(text, end, after):
+            distances.append(after - end)
+    return min(distances) if distances else -1
+
+
+def _extract_memory(text: str) -> Optional[Tuple[str, float]]:
+    """取离“内存”关键词最近、且不属于硬盘/带宽等的容量；没有关键词时只在唯一一个无归属的容量上采用。"""
+    memory: List[Tuple[int, "re.Match[str]"]] = []
+    unattached: List["re.Match[str]"] = []
+    for match in _MEMORY.finditer(text):
+        to_memory = _keyword_distance(text, _MEMORY_WORDS, match.start(), match.end())
+        to_other = _keyword_distance(text, _NON_MEMORY_WORDS, match.start(), match.end())
+        if to_memory >= 0 and (to_other < 0 or to_memory < to_other):
+            memory.append((to_memory, match))
+        elif to_other < 0:
+            unattached.append(match)
+    if memory:
+        match, confidence = min(memory, key=lambda item: item[0])[1], 0.9
+    elif len(unattached) == 1 and not any(word in text for word in _MEMORY_WORDS):
+        match, confidence = unattached[0], 0.85
+    else:
+        return None
+    numbers = [group for group in match.groups() if group]
+    if len(numbers) >= 2:
+        return f"{_format_number(numbers[0])}-{_format_number(numbers[1])}GB", confidence
+    return f"{_bound_prefix(text, match.start(), match.end())}{_format_number(numbers[0])}GB", confidence
+
+
+def _keyword_tables() -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    keywords: Dict[str, List[str]] = {}
+    ascii_words: Dict[str, List[str]] = {}
+    for keyword, label in SCENE_LABELS.items():
+        # 英文关键词前后不能紧跟英文字母数字，避免 "ai" 命中 "email"；紧挨中文（“用于web服务”）仍算命中。
+        table = ascii_words if keyword.isascii() else keywords
+        table.setdefault(f"scene:{label}", []).append(keyword)
+    for alias, arch in ARCH_ALIASES.items():
+        keywords.setdefault(f"arch:{arch}", []).append(alias)
+    for field, hints in FIELD_MENTIONS.items():
+        keywords[f"mention:{field}"] = list(hints)
+    return keywords, ascii_words
+
+
+_scene_keywords, _scene_ascii_words = _keyword_tables()
+_rule_matcher = KeywordMatcher(_scene_keywords, ascii_words=_scene_ascii_words)
+
+
+def _first(signals: Dict[str, int], prefix: str) -> Optional[str]:
+    """取最先出现的、以 prefix 开头的信号值。"""
+    hits = [(start, signal) for signal, start in signals.items() if signal.startswith(prefix)]
+    return min(hits)[1][len(prefix):] if hits else None
+
+
+def _extract_region(lowered: str) -> Optional[str]:
+    match = _REGION_ID.search(lowered)
+    if match:
+        return match.group(1)
+    return region_from_signals(intent_signals(lowered)) or None
+
+
+def extract_by_rules(question: str, expected_field: str = "") -> RuleExtraction:
+    """用正则与关键词表抽取导购字段。
+
+    expected_field 为上一轮追问的字段；用户只回答一个数字或区间（如“2-4”）时归到该字段。
+    """
+    text = question or ""
+    lowered = text.lower()
+    values: Dict[str, str] = {}
+    confidence: Dict[str, float] = {}
+
+    signals = _rule_matcher.scan(lowered)
+    scene = _first(signals, "scene:")
+    if scene:
+        values["场景"], confidence["场景"] = scene, 0.9
+
+    short = _CPU_MEMORY_SHORT.search(lowered)
+    if short:
+        values["vCPU"], confidence["vCPU"] = short.group(1), 0.95
+        values["内存"], confidence["内存"] = f"{short.group(2)}GB", 0.95
+    else:
+        cpu = _match_value(_CPU_RANGE, lowered) or _match_value(_CPU_SINGLE, lowered)
+        if cpu:
+            values["vCPU"], confidence["vCPU"] = cpu[0], 0.95
+        memory = _extract_memory(lowered)
+        if memory:
+            values["内存"], confidence["内存"] = memory
+
+    budget = _match_budget(_BUDGET_RANGE, lowered) or _match_budget(_BUDGET_SINGLE, lowered)
+    budget_confidence = 0.95
+    if not budget:
+        budget = _match_budget(_BUDGET_BARE, lowered)
+        budget_confidence = 0.85
+    if budget:
+        period = "每年" if "年" in text else "每月"
+        values["预算"] = f"{period}{budget[0]}元"
+        confidence["预算"] = budget_confidence if budget[1] else 0.5
+
+    region = _extract_region(lowered)
+    if region:
+        values["地域"], confidence["地域"] = region, 0.95
+
+    arch = _first(signals, "arch:")
+    if arch:
+        values["架构"], confidence["架构"] = arch, 0.95
+
+    bare = _BARE_VALUE.match(lowered)
+    if bare and expected_field in ("vCPU", "内存", "预算") and expected_field not in values:
+        numbers = [group for group in bare.groups() if group]
+        value = "-".join(_format_number(number) for number in numbers)
+        values[expected_field] = {"vCPU": value, "内存": f"{value}GB", "预算": f"每月{value}元"}[expected_field]
+        confidence[expected_field] = 0.85
+
+    unresolved = [field for field in FIELD_MENTIONS if field not in values and f"mention:{field}" in signals]
+    return RuleExtraction(values, confidence, unresolved)
@@ -0,0 +1,657 @@
+﻿import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Set, TypeVar
+
+from tracing import LatencyHistogram, current_span
+
+T = TypeVar("T")
+
+UPSTREAM_TIMEOUTS = {
+    "llm": float(os.environ.get("UPSTREAM_TIMEOUT_LLM", "60")),
+    "rag": float(os.environ.get("UPSTREAM_TIMEOUT_RAG", "90")),
+    "openapi": float(os.environ.get("UPSTREAM_TIMEOUT_OPENAPI", "15")),
+}
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY", "2"))
+# 开启对冲请求的上游，逗号分隔，如 "rag,openapi"；对冲会增加上游调用量，默认关闭。
+UPSTREAM_HEDGE = {name.strip() for name in os.environ.get("UPSTREAM_HEDGE", "").split(",") if name.strip()}
+HEDGE_QUANTILE = float(os.environ.get("UPSTREAM_HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("UPSTREAM_BREAKER_RESET_SECONDS", "30"))
+UPSTREAM_WORKERS = int(os.environ.get("UPSTREAM_WORKERS", "64"))
+# 客户端配额（0 表示不限）：每秒请求数 UPSTREAM_RATE_<NAME>，每分钟 token 数 UPSTREAM_TPM_<NAME>。
+UPSTREAM_RATES = {
+    name: float(os.environ.get(f"UPSTREAM_RATE_{name.upper()}", "0"))
+    for name in ("llm", "rag", "openapi")
+}
+UPSTREAM_TPM = {name: float(os.environ.get(f"UPSTREAM_TPM_{name.upper()}", "0")) for name in ("llm", "rag")}
+TOKEN_BURST_SECONDS = 10
+QUEUE_POLL_SECONDS = 0.5
+
+# 优先级 = 流量类别 * 10 + 阶段：交互式回合先于批量回放与后台任务，同一类别内面向用户的回答先于路由。
+TRAFFIC_CLASSES = ("interactive", "batch", "background")
+STAGE_PRIORITY = {"answer": 0, "summary": 0, "extract": 1, "plan": 1, "router": 2}
+_traffic_class: ContextVar[str] = ContextVar("traffic_class", default="interactive")
+# 同步流式调用在后台线程中执行；超时后置位，线程里的流不再向 sink 输出。
+_stream_abandoned: ContextVar[Optional[threading.Event]] = ContextVar("stream_abandoned", default=None)
+
+# 错误码或消息中出现这些片段时视为瞬时故障，可以重试并计入熔断。
+RETRYABLE_MARKERS = (
+    "throttling",
+    "ratequota",
+    "serviceunavailable",
+    "internalerror",
+    "requesttimeout",
+    "timeout",
+    "toomanyrequests",
+)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class UpstreamError(RuntimeError):
+    """上游返回的错误；code/status 用于判断是否可重试。"""
+
+    def __init__(self, message: str, code: str = "", status: int = 0):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+
+class UpstreamTimeout(UpstreamError):
+    def __init__(self, upstream: str, seconds: float):
+        super().__init__(f"{upstream} 调用超时（{seconds:g} 秒）", "Timeout", 504)
+
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, upstream: str):
+        super().__init__(f"{upstream} 暂不可用（熔断中）", "CircuitOpen", 503)
+
+
+@contextmanager
+def traffic_class(name: str) -> Iterator[None]:
+    """标记当前上下文发起的上游调用所属的流量类别（interactive/batch/background）。"""
+    token = _traffic_class.set(name)
+    try:
+        yield
+    finally:
+        _traffic_class.reset(token)
+
+
+def check_stream() -> None:
+    """同步流式调用把每个分片交给 sink 之前调用：本次尝试已超时被放弃时抛出，避免与重试的输出混在一起。"""
+    abandoned = _stream_abandoned.get()
+    if abandoned is not None and abandoned.is_set():
+        raise UpstreamError("流式输出已超时", "Timeout", 504)
+
+
+def call_priority(stage: str) -> int:
+    traffic = _traffic_class.get()
+    rank = TRAFFIC_CLASSES.index(traffic) if traffic in TRAFFIC_CLASSES else 0
+    return rank * 10 + STAGE_PRIORITY.get(stage, 1)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    # 不为判断异常类型而导入 aiohttp：没导入过就不可能抛出它的异常。
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None and isinstance(exc, aiohttp.ClientError):
+        return True
+    status = getattr(exc, "status", None) or getattr(exc, "status_code", None) or getattr(exc, "statusCode", None)
+    if isinstance(status, int) and status in RETRYABLE_STATUS:
+        return True
+    text = f"{getattr(exc, 'code', '') or ''} {exc}".lower()
+    return any(marker in text for marker in RETRYABLE_MARKERS)
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断 reset_seconds 秒，之后放行一个探测请求，成功则恢复。"""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failures
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> str:
+        """放行时返回 "closed"，或 "probe" 表示本次是半开状态下唯一的探测请求；熔断中返回空串。"""
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._probing:
+                return ""
+            self._probing = True
+            return "probe"
+
+    def release_probe(self) -> None:
+        """探测请求没有得出结论（如被取消）时交还探测名额，下一次调用可以重新探测。"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self.failure_threshold > 0 and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class QuotaLimiter:
+    """上游配额的客户端限流：请求数（每秒）与 token 数（每分钟）两个令牌桶，0 表示该项不限。
+
+    额度不足时调用方按优先级排队（数值越小越先放行，同优先级先到先得），只有队首等待额度恢复；
+    token 在每次尝试（含对冲）放行时按估计值预扣，由 refund_tokens 按实际用量多退少补；拿不到实际用量时保留估计值。
+    """
+
+    def __init__(self, requests_per_second: float = 0.0, tokens_per_minute: float = 0.0, burst: Optional[int] = None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self._request_capacity = float(max(1, burst or int(requests_per_second)))
+        self._token_rate = tokens_per_minute / 60
+        self._token_capacity = self._token_rate * TOKEN_BURST_SECONDS
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue: List[List[Any]] = []
+        self._sequence = itertools.count()
+        self._waits: Dict[str, LatencyHistogram] = {}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        if self.requests_per_second > 0:
+            self._requests = min(self._request_capacity, self._requests + elapsed * self.requests_per_second)
+        if self._token_rate > 0:
+            self._tokens = min(self._token_capacity, self._tokens + elapsed * self._token_rate)
+
+    def _shortfall(self, tokens: int) -> float:
+        """额度足够放行一次调用还需等待的秒数。"""
+        wait_seconds = 0.0
+        if self.requests_per_second > 0 and self._requests < 1:
+            wait_seconds = (1 - self._requests) / self.requests_per_second
+        if self._token_rate > 0:
+            # 单次估计超过桶容量时按容量计，否则永远等不到。
+            needed = min(float(tokens), self._token_capacity)
+            if self._tokens < needed:
+                wait_seconds = max(wait_seconds, (needed - self._tokens) / self._token_rate)
+        return wait_seconds
+
+    def _enqueue(self, priority: int, wake: Callable[[], None]) -> List[Any]:
+        entry = [priority, next(self._sequence), wake]
+        with self._lock:
+            heapq.heappush(self._queue, entry)
+        return entry
+
+    def _try_take(self, entry: List[Any], tokens: int) -> Optional[float]:
+        """entry 在队首且额度足够时扣减额度、出队并返回 0；在队首但额度不足时返回需等待的秒数；不在队首返回 None。"""
+        with self._lock:
+            if self._queue[0] is not entry:
+                return None
+            self._refill()
+            wait_seconds = self._shortfall(tokens)
+            if wait_seconds > 0:
+                return wait_seconds
+            self._take(tokens)
+            heapq.heappop(self._queue)
+            if self._queue:
+                self._queue[0][2]()
+            return 0.0
+
+    def _take(self, tokens: int) -> None:
+        if self.requests_per_second > 0:
+            self._requests -= 1
+        if self._token_rate > 0:
+            self._tokens -= tokens
+
+    def try_acquire(self, tokens: int = 0) -> bool:
+        """不排队：没有调用在等待且额度足够时立即扣减并返回 True，用于对冲这类可有可无的请求。"""
+        with self._lock:
+            if self._queue:
+                return False
+            self._refill()
+            if self._shortfall(tokens) > 0:
+                return False
+            self._take(tokens)
+            return True
+
+    def _discard(self, entry: List[Any]) -> None:
+        """等待中被取消或出错时移出队列，并唤醒新的队首。"""
+        with self._lock:
+            if entry not in self._queue:
+                return
+            was_head = self._queue[0] is entry
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            if was_head and self._queue:
+                self._queue[0][2]()
+
+    def _observe(self, started: float) -> float:
+        waited = time.monotonic() - started
+        traffic = _traffic_class.get()
+        with self._lock:
+            histogram = self._waits.setdefault(traffic, LatencyHistogram())
+            histogram.observe(waited * 1000, True)
+        return waited
+
+    def acquire(self, priority: int = 0, tokens: int = 0) -> float:
+        """阻塞到放行为止，返回排队等待的秒数。"""
+        started = time.monotonic()
+        event = threading.Event()
+        entry = self._enqueue(priority, event.set)
+        try:
+            while True:
+                wait_seconds = self._try_take(entry, tokens)
+                if wait_seconds == 0.0:
+                    return self._observe(started)
+                event.wait(QUEUE_POLL_SECONDS if wait_seconds is None else min(wait_seconds, QUEUE_POLL_SECONDS))
+                event.clear()
+        finally:
+            self._discard(entry)
+
+    async def aacquire(self, priority: int = 0, tokens: int = 0) -> float:
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        entry = self._enqueue(priority, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                wait_seconds = self._try_take(entry, tokens)
+                if wait_seconds == 0.0:
+                    return self._observe(started)
+                timeout = QUEUE_POLL_SECONDS if wait_seconds is None else min(wait_seconds, QUEUE_POLL_SECONDS)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            self._discard(entry)
+
+    def refund_tokens(self, estimated: int, actual: Optional[int]) -> None:
+        if self._token_rate <= 0 or actual is None:
+            return
+        with self._lock:
+            self._tokens = min(self._token_capacity, self._tokens + estimated - actual)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests_per_second": self.requests_per_second,
+                "tokens_per_minute": self.tokens_per_minute,
+                "queued": len(self._queue),
+                "queue_wait": {traffic: histogram.summary() for traffic, histogram in self._waits.items()},
+            }
+
+
+_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+
+
+class Upstream:
+    """单个上游的调用策略：每次尝试的截止时间、带抖动的指数退避重试、按 p95 延迟触发的对冲请求与熔断。
+
+    streaming=True 的调用会把增量交给调用方，一旦开始输出就不再重试，也不做对冲。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        retries: int = UPSTREAM_RETRIES,
+        hedge: bool = False,
+        breaker: Optional[CircuitBreaker] = None,
+        limiter: Optional[QuotaLimiter] = None,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "failures": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "short_circuits": 0,
+            "throttled": 0,
+        }
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """对冲的等待时间：最近成功调用延迟的 HEDGE_QUANTILE 分位数；样本不足时不对冲。"""
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return max(HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_QUANTILE))])
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+    def _admit(self) -> bool:
+        """放行则返回本次调用是否是熔断器的探测请求，否则抛出 CircuitOpenError。"""
+        self._count("calls")
+        admitted = self.breaker.allow()
+        if not admitted:
+            self._count("short_circuits")
+            raise CircuitOpenError(self.name)
+        return admitted == "probe"
+
+    def _abandon(self, probe: bool) -> None:
+        """调用被取消或中断（非 Exception）时上游没有给出结论，探测请求要交还名额，否则熔断器会一直停在半开状态。"""
+        if probe:
+            self.breaker.release_probe()
+
+    def _throttled(self, wait_seconds: float) -> None:
+        if wait_seconds > 0.001:
+            self._count("throttled")
+
+    def refund_tokens(self, estimated: int, actual: Optional[int]) -> None:
+        """调用结束后按实际 token 用量修正配额的预扣。"""
+        if self.limiter is not None:
+            self.limiter.refund_tokens(estimated, actual)
+
+    def _reserve_hedge(self, tokens: int) -> bool:
+        """对冲请求同样占用配额；额度紧张时不对冲，免得和排队的调用抢额度。"""
+        return self.limiter is None or self.limiter.try_acquire(tokens)
+
+    def _release(self, tokens: int, error: BaseException) -> None:
+        """失败的尝试：上游明确返回错误时退还预扣；超时的请求上游可能仍在计费，保留估计值。"""
+        if isinstance(error, UpstreamError) and not isinstance(error, UpstreamTimeout):
+            self.refund_tokens(tokens, 0)
+
+    def _settle(self, started: float, error: Optional[BaseException], streaming: bool) -> None:
+        if error is None:
+            if not streaming:
+                # 流式调用的耗时取决于输出长度，不参与对冲延迟的估计。
+                with self._lock:
+                    self._latencies.append(time.monotonic() - started)
+            self.breaker.record_success()
+            return
+        self._count("failures")
+        if isinstance(error, UpstreamTimeout):
+            self._count("timeouts")
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            # 参数错误等不可重试的错误说明上游仍在正常应答，不计入熔断。
+            self.breaker.record_success()
+
+    def _should_retry(self, error: BaseException, attempt: int, emitted: bool) -> bool:
+        return not emitted and attempt < self.retries and is_retryable(error) and self.breaker.state != "open"
+
+    def call(
+        self,
+        func: Callable[[], T],
+        streaming: bool = False,
+        emitted: Callable[[], bool] = lambda: False,
+        priority: int = 0,
+        tokens: int = 0,
+    ) -> T:
+        """同步调用 func()；非流式调用在线程池中执行以便施加截止时间（超时的线程会在后台自然结束）。
+
+        设置了配额时，每次尝试（含对冲）前按 priority 排队并预扣 tokens（估计的 token 数）；
+        成功的那次由调用方按实际用量 refund_tokens，失败的在这里结算（见 _release）。
+        """
+        probe = self._admit()
+        attempt = 0
+        while True:
+            try:
+                if self.limiter is not None:
+                    self._throttled(self.limiter.acquire(priority, tokens))
+                started = time.monotonic()
+                error: Optional[BaseException] = None
+                try:
+                    if streaming:
+                        result = self._run_stream_with_deadline(func, tokens)
+                    else:
+                        result = self._run_with_deadline(func, tokens)
+                except Exception as exc:
+                    error = exc
+            except BaseException:
+                self._abandon(probe)
+                raise
+            self._settle(started, error, streaming)
+            # 第一次尝试已经给出结论，之后的重试不再占用探测名额。
+            probe = False
+            if error is None:
+                return result
+            if not self._should_retry(error, attempt, streaming and emitted()):
+                raise error
+            self._count("retries")
+            current_span().set(retries=attempt + 1)
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def _run_with_deadline(self, func: Callable[[], T], tokens: int = 0) -> T:
+        deadline = time.monotonic() + self.timeout
+        futures: List[Future] = [_pool.submit(copy_context().run, func)]
+        delay = self.hedge_delay()
+        if delay is not None and delay < self.timeout:
+            done, _ = wait(futures, timeout=delay)
+            if not done and self._reserve_hedge(tokens):
+                self._count("hedges")
+                current_span().set(hedged=True)
+                futures.append(_pool.submit(copy_context().run, func))
+        pending: Set[Future] = set(futures)
+        last_error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self._count("hedge_wins")
+                    return future.result()
+                last_error = future.exception()
+                self._release(tokens, last_error)
+        if last_error is not None and time.monotonic() < deadline:
+            raise last_error
+        raise UpstreamTimeout(self.name, self.timeout)
+
+    def _run_stream_with_deadline(self, func: Callable[[], T], tokens: int = 0) -> T:
+        """在线程池中消费整个流并施加截止时间（与异步路径一致）；超时后线程中的流在下一个分片处停止输出。"""
+        abandoned = threading.Event()
+        context = copy_context()
+        context.run(_stream_abandoned.set, abandoned)
+        future = _pool.submit(context.run, func)
+        done, _ = wait([future], timeout=self.timeout)
+        if not done:
+            abandoned.set()
+            raise UpstreamTimeout(self.name, self.timeout)
+        error = future.exception()
+        if error is not None:
+            self._release(tokens, error)
+            raise error
+        return future.result()
+
+    async def acall(
+        self,
+        func: Callable[[], Awaitable[T]],
+        streaming: bool = False,
+        emitted: Callable[[], bool] = lambda: False,
+        priority: int = 0,
+        tokens: int = 0,
+    ) -> T:
+        """异步调用 func()；超时的尝试会被取消。"""
+        probe = self._admit()
+        attempt = 0
+        while True:
+            try:
+                if self.limiter is not None:
+                    self._throttled(await self.limiter.aacquire(priority, tokens))
+                started = time.monotonic()
+                error: Optional[BaseException] = None
+                try:
+                    result = await self._arun_with_deadline(func, hedge=not streaming, tokens=tokens)
+                except Exception as exc:
+                    error = exc
+            except BaseException:
+                # asyncio.CancelledError：回合超时、客户端断开或推测任务被取消。
+                self._abandon(probe)
+                raise
+            self._settle(started, error, streaming)
+            # 第一次尝试已经给出结论，之后的重试不再占用探测名额。
+            probe = False
+            if error is None:
+                return result
+            if not self._should_retry(error, attempt, streaming and emitted()):
+                raise error
+            self._count("retries")
+            current_span().set(retries=attempt + 1)
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+
+    async def _arun_with_deadline(self, func: Callable[[], Awaitable[T]], hedge: bool, tokens: int = 0) -> T:
+        deadline = time.monotonic() + self.timeout
+        primary = asyncio.ensure_future(func())
+        tasks = [primary]
+        try:
+            delay = self.hedge_delay() if hedge else None
+            if delay is not None and delay < self.timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._reserve_hedge(tokens):
+                    self._count("hedges")
+                    current_span().set(hedged=True)
+                    tasks.append(asyncio.ensure_future(func()))
+            pending = set(tasks)
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(0.0, deadline - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count("hedge_wins")
+                        return task.result()
+                    last_error = task.exception()
+                    self._release(tokens, last_error)
+            if last_error is not None and time.monotonic() < deadline:
+                raise last_error
+            raise UpstreamTimeout(self.name, self.timeout)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        delay = self.hedge_delay()
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "state": self.breaker.state,
+            "timeout_s": self.timeout,
+            "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+            "quota": self.limiter.snapshot() if self.limiter is not None else None,
+        }
+
+
+_upstreams: Dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+
+def _quota_limiter(rate: float, tokens_per_minute: float, burst: Optional[int] = None) -> Optional[QuotaLimiter]:
+    if rate <= 0 and tokens_per_minute <= 0:
+        return None
+    return QuotaLimiter(rate, tokens_per_minute, burst)
+
+
+def upstream(name: str) -> Upstream:
+    """按名称（llm/rag/openapi）取上游策略，首次使用时按环境变量创建。"""
+    with _upstreams_lock:
+        policy = _upstreams.get(name)
+        if policy is None:
+            policy = _upstreams[name] = Upstream(
+                name,
+                UPSTREAM_TIMEOUTS.get(name, UPSTREAM_TIMEOUTS["llm"]),
+                hedge=name in UPSTREAM_HEDGE,
+                limiter=_quota_limiter(UPSTREAM_RATES.get(name, 0.0), UPSTREAM_TPM.get(name, 0.0)),
+            )
+        return policy
+
+
+def set_quota(name: str, rate: float, tokens_per_minute: float = 0.0, burst: Optional[int] = None) -> None:
+    """调整某个上游的客户端配额（每秒请求数、每分钟 token 数，均为 0 表示不限）；保留已有的统计与熔断状态。"""
+    upstream(name).limiter = _quota_limiter(rate, tokens_per_minute, burst)
+
+
+def configure_upstream(name: str, **settings: Any) -> Upstream:
+    """替换某个上游的策略（测试、压测时调整超时/重试/对冲/熔断参数）。"""
+    breaker = CircuitBreaker(
+        settings.pop("breaker_failures", BREAKER_FAILURES),
+        settings.pop("breaker_reset_seconds", BREAKER_RESET_SECONDS),
+    )
+    policy = Upstream(
+        name,
+        settings.pop("timeout", UPSTREAM_TIMEOUTS.get(name, UPSTREAM_TIMEOUTS["llm"])),
+        retries=settings.pop("retries", UPSTREAM_RETRIES),
+        hedge=settings.pop("hedge", name in UPSTREAM_HEDGE),
+        breaker=breaker,
+        limiter=_quota_limiter(
+            settings.pop("rate", UPSTREAM_RATES.get(name, 0.0)),
+            settings.pop("tokens_per_minute", UPSTREAM_TPM.get(name, 0.0)),
+            settings.pop("burst", None),
+        ),
+    )
+    if settings:
+        raise TypeError(f"未知参数：{', '.join(settings)}")
+    with _upstreams_lock:
+        _upstreams[name] = policy
+    return policy
+
+
+def upstream_stats() -> Dict[str, Dict[str, Any]]:
+    """各上游的调用/重试/超时/对冲/熔断计数与熔断器状态。"""
+    with _upstreams_lock:
+        policies = list(_upstreams.values())
+    return {policy.name: policy.snapshot() for policy in policies}
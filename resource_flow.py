@@ -1,10 +1,16 @@
-﻿import json
+﻿import asyncio
+import json
 import re
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Dict, List, Optional, TypedDict
 
-from helpers import resolve_region_id
-from tools import Billing, ECS, call_llm
-from agents import general_assistant, spec_assistant
+from helpers import intent_signals, resolve_region_id
+from intent_model import confident_label, record_route
+from resilience import UpstreamError
+from tools import Billing, ECS, InstanceSummary, acall_llm, acall_llm_parsed, call_llm, call_llm_parsed
+from tracing import current_span, traced
+from agents import ageneral_assistant, aspec_assistant, general_assistant, spec_assistant
 
 RESOURCE_AGENT_NAMES = [
     "AliyunInfoAssistant",
@@ -13,6 +19,13 @@ RESOURCE_AGENT_NAMES = [
 ]
 
 
+class AgentStep(TypedDict):
+    """Planner 给出的一步；depends_on 中的 agent 完成后才会执行本步。"""
+
+    agent: str
+    depends_on: List[str]
+
+
 def _format_balance(data: Dict[str, str]) -> str:
     return (
         "余额信息：\n"
@@ -24,22 +37,38 @@ def _format_balance(data: Dict[str, str]) -> str:
     )
 
 
-def _format_instances(instances: List[Dict[str, str]]) -> str:
-    if not instances:
+SUMMARY_TOP_N = 10
+
+
+def _format_counts(counts: Dict[str, int]) -> str:
+    items = list(counts.items())
+    text = "，".join(f"{name or '未知'} {count}" for name, count in items[:SUMMARY_TOP_N])
+    if len(items) > SUMMARY_TOP_N:
+        text += f"，其余 {len(items) - SUMMARY_TOP_N} 项"
+    return text
+
+
+def _format_instances(summary: InstanceSummary) -> str:
+    if not summary.total:
         return "未查询到 ECS 实例。"
-    lines = ["ECS 实例列表（最多 10 条）："]
-    for item in instances:
-        lines.append(
-            f"- {item.get('instance_id')} | {item.get('instance_type')} | "
-            f"{item.get('status')} | {item.get('zone_id')}"
-        )
+    scope = summary.regions[0] if len(summary.regions) == 1 else f"{len(summary.regions)} 个地域"
+    lines = [
+        f"ECS 实例概览（{scope}）：共 {summary.total} 台",
+        f"- 按状态：{_format_counts(summary.by_status)}",
+        f"- 按规格：{_format_counts(summary.by_type)}",
+        f"- 按可用区：{_format_counts(summary.by_zone)}",
+        f"示例实例（最多 {len(summary.samples)} 条）：",
+    ]
+    for item in summary.samples:
+        lines.append(f"- {item.instance_id} | {item.instance_type} | {item.status} | {item.zone_id}")
     return "\n".join(lines)
 
 
+@traced("resource_assistant")
 def resource_assistant(question: str) -> str:
-    lowered = question.lower()
-    wants_balance = "余额" in question or "账户" in question or "账单" in question
-    wants_instances = "实例" in question or "ecs" in lowered
+    signals = intent_signals(question)
+    wants_balance = "balance" in signals
+    wants_instances = "instance" in signals or "ecs" in signals
     if not wants_balance and not wants_instances:
         return "未识别到资源查询意图，请说明是查询余额还是 ECS 实例。"
     replies: List[str] = []
@@ -47,30 +76,36 @@ def resource_assistant(question: str) -> str:
         if wants_balance:
             replies.append(_format_balance(Billing.get_balance()))
         if wants_instances:
+            # 未指定地域且未设置 DEFAULT_REGION_ID 时，汇总全部地域。
             region_id = resolve_region_id(question)
-            if not region_id:
-                return "请提供地域（例如 cn-hangzhou），或设置 DEFAULT_REGION_ID。"
-            replies.append(_format_instances(ECS.query_instances(region_id)))
+            replies.append(_format_instances(ECS.summarize_instances(region_id or None)))
+    except UpstreamError as exc:
+        return f"{exc}，请稍后重试。"
     except RuntimeError as exc:
         return f"{exc}\n如需查询账号/实例信息，请配置 ALIBABA_CLOUD_ACCESS_KEY_ID/SECRET。"
     return "\n\n".join(replies)
 
 
-def _parse_agent_list(text: str) -> List[str]:
+async def aresource_assistant(question: str) -> str:
+    """OpenAPI SDK 为同步实现，放到线程池执行以免阻塞事件循环。"""
+    return await asyncio.to_thread(resource_assistant, question)
+
+
+def _parse_agent_list(text: str) -> List[Any]:
     if not text:
         return []
     try:
         data = json.loads(text)
         if isinstance(data, list):
-            return [str(item) for item in data]
+            return data
     except Exception:
         pass
-    match = re.search(r"\[.*?\]", text, re.S)
+    match = re.search(r"\[.*\]", text, re.S)
     if match:
         try:
             data = json.loads(match.group(0))
             if isinstance(data, list):
-                return [str(item) for item in data]
+                return data
         except Exception:
             pass
     ordered: List[str] = []
@@ -80,10 +115,31 @@ def _parse_agent_list(text: str) -> List[str]:
     return ordered
 
 
-def _heuristic_agent_order(question: str) -> List[str]:
-    lowered = question.lower()
-    wants_spec = "ecs." in lowered or "规格" in question or "参数" in question or "详情" in question
-    wants_resource = "余额" in question or "实例" in question or "ecs" in lowered
+def normalize_agent_steps(items: List[Any]) -> List[AgentStep]:
+    """兼容纯名称数组与带 depends_on 的对象数组，依赖只能指向排在前面的 agent。"""
+    steps: List[AgentStep] = []
+    seen: List[str] = []
+    for item in items:
+        if isinstance(item, dict):
+            name = str(item.get("agent", ""))
+            raw_deps = item.get("depends_on") or []
+            if isinstance(raw_deps, str):
+                raw_deps = [raw_deps]
+        else:
+            name = str(item)
+            raw_deps = []
+        if name not in RESOURCE_AGENT_NAMES or name in seen:
+            continue
+        depends_on = [str(dep) for dep in raw_deps if str(dep) in seen]
+        steps.append({"agent": name, "depends_on": depends_on})
+        seen.append(name)
+    return steps
+
+
+def _heuristic_agent_order(question: str) -> List[AgentStep]:
+    signals = intent_signals(question)
+    wants_spec = "spec" in signals
+    wants_resource = "balance" in signals or "instance" in signals or "ecs" in signals
     order: List[str] = []
     if wants_resource:
         order.append("AliyunInfoAssistant")
@@ -91,57 +147,243 @@ def _heuristic_agent_order(question: str) -> List[str]:
         order.append("InstanceTypeDetailAssistant")
     if not order:
         order.append("ChatAssistant")
-    return order
+    return normalize_agent_steps(order)
 
 
-def plan_resource_agents(question: str, history: List[Dict[str, str]]) -> List[str]:
-    system_prompt = (
-        "你是资源查询的 Planner，需要决定要依次调用哪些 assistant。\n"
-        "只允许输出 JSON 数组，元素必须是以下之一：\n"
-        "- AliyunInfoAssistant\n"
-        "- InstanceTypeDetailAssistant\n"
-        "- ChatAssistant\n"
-        "只输出数组本身，不要输出其他文字。"
-    )
+PLANNER_SYSTEM_PROMPT = (
+    "你是资源查询的 Planner，需要决定要调用哪些 assistant。\n"
+    "只允许输出 JSON 数组，元素必须是以下之一：\n"
+    "- AliyunInfoAssistant\n"
+    "- InstanceTypeDetailAssistant\n"
+    "- ChatAssistant\n"
+    "相互独立的 assistant 会并行执行。若某个 assistant 需要使用前面 assistant 的结果，"
+    "请将该元素写成对象，例如 {\"agent\": \"ChatAssistant\", \"depends_on\": [\"AliyunInfoAssistant\"]}。\n"
+    "只输出数组本身，不要输出其他文字。"
+)
+
+
+def agent_label(steps: List[AgentStep]) -> str:
+    """agent 执行计划的规范化文本，作为本地意图分类器的标签。"""
+    return json.dumps(steps, ensure_ascii=False)
+
+
+def local_agent_order(question: str) -> List[AgentStep]:
+    """本地意图分类器足够确定时直接给出 agent 执行计划，否则返回空列表。"""
+    label = confident_label("agents", question)
+    if not label:
+        return []
+    try:
+        return normalize_agent_steps(json.loads(label))
+    except ValueError:
+        return []
+
+
+def _parse_agent_steps(text: str) -> List[AgentStep]:
+    return normalize_agent_steps(_parse_agent_list(text))
+
+
+def _resolve_agent_order(steps: List[AgentStep], question: str) -> List[AgentStep]:
+    if steps:
+        record_route("agents", question, agent_label(steps))
+    return steps or _heuristic_agent_order(question)
+
+
+@traced("plan_resource_agents")
+def plan_resource_agents(question: str, history: List[Dict[str, str]]) -> List[AgentStep]:
+    local = local_agent_order(question)
+    if local:
+        current_span().set(router="local")
+        return local
     payload = {"question": question}
     try:
-        text = call_llm(system_prompt, json.dumps(payload, ensure_ascii=False), history=history)
-        order = _parse_agent_list(text)
-        order = [name for name in order if name in RESOURCE_AGENT_NAMES]
-        return order or _heuristic_agent_order(question)
+        steps = call_llm_parsed(
+            PLANNER_SYSTEM_PROMPT,
+            json.dumps(payload, ensure_ascii=False),
+            _parse_agent_steps,
+            history=history,
+            stage="plan",
+        )
+        return _resolve_agent_order(steps, question)
     except Exception:
         return _heuristic_agent_order(question)
 
 
+@traced("plan_resource_agents")
+async def aplan_resource_agents(question: str, history: List[Dict[str, str]]) -> List[AgentStep]:
+    local = local_agent_order(question)
+    if local:
+        current_span().set(router="local")
+        return local
+    payload = {"question": question}
+    try:
+        steps = await acall_llm_parsed(
+            PLANNER_SYSTEM_PROMPT,
+            json.dumps(payload, ensure_ascii=False),
+            _parse_agent_steps,
+            history=history,
+            stage="plan",
+        )
+        return _resolve_agent_order(steps, question)
+    except Exception:
+        return _heuristic_agent_order(question)
+
+
+def _execution_waves(steps: List[AgentStep]) -> List[List[AgentStep]]:
+    """按依赖深度分层，同一层内的 agent 互不依赖，可以并行执行。"""
+    levels: Dict[str, int] = {}
+    waves: List[List[AgentStep]] = []
+    for step in steps:
+        level = max((levels[dep] + 1 for dep in step["depends_on"]), default=0)
+        levels[step["agent"]] = level
+        if level == len(waves):
+            waves.append([])
+        waves[level].append(step)
+    return waves
+
+
+def _agent_query(question: str, step: AgentStep, responses: Dict[str, str]) -> str:
+    known = [responses[dep] for dep in step["depends_on"] if dep in responses]
+    if not known:
+        return question
+    known_text = "\n".join(known)
+    return f"你可以参考已知信息：{known_text}\n用户问题：{question}"
+
+
+@traced("run_agent")
+def _run_agent(agent: str, query: str, history: List[Dict[str, str]], stream: bool = False) -> str:
+    current_span().set(agent=agent)
+    if agent == "AliyunInfoAssistant":
+        return resource_assistant(query)
+    if agent == "InstanceTypeDetailAssistant":
+        return spec_assistant(query, history, stream=stream)
+    return general_assistant(query, history, stream=stream)
+
+
+@traced("run_agent")
+async def _arun_agent(agent: str, query: str, history: List[Dict[str, str]], stream: bool = False) -> str:
+    current_span().set(agent=agent)
+    if agent == "AliyunInfoAssistant":
+        return await aresource_assistant(query)
+    if agent == "InstanceTypeDetailAssistant":
+        return await aspec_assistant(query, history, stream=stream)
+    return await ageneral_assistant(query, history, stream=stream)
+
+
+def execute_agents(
+    question: str,
+    history: List[Dict[str, str]],
+    steps: List[AgentStep],
+) -> List[Dict[str, str]]:
+    """执行计划中的 agent：无依赖的并行，有依赖的等待上游结果后再执行。
+
+    只有一个 agent 时其输出即最终回复，开启增量输出。
+    """
+    stream = len(steps) == 1
+    responses: Dict[str, str] = {}
+    for wave in _execution_waves(steps):
+        queries = [_agent_query(question, step, responses) for step in wave]
+        if len(wave) == 1:
+            results = [_run_agent(wave[0]["agent"], queries[0], history, stream=stream)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+                # 复制上下文，让线程内的调用沿用当前会话的追踪信息。
+                futures = [
+                    pool.submit(copy_context().run, _run_agent, step["agent"], query, history)
+                    for step, query in zip(wave, queries)
+                ]
+                results = [future.result() for future in futures]
+        for step, response in zip(wave, results):
+            responses[step["agent"]] = response
+    return [{"agent": step["agent"], "response": responses[step["agent"]]} for step in steps]
+
+
+async def aexecute_agents(
+    question: str,
+    history: List[Dict[str, str]],
+    steps: List[AgentStep],
+) -> List[Dict[str, str]]:
+    stream = len(steps) == 1
+    responses: Dict[str, str] = {}
+    for wave in _execution_waves(steps):
+        results = await asyncio.gather(
+            *(
+                _arun_agent(step["agent"], _agent_query(question, step, responses), history, stream=stream)
+                for step in wave
+            )
+        )
+        for step, response in zip(wave, results):
+            responses[step["agent"]] = response
+    return [{"agent": step["agent"], "response": responses[step["agent"]]} for step in steps]
+
+
+SUMMARY_SYSTEM_PROMPT = "你是 SummaryAssistant，请基于已知信息简洁、准确地回答用户问题。"
+
+
+def _summary_prompt(question: str, agent_messages: List[Dict[str, str]]) -> str:
+    chunks = "\n\n".join(
+        f"{item['agent']}：\n{item['response']}" for item in agent_messages
+    )
+    return f"用户问题：{question}\n\n已知信息：\n{chunks}"
+
+
+@traced("summarize_resource_answer")
 def _summarize_resource_answer(
     question: str,
     agent_messages: List[Dict[str, str]],
     history: List[Dict[str, str]],
 ) -> str:
-    system_prompt = "你是 SummaryAssistant，请基于已知信息简洁、准确地回答用户问题。"
-    chunks = "\n\n".join(
-        f"{item['agent']}：\n{item['response']}" for item in agent_messages
+    return call_llm(
+        SUMMARY_SYSTEM_PROMPT,
+        _summary_prompt(question, agent_messages),
+        history=history,
+        stream=True,
+        stage="summary",
     )
-    user_prompt = f"用户问题：{question}\n\n已知信息：\n{chunks}"
-    return call_llm(system_prompt, user_prompt, history=history)
 
 
-def run_resource_flow(question: str, history: List[Dict[str, str]]) -> str:
-    order = plan_resource_agents(question, history)
+@traced("summarize_resource_answer")
+async def _asummarize_resource_answer(
+    question: str,
+    agent_messages: List[Dict[str, str]],
+    history: List[Dict[str, str]],
+) -> str:
+    return await acall_llm(
+        SUMMARY_SYSTEM_PROMPT,
+        _summary_prompt(question, agent_messages),
+        history=history,
+        stream=True,
+        stage="summary",
+    )
+
+
+@traced("resource_flow")
+def run_resource_flow(
+    question: str,
+    history: List[Dict[str, str]],
+    order: Optional[List[AgentStep]] = None,
+) -> str:
+    """order 由回合规划器预先给出时，跳过 Planner 调用。"""
     if not order:
-        return general_assistant(question, history)
-    current_query = question
-    agent_messages: List[Dict[str, str]] = []
-    for idx, agent in enumerate(order):
-        if agent == "AliyunInfoAssistant":
-            response = resource_assistant(current_query)
-        elif agent == "InstanceTypeDetailAssistant":
-            response = spec_assistant(current_query, history)
-        else:
-            response = general_assistant(current_query, history)
-        agent_messages.append({"agent": agent, "response": response})
-        if idx < len(order) - 1:
-            current_query = f"你可以参考已知信息：{response}\n用户问题：{question}"
+        order = plan_resource_agents(question, history)
+    if not order:
+        return general_assistant(question, history, stream=True)
+    agent_messages = execute_agents(question, history, order)
     if len(agent_messages) == 1:
         return agent_messages[0]["response"]
     return _summarize_resource_answer(question, agent_messages, history)
+
+
+@traced("resource_flow")
+async def arun_resource_flow(
+    question: str,
+    history: List[Dict[str, str]],
+    order: Optional[List[AgentStep]] = None,
+) -> str:
+    if not order:
+        order = await aplan_resource_agents(question, history)
+    if not order:
+        return await ageneral_assistant(question, history, stream=True)
+    agent_messages = await aexecute_agents(question, history, order)
+    if len(agent_messages) == 1:
+        return agent_messages[0]["response"]
+    return await _asummarize_resource_answer(question, agent_messages, history)
@@ -0,0 +1,291 @@
+﻿import argparse
+import asyncio
+import json
+import os
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+from tools import close_http_session
+from resilience import UpstreamError, upstream_stats
+from speculation import speculation_stats
+from tracing import histograms
+from worker_pool import WORKER_COUNT, WorkerLost, WorkerPool
+from workflow import ainvoke_reply, astream_reply, build_app
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "8080"))
+SERVER_MAX_CONCURRENCY = int(os.environ.get("SERVER_MAX_CONCURRENCY", "32"))
+SERVER_MAX_QUEUE = int(os.environ.get("SERVER_MAX_QUEUE", "256"))
+SERVER_SESSION_QUEUE = int(os.environ.get("SERVER_SESSION_QUEUE", "4"))
+SERVER_TURN_TIMEOUT = float(os.environ.get("SERVER_TURN_TIMEOUT", "120"))
+RETRY_AFTER_SECONDS = "1"
+
+
+class Overloaded(Exception):
+    """准入被拒绝：全局排队已满（503）或单会话排队过多（429）。"""
+
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class _SessionSlot:
+    __slots__ = ("lock", "waiters")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+
+class TurnScheduler:
+    """多会话并发调度：同一会话的回合串行执行，全局最多 max_concurrency 个回合同时运行，
+    超出部分排队，排队数超过 max_queue 时直接拒绝。"""
+
+    def __init__(
+        self,
+        max_concurrency: int = SERVER_MAX_CONCURRENCY,
+        max_queue: int = SERVER_MAX_QUEUE,
+        session_queue: int = SERVER_SESSION_QUEUE,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.session_queue = session_queue
+        self._workers = asyncio.Semaphore(max_concurrency)
+        self._sessions: Dict[str, _SessionSlot] = {}
+        self.admitted = 0
+        self.running = 0
+        self.stats = {"completed": 0, "failed": 0, "rejected": 0, "timeouts": 0}
+
+    @property
+    def queued(self) -> int:
+        return self.admitted - self.running
+
+    def saturated(self) -> bool:
+        return self.admitted >= self.max_concurrency + self.max_queue
+
+    def _admit(self, session_id: str) -> _SessionSlot:
+        if self.saturated():
+            self.stats["rejected"] += 1
+            raise Overloaded(503, "服务繁忙，请稍后重试。")
+        slot = self._sessions.setdefault(session_id, _SessionSlot())
+        if slot.waiters >= self.session_queue:
+            self.stats["rejected"] += 1
+            raise Overloaded(429, "该会话的请求过多，请等待上一轮回复。")
+        slot.waiters += 1
+        self.admitted += 1
+        return slot
+
+    def _release(self, session_id: str, slot: _SessionSlot) -> None:
+        slot.waiters -= 1
+        self.admitted -= 1
+        if not slot.waiters:
+            self._sessions.pop(session_id, None)
+
+    async def run(self, session_id: str, turn: Any) -> Any:
+        """排队后执行 turn()（返回协程的可调用对象），超过 SERVER_TURN_TIMEOUT 抛出 asyncio.TimeoutError。"""
+        slot = self._admit(session_id)
+        try:
+            # 先拿会话锁再占 worker，避免同一会话的后续请求空占并发名额。
+            async with slot.lock, self._workers:
+                self.running += 1
+                try:
+                    result = await asyncio.wait_for(turn(), SERVER_TURN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    raise
+                except Exception:
+                    self.stats["failed"] += 1
+                    raise
+                finally:
+                    self.running -= 1
+                self.stats["completed"] += 1
+                return result
+        finally:
+            self._release(session_id, slot)
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "status": "saturated" if self.saturated() else "ok",
+            "running": self.running,
+            "queued": self.queued,
+            "active_sessions": len(self._sessions),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            **self.stats,
+        }
+
+
+def _error(status: int, message: str, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    return web.json_response({"error": message}, status=status, headers=headers, dumps=_dumps)
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _sse(data: Dict[str, Any]) -> bytes:
+    return f"data: {_dumps(data)}\n\n".encode("utf-8")
+
+
+async def _chat(request: web.Request) -> web.StreamResponse:
+    try:
+        body = await request.json()
+    except ValueError:
+        return _error(400, "请求体必须是 JSON。")
+    if not isinstance(body, dict):
+        return _error(400, "请求体必须是 JSON 对象。")
+    question = str(body.get("question") or "").strip()
+    session_id = str(body.get("session_id") or "").strip()
+    if not question or not session_id:
+        return _error(400, "需要提供 session_id 与 question。")
+    app = request.app["graph"]
+    pool: Optional[WorkerPool] = request.app["pool"]
+    scheduler: TurnScheduler = request.app["scheduler"]
+    config = {"configurable": {"thread_id": session_id}}
+
+    if not body.get("stream"):
+        async def _turn() -> str:
+            if pool is not None:
+                return await pool.ainvoke(session_id, question)
+            return await ainvoke_reply(app, question, config)
+
+        try:
+            reply = await scheduler.run(session_id, _turn)
+        except Overloaded as exc:
+            return _error(exc.status, exc.reason, {"Retry-After": RETRY_AFTER_SECONDS})
+        except asyncio.TimeoutError:
+            return _error(504, "本轮处理超时，请稍后重试。")
+        except (UpstreamError, WorkerLost) as exc:
+            return _error(503, f"{exc}，请稍后重试。", {"Retry-After": RETRY_AFTER_SECONDS})
+        except Exception as exc:
+            return _error(500, f"处理失败：{exc}")
+        return web.json_response({"session_id": session_id, "reply": reply}, dumps=_dumps)
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+
+    async def _stream_turn() -> None:
+        await response.prepare(request)
+        replies = pool.astream(session_id, question) if pool is not None else astream_reply(app, question, config)
+        async for kind, text in replies:
+            await response.write(_sse({kind: text}))
+
+    try:
+        await scheduler.run(session_id, _stream_turn)
+    except Overloaded as exc:
+        return _error(exc.status, exc.reason, {"Retry-After": RETRY_AFTER_SECONDS})
+    except asyncio.TimeoutError:
+        if not response.prepared:
+            return _error(504, "本轮处理超时，请稍后重试。")
+        await response.write(_sse({"error": "本轮处理超时，请稍后重试。"}))
+    except (UpstreamError, WorkerLost) as exc:
+        if not response.prepared:
+            return _error(503, f"{exc}，请稍后重试。", {"Retry-After": RETRY_AFTER_SECONDS})
+        await response.write(_sse({"error": f"{exc}，请稍后重试。"}))
+    except Exception as exc:
+        if not response.prepared:
+            return _error(500, f"处理失败：{exc}")
+        await response.write(_sse({"error": f"处理失败：{exc}"}))
+    await response.write_eof()
+    return response
+
+
+async def _health(request: web.Request) -> web.Response:
+    health = request.app["scheduler"].health()
+    pool: Optional[WorkerPool] = request.app["pool"]
+    if pool is not None:
+        health["pool"] = pool.snapshot()
+    return web.json_response(health, status=200 if health["status"] == "ok" else 503, dumps=_dumps)
+
+
+async def _metrics(request: web.Request) -> web.Response:
+    pool: Optional[WorkerPool] = request.app["pool"]
+    if pool is not None:
+        # 上游调用与各阶段都在 worker 进程中执行，统计按 worker 分别返回。
+        return web.json_response(
+            {"scheduler": request.app["scheduler"].health(), "pool": pool.snapshot(), "workers": await pool.worker_stats()},
+            dumps=_dumps,
+        )
+    return web.json_response(
+        {
+            "scheduler": request.app["scheduler"].health(),
+            "upstreams": upstream_stats(),
+            "latency": histograms(),
+            "speculation": speculation_stats(),
+        },
+        dumps=_dumps,
+    )
+
+
+async def _start_pool(server: web.Application) -> None:
+    await server["pool"].start()
+
+
+async def _close_pool(server: web.Application) -> None:
+    await server["pool"].close()
+
+
+async def _close_upstream(_: web.Application) -> None:
+    await close_http_session()
+
+
+def create_server(
+    graph: Any = None,
+    scheduler: Optional[TurnScheduler] = None,
+    pool: Optional[WorkerPool] = None,
+) -> web.Application:
+    """创建 HTTP 服务：POST /v1/chat 处理一轮对话，GET /healthz 返回负载情况，GET /metrics 返回各阶段延迟直方图。
+
+    传入 pool 时回合转发到 worker 进程执行（见 worker_pool.WorkerPool），本进程不编译对话图。
+    """
+    server = web.Application()
+    server["pool"] = pool
+    server["graph"] = None if pool is not None else graph or build_app()
+    server["scheduler"] = scheduler or TurnScheduler()
+    server.router.add_post("/v1/chat", _chat)
+    server.router.add_get("/healthz", _health)
+    server.router.add_get("/metrics", _metrics)
+    if pool is not None:
+        server.on_startup.append(_start_pool)
+        server.on_cleanup.append(_close_pool)
+    server.on_cleanup.append(_close_upstream)
+    return server
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="多智能体客服 HTTP 服务")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="使用离线桩替代 DashScope/OpenAPI（本地联调、压测用）",
+    )
+    parser.add_argument(
+        "--stub-latency",
+        default="0.2",
+        help="桩的单次调用延迟：秒数或分布，如 lognormal:0.8:0.5（见 stubs.latency_sampler）",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKER_COUNT,
+        help="worker 进程数，按会话 ID 一致性哈希分片；0 表示在本进程内处理（默认）",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 0:
+        pool = WorkerPool(args.workers, stub_latency=args.stub_latency if args.stub else None)
+        web.run_app(create_server(pool=pool), host=args.host, port=args.port)
+        return 0
+    if args.stub:
+        from stubs import install_stub_backends
+
+        install_stub_backends(args.stub_latency, args.stub_latency, args.stub_latency)
+    web.run_app(create_server(), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,496 @@
+﻿import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+from langgraph.checkpoint.memory import MemorySaver
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite")
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", os.path.join(".cache", "sessions.sqlite3"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "1800"))
+SESSION_KEEP_CHECKPOINTS = int(os.environ.get("SESSION_KEEP_CHECKPOINTS", "3"))
+# 回合内各步的 checkpoint 何时写入：exit=回合结束时写一次（默认）；async/sync=每一步都写（可从中断的步骤恢复）。
+SESSION_DURABILITY = os.environ.get("SESSION_DURABILITY", "exit")
+
+# (checkpoint_id, parent_id, checkpoint, metadata, pending_writes, channel_values)，均为序列化后的数据。
+# checkpoint 中不含 channel_values，各 channel 的值按版本单独存放（见 SqliteCheckpointSaver.put）；
+# 缓存中的 pending_writes 为 None 表示 put_writes 之后尚未重新读取。
+_Row = Tuple[
+    str,
+    Optional[str],
+    Tuple[str, bytes],
+    Tuple[str, bytes],
+    Optional[List[Tuple[str, str, Tuple[str, bytes], str, int]]],
+    Dict[str, Tuple[str, bytes]],
+]
+
+
+class SqliteCheckpointSaver(BaseCheckpointSaver[int]):
+    """SQLite 持久化的 checkpointer。
+
+    - 每个 (thread_id, checkpoint_ns) 只保留最近 keep_checkpoints 个 checkpoint 及其 writes；
+    - channel 的值按 (channel, version) 单独存放，put 只写入本步有变化的 channel，未变化的沿用旧版本；
+    - 最近活跃会话的最新 checkpoint 缓存在内存中，按 LRU 与空闲时间淘汰，内存占用与会话总数无关。
+    """
+
+    def __init__(
+        self,
+        path: str = SESSION_DB_PATH,
+        *,
+        cache_size: int = SESSION_CACHE_SIZE,
+        idle_seconds: float = SESSION_IDLE_SECONDS,
+        keep_checkpoints: int = SESSION_KEEP_CHECKPOINTS,
+        serde: Any = None,
+    ) -> None:
+        super().__init__(serde=serde)
+        self.path = path
+        self.cache_size = cache_size
+        self.idle_seconds = idle_seconds
+        self.keep_checkpoints = max(1, keep_checkpoints)
+        self._lock = threading.RLock()
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, _Row]]" = OrderedDict()
+        directory = os.path.dirname(path)
+        if directory and path != ":memory:":
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_id TEXT,
+                checkpoint_type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                value_type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                version TEXT NOT NULL,
+                value_type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+            );
+            """
+        )
+        self._conn.commit()
+
+    # ---- 内存热缓存 ----
+
+    def _cache_get(self, key: Tuple[str, str]) -> Optional[_Row]:
+        now = time.monotonic()
+        self._evict_idle(now)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache[key] = (now, entry[1])
+        self._cache.move_to_end(key)
+        return entry[1]
+
+    def _cache_put(self, key: Tuple[str, str], row: _Row) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = (time.monotonic(), row)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _evict_idle(self, now: float) -> None:
+        while self._cache:
+            key, (last_access, _) = next(iter(self._cache.items()))
+            if now - last_access <= self.idle_seconds:
+                return
+            del self._cache[key]
+
+    def cache_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"cached_sessions": len(self._cache)}
+
+    def evict_cached(self, owned: Callable[[str], bool]) -> int:
+        """把 owned(thread_id) 为假的会话移出内存缓存，返回移出的条数。
+
+        多进程共用同一个数据库时，会话改由其他进程处理后本进程的缓存会过期（见 worker_pool）。
+        """
+        with self._lock:
+            stale = [key for key in self._cache if not owned(key[0])]
+            for key in stale:
+                del self._cache[key]
+        return len(stale)
+
+    # ---- SQLite 读写 ----
+
+    def _load_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> List[Tuple[str, str, Tuple[str, bytes], str, int]]:
+        rows = self._conn.execute(
+            "SELECT task_id, channel, value_type, value, task_path, idx FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        writes = [(task_id, channel, (value_type, value), task_path, idx) for task_id, channel, value_type, value, task_path, idx in rows]
+        writes.sort(key=lambda item: writes_sort_key(item[3], item[0], item[4]))
+        return writes
+
+    def _load_values(
+        self, thread_id: str, checkpoint_ns: str, checkpoint: Tuple[str, bytes]
+    ) -> Dict[str, Tuple[str, bytes]]:
+        """按 checkpoint 的 channel_versions 取出各 channel 的值；旧格式的 checkpoint 自带 channel_values，这里取不到也无妨。"""
+        versions = self.serde.loads_typed(checkpoint).get("channel_versions", {})
+        rows = self._conn.execute(
+            "SELECT channel, version, value_type, value FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+            (thread_id, checkpoint_ns),
+        ).fetchall()
+        return {
+            channel: (value_type, value)
+            for channel, version, value_type, value in rows
+            if channel in versions and str(versions[channel]) == version
+        }
+
+    def _load_row(self, thread_id: str, checkpoint_ns: str, checkpoint_id: Optional[str]) -> Optional[_Row]:
+        if checkpoint_id:
+            found = self._conn.execute(
+                "SELECT checkpoint_id, parent_id, checkpoint_type, checkpoint, metadata_type, metadata "
+                "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchone()
+        else:
+            found = self._conn.execute(
+                "SELECT checkpoint_id, parent_id, checkpoint_type, checkpoint, metadata_type, metadata "
+                "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT 1",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+        if found is None:
+            return None
+        found_id, parent_id, checkpoint_type, checkpoint, metadata_type, metadata = found
+        return (
+            found_id,
+            parent_id,
+            (checkpoint_type, checkpoint),
+            (metadata_type, metadata),
+            self._load_writes(thread_id, checkpoint_ns, found_id),
+            self._load_values(thread_id, checkpoint_ns, (checkpoint_type, checkpoint)),
+        )
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row: _Row) -> CheckpointTuple:
+        checkpoint_id, parent_id, serialized, metadata, writes, values = row
+        checkpoint = self.serde.loads_typed(serialized)
+        channel_values = dict(checkpoint.get("channel_values") or {})
+        channel_values.update(
+            {channel: self.serde.loads_typed(value) for channel, value in values.items() if value[0] != "empty"}
+        )
+        checkpoint["channel_values"] = channel_values
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint=checkpoint,
+            metadata=self.serde.loads_typed(metadata),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_id,
+                    }
+                }
+                if parent_id
+                else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed(value)) for task_id, channel, value, _, _ in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        key = (thread_id, checkpoint_ns)
+        with self._lock:
+            row = self._cache_get(key)
+            if row is None or (checkpoint_id and row[0] != checkpoint_id):
+                row = self._load_row(thread_id, checkpoint_ns, checkpoint_id)
+                if row is None:
+                    return None
+                if not checkpoint_id:
+                    self._cache_put(key, row)
+            elif row[4] is None:
+                row = row[:4] + (self._load_writes(thread_id, checkpoint_ns, row[0]),) + row[5:]
+                self._cache_put(key, row)
+        return self._to_tuple(thread_id, checkpoint_ns, row)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        clauses: List[str] = []
+        params: List[Any] = []
+        if config:
+            clauses.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            checkpoint_ns = config["configurable"].get("checkpoint_ns")
+            if checkpoint_ns is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                clauses.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            clauses.append("checkpoint_id < ?")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, checkpoint_type, checkpoint, "
+                f"metadata_type, metadata FROM checkpoints {where} ORDER BY checkpoint_id DESC",
+                params,
+            ).fetchall()
+        for thread_id, checkpoint_ns, checkpoint_id, parent_id, c_type, c_value, m_type, m_value in found:
+            if limit is not None and limit <= 0:
+                return
+            metadata = self.serde.loads_typed((m_type, m_value))
+            if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            with self._lock:
+                writes = self._load_writes(thread_id, checkpoint_ns, checkpoint_id)
+                values = self._load_values(thread_id, checkpoint_ns, (c_type, c_value))
+            yield self._to_tuple(
+                thread_id,
+                checkpoint_ns,
+                (checkpoint_id, parent_id, (c_type, c_value), (m_type, m_value), writes, values),
+            )
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        stripped = checkpoint.copy()
+        channel_values: Dict[str, Any] = stripped.pop("channel_values")  # type: ignore[misc]
+        new_values = {
+            channel: self.serde.dumps_typed(channel_values[channel]) if channel in channel_values else ("empty", b"")
+            for channel in new_versions
+        }
+        serialized = self.serde.dumps_typed(stripped)
+        serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        key = (thread_id, checkpoint_ns)
+        with self._lock:
+            if new_values:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (thread_id, checkpoint_ns, channel, str(new_versions[channel]), value_type, value)
+                        for channel, (value_type, value) in new_values.items()
+                    ],
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    parent_id,
+                    serialized[0],
+                    serialized[1],
+                    serialized_metadata[0],
+                    serialized_metadata[1],
+                ),
+            )
+            self._prune(thread_id, checkpoint_ns)
+            self._conn.commit()
+            # 未变化的 channel 沿用父 checkpoint 缓存中的值；父 checkpoint 不在缓存中时下次从数据库读取。
+            cached = self._cache.get(key)
+            if cached is not None and cached[1][0] == parent_id:
+                values = {**cached[1][5], **new_values}
+                values = {channel: values[channel] for channel in checkpoint["channel_versions"] if channel in values}
+                self._cache_put(key, (checkpoint["id"], parent_id, serialized, serialized_metadata, [], values))
+            elif parent_id is None:
+                self._cache_put(key, (checkpoint["id"], parent_id, serialized, serialized_metadata, [], new_values))
+            else:
+                self._cache.pop(key, None)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        stale = self._conn.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.keep_checkpoints),
+        ).fetchall()
+        if not stale:
+            return
+        params = [(thread_id, checkpoint_ns, checkpoint_id) for (checkpoint_id,) in stale]
+        self._conn.executemany(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            params,
+        )
+        self._conn.executemany(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            params,
+        )
+        # 删除不再被保留的 checkpoint 引用的 channel 版本。
+        referenced = set()
+        for checkpoint_type, checkpoint in self._conn.execute(
+            "SELECT checkpoint_type, checkpoint FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+            (thread_id, checkpoint_ns),
+        ):
+            versions = self.serde.loads_typed((checkpoint_type, checkpoint)).get("channel_versions", {})
+            referenced.update((channel, str(version)) for channel, version in versions.items())
+        stored = self._conn.execute(
+            "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?",
+            (thread_id, checkpoint_ns),
+        ).fetchall()
+        self._conn.executemany(
+            "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+            [(thread_id, checkpoint_ns, channel, version) for channel, version in stored if (channel, version) not in referenced],
+        )
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 特殊 channel（错误/中断等）覆盖写入，普通 channel 重复写入时保留首次结果。
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_bytes = self.serde.dumps_typed(value)
+            rows.append(
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint_id,
+                    task_id,
+                    WRITES_IDX_MAP.get(channel, idx),
+                    channel,
+                    value_type,
+                    value_bytes,
+                    task_path,
+                )
+            )
+        with self._lock:
+            self._conn.executemany(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            # 缓存的 checkpoint 与 channel 值仍然有效，只需在下次读取时重新加载 writes。
+            cached = self._cache.get((thread_id, checkpoint_ns))
+            if cached is not None and cached[1][0] == checkpoint_id:
+                self._cache[(thread_id, checkpoint_ns)] = (cached[0], cached[1][:4] + (None,) + cached[1][5:])
+            else:
+                self._cache.pop((thread_id, checkpoint_ns), None)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            self._conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+            self._conn.execute("DELETE FROM blobs WHERE thread_id = ?", (thread_id,))
+            self._conn.commit()
+            for key in [key for key in self._cache if key[0] == thread_id]:
+                del self._cache[key]
+
+    # 异步接口在线程中执行同步实现：SQLite 读写与提交会阻塞，不能放在事件循环里。
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_checkpointer(backend: Optional[str] = None) -> BaseCheckpointSaver:
+    """按 SESSION_STORE 创建会话存储：sqlite（默认，持久化且内存有界）或 memory（仅调试用）。"""
+    backend = backend or SESSION_STORE
+    if backend == "memory":
+        return MemorySaver()
+    if backend == "sqlite":
+        return SqliteCheckpointSaver()
+    raise ValueError(f"未知的会话存储类型：{backend}")
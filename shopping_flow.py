@@ -1,11 +1,15 @@
 ﻿import json
 import os
-import re
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from helpers import resolve_region_id
-from tools import call_llm, call_rag_app
-from agents import general_assistant
+from catalog import format_candidates, shortlist_candidates
+from helpers import intent_signals, parse_json_object, resolve_region_id
+from requirement_rules import extract_by_rules
+from resilience import UpstreamError
+from speculation import SPECULATIVE_RECOMMEND_ENABLED, speculator
+from tools import acall_llm_parsed, acall_rag_app, call_llm_parsed, call_rag_app, emit_text
+from tracing import current_span, traced
+from agents import ageneral_assistant, general_assistant
 
 REQUIRED_FIELDS = ["场景", "vCPU", "内存", "预算", "地域"]
 OPTIONAL_FIELDS = ["架构"]
@@ -17,6 +21,9 @@ FIELD_QUESTIONS = {
     "地域": "希望部署在哪个地域？例如 cn-hangzhou。",
 }
 EXTRACTION_FIELDS = REQUIRED_FIELDS + OPTIONAL_FIELDS
+SHOPPING_ROUTES = ("ECSGuideAssistant", "Other")
+RULE_EXTRACTOR_ENABLED = os.environ.get("RULE_EXTRACTOR", "on") != "off"
+RULE_EXTRACTION_THRESHOLD = float(os.environ.get("RULE_EXTRACTION_THRESHOLD", "0.8"))
 
 
 def _is_filled(value: object) -> bool:
@@ -33,71 +40,28 @@ def _requirements_complete(requirements: Dict[str, str]) -> bool:
 
 
 def _should_reuse_requirements(question: str) -> bool:
-    text = (question or "").strip()
-    if not text:
-        return False
-    lowered = text.lower()
-    carry_over_hints = {
-        "沿用",
-        "继续",
-        "基于",
-        "在之前基础上",
-        "在刚才基础上",
-        "之前",
-        "上次",
-        "刚才",
-        "同样",
-        "不变",
-        "其余不变",
-        "照旧",
-    }
-    if any(hint in text for hint in carry_over_hints):
-        return True
-    modify_hints = {
-        "改为",
-        "改成",
-        "改到",
-        "调整",
-        "变为",
-        "换成",
-        "提高",
-        "降低",
-        "上调",
-        "下调",
-        "更新",
-    }
-    requirement_keywords = {"场景", "业务", "用途", "预算", "内存", "vcpu", "cpu", "核", "地域", "区域"}
-    if any(hint in text for hint in modify_hints) and any(key in lowered or key in text for key in requirement_keywords):
+    signals = intent_signals(question)
+    if "carry_over" in signals:
         return True
-    return False
+    return "modify" in signals and "requirement" in signals
 
 
-def _parse_json(text: str) -> Dict[str, str]:
-    try:
-        return json.loads(text)
-    except Exception:
-        match = re.search(r"\{.*\}", text or "", re.S)
-        if match:
-            try:
-                return json.loads(match.group(0))
-            except Exception:
-                return {}
-    return {}
-
-
-def _extract_requirements(
-    question: str,
-    history: List[Dict[str, str]],
+def _extraction_request(
     requirements: Dict[str, str],
-) -> Dict[str, str]:
+    question: str,
+    fields: List[str] = EXTRACTION_FIELDS,
+) -> Tuple[str, str]:
     system_prompt = (
         "你是信息抽取器。请从用户输入中抽取导购所需信息，并输出 JSON。\n"
-        f"必须包含字段：{', '.join(EXTRACTION_FIELDS)}。\n"
+        f"必须包含字段：{', '.join(fields)}。\n"
         "未提到的字段输出空字符串，不要编造。只输出 JSON。"
     )
     payload = {"已收集需求": requirements, "用户输入": question}
-    text = call_llm(system_prompt, json.dumps(payload, ensure_ascii=False), history=history)
-    data = _parse_json(text)
+    return system_prompt, json.dumps(payload, ensure_ascii=False)
+
+
+def normalize_extraction(data: Dict[str, Any]) -> Dict[str, str]:
+    """只保留抽取字段，并统一转为字符串。"""
     result: Dict[str, str] = {}
     for key in EXTRACTION_FIELDS:
         value = data.get(key)
@@ -106,6 +70,88 @@ def _extract_requirements(
     return result
 
 
+def _parse_extraction(text: str) -> Optional[Dict[str, str]]:
+    """输出中没有 JSON 对象时返回 None，由 call_llm_parsed 换主模型重试。"""
+    data = parse_json_object(text)
+    return normalize_extraction(data) if data else None
+
+
+def _expected_field(requirements: Dict[str, str]) -> str:
+    """上一轮追问的字段（第一个缺失的必填字段）。"""
+    missing = [field for field in REQUIRED_FIELDS if not _is_filled(requirements.get(field))]
+    return missing[0] if missing else ""
+
+
+def _rule_extraction(question: str, requirements: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, str], List[str]]:
+    """先用规则抽取，返回 (可信字段, 低置信字段, 仍需交给 LLM 的字段)。
+
+    用户提到了却没能解析的字段、置信度不够的字段，以及正在追问却没答上的字段才交给 LLM。
+    """
+    if not RULE_EXTRACTOR_ENABLED:
+        return {}, {}, list(EXTRACTION_FIELDS)
+    expected = _expected_field(requirements)
+    result = extract_by_rules(question, expected)
+    confident = result.confident(RULE_EXTRACTION_THRESHOLD)
+    tentative = {field: value for field, value in result.values.items() if field not in confident}
+    pending = [
+        field
+        for field in EXTRACTION_FIELDS
+        if field not in confident and (field in result.unresolved or field in tentative or field == expected)
+    ]
+    current_span().set(rule_fields=sorted(confident), llm_fields=pending)
+    return confident, tentative, pending
+
+
+def _combine_extraction(
+    confident: Dict[str, str],
+    tentative: Dict[str, str],
+    llm_extracted: Dict[str, str],
+    pending: List[str],
+) -> Dict[str, str]:
+    """规则的可信结果优先；LLM 只补它被要求的字段，没补上时退回低置信的规则结果。"""
+    combined = dict(tentative)
+    combined.update({field: value for field, value in llm_extracted.items() if field in pending and _is_filled(value)})
+    combined.update(confident)
+    return combined
+
+
+@traced("extract_requirements")
+def _extract_requirements(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+) -> Dict[str, str]:
+    confident, tentative, pending = _rule_extraction(question, requirements)
+    if not pending:
+        return confident
+    system_prompt, user_prompt = _extraction_request(requirements, question, pending)
+    try:
+        extracted = call_llm_parsed(system_prompt, user_prompt, _parse_extraction, history=history, stage="extract")
+    except UpstreamError:
+        # 上游重试后仍失败或已熔断时，只用规则结果，未识别的字段留待追问。
+        current_span().set(fallback="rules")
+        return _combine_extraction(confident, tentative, {}, pending)
+    return _combine_extraction(confident, tentative, extracted or {}, pending)
+
+
+@traced("extract_requirements")
+async def _aextract_requirements(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+) -> Dict[str, str]:
+    confident, tentative, pending = _rule_extraction(question, requirements)
+    if not pending:
+        return confident
+    system_prompt, user_prompt = _extraction_request(requirements, question, pending)
+    try:
+        extracted = await acall_llm_parsed(system_prompt, user_prompt, _parse_extraction, history=history, stage="extract")
+    except UpstreamError:
+        current_span().set(fallback="rules")
+        return _combine_extraction(confident, tentative, {}, pending)
+    return _combine_extraction(confident, tentative, extracted or {}, pending)
+
+
 def _merge_requirements(requirements: Dict[str, str], extracted: Dict[str, str]) -> Dict[str, str]:
     merged = dict(requirements)
     for key, value in extracted.items():
@@ -114,15 +160,16 @@ def _merge_requirements(requirements: Dict[str, str], extracted: Dict[str, str])
     return merged
 
 
-def guide_assistant(
+def _extraction_base(question: str, requirements: Dict[str, str]) -> Dict[str, str]:
+    reuse_existing = not _requirements_complete(requirements) or _should_reuse_requirements(question)
+    return requirements if reuse_existing else {}
+
+
+def _finish_guide(
     question: str,
-    history: List[Dict[str, str]],
-    requirements: Dict[str, str],
+    base_requirements: Dict[str, str],
+    extracted: Dict[str, str],
 ) -> Tuple[str, Dict[str, str], bool]:
-    reuse_existing = not _requirements_complete(requirements) or _should_reuse_requirements(question)
-    extraction_requirements = requirements if reuse_existing else {}
-    extracted = _extract_requirements(question, history, extraction_requirements)
-    base_requirements = requirements if reuse_existing else {}
     updated = _merge_requirements(base_requirements, extracted)
     if not _is_filled(updated.get("地域")):
         region_id = resolve_region_id(question)
@@ -134,57 +181,278 @@ def guide_assistant(
     return "", updated, True
 
 
-def recommend_assistant(requirements: Dict[str, str], history: List[Dict[str, str]]) -> str:
-    app_id = os.environ.get("RAG_APP_ID", "")
-    if not app_id:
-        return "未设置 RAG_APP_ID，无法推荐实例规格。"
-    requirement_text = json.dumps(requirements, ensure_ascii=False)
+@traced("guide")
+def guide_assistant(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+    extracted: Optional[Dict[str, str]] = None,
+) -> Tuple[str, Dict[str, str], bool]:
+    base_requirements = _extraction_base(question, requirements)
+    if extracted is None:
+        extracted = _extract_requirements(question, history, base_requirements)
+    else:
+        extracted = {**extracted, **_rule_extraction(question, base_requirements)[0]}
+    return _finish_guide(question, base_requirements, extracted)
+
+
+@traced("guide")
+async def aguide_assistant(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+    extracted: Optional[Dict[str, str]] = None,
+) -> Tuple[str, Dict[str, str], bool]:
+    base_requirements = _extraction_base(question, requirements)
+    if extracted is None:
+        extracted = await _aextract_requirements(question, history, base_requirements)
+    else:
+        extracted = {**extracted, **_rule_extraction(question, base_requirements)[0]}
+    return _finish_guide(question, base_requirements, extracted)
+
+
+CATALOG_ANSWER_MODE = os.environ.get("CATALOG_ANSWER_MODE", "prompt")
+
+
+def _recommend_prompt(requirements: Dict[str, str], candidates: List[Dict[str, Any]]) -> str:
+    # 字段排序后序列化，相同需求生成相同提示词，便于命中 RAG 缓存。
+    requirement_text = json.dumps(requirements, ensure_ascii=False, sort_keys=True)
     prompt = (
         "你是 ECS 实例导购，请基于需求推荐合适的实例规格，并给出推荐理由。\n"
         "请从实例规格族知识库中检索信息，输出 3-5 个候选规格（不足可少于 3 个）。\n"
         f"需求：{requirement_text}"
     )
+    if candidates:
+        prompt += f"\n本地规格目录初筛的候选（请优先在其中挑选并核对参数）：\n{format_candidates(candidates)}"
+    return prompt
+
+
+def _direct_recommendation(candidates: List[Dict[str, Any]]) -> str:
+    return f"根据您的需求，从规格目录中筛选出以下候选（价格为参考价）：\n{format_candidates(candidates)}"
+
+
+def _speculation_target(requirements: Dict[str, str]) -> Optional[Tuple[str, str, str]]:
+    """只差一个可推测的必填字段时，返回 (字段, 按推测值生成的 RAG 提示词, app_id)。
+
+    推荐不走 RAG（直接给目录候选）时本地就很快，不做推测。
+    """
+    if not SPECULATIVE_RECOMMEND_ENABLED:
+        return None
+    missing = [field for field in REQUIRED_FIELDS if not _is_filled(requirements.get(field))]
+    value = speculator.predict(missing[0]) if len(missing) == 1 else ""
+    app_id = os.environ.get("RAG_APP_ID", "")
+    if not value or not app_id:
+        return None
+    predicted = {**requirements, missing[0]: value}
+    candidates = shortlist_candidates(predicted)
+    if candidates and CATALOG_ANSWER_MODE == "direct":
+        return None
+    return missing[0], _recommend_prompt(predicted, candidates), app_id
+
+
+@traced("speculative_recommend")
+def _speculative_recommend(app_id: str, prompt: str) -> str:
     return call_rag_app(app_id, prompt)
 
 
+@traced("speculative_recommend")
+async def _aspeculative_recommend(app_id: str, prompt: str) -> str:
+    return await acall_rag_app(app_id, prompt)
+
+
+def _speculate(session_id: str, requirements: Dict[str, str]) -> None:
+    """在追问最后一个字段的同时，按最可能的回答在后台预取推荐。"""
+    target = _speculation_target(requirements) if session_id else None
+    if target is None:
+        return
+    field, prompt, app_id = target
+    if speculator.start(session_id, prompt, field, lambda: _speculative_recommend(app_id, prompt)):
+        current_span().set(speculated=field)
+
+
+def _aspeculate(session_id: str, requirements: Dict[str, str]) -> None:
+    target = _speculation_target(requirements) if session_id else None
+    if target is None:
+        return
+    field, prompt, app_id = target
+    if speculator.astart(session_id, prompt, field, lambda: _aspeculative_recommend(app_id, prompt)):
+        current_span().set(speculated=field)
+
+
+@traced("recommend")
+def recommend_assistant(
+    requirements: Dict[str, str],
+    history: List[Dict[str, str]],
+    stream: bool = False,
+    session_id: str = "",
+) -> str:
+    """session_id 非空时先认领上一轮的推测任务，提示词一致就直接用它的结果。"""
+    candidates = shortlist_candidates(requirements)
+    app_id = os.environ.get("RAG_APP_ID", "")
+    if candidates and (CATALOG_ANSWER_MODE == "direct" or not app_id):
+        return _direct_recommendation(candidates)
+    if not app_id:
+        return "未设置 RAG_APP_ID，无法推荐实例规格。"
+    prompt = _recommend_prompt(requirements, candidates)
+    job = speculator.claim(session_id, prompt) if session_id else None
+    text = speculator.result(job) if job is not None else None
+    if text is not None:
+        current_span().set(speculation="hit")
+        if stream:
+            emit_text(text)
+        return text
+    try:
+        return call_rag_app(app_id, prompt, stream=stream)
+    except UpstreamError:
+        # RAG 不可用时退回本地目录的候选。
+        if not candidates:
+            raise
+        current_span().set(fallback="catalog")
+        return _direct_recommendation(candidates)
+
+
+@traced("recommend")
+async def arecommend_assistant(
+    requirements: Dict[str, str],
+    history: List[Dict[str, str]],
+    stream: bool = False,
+    session_id: str = "",
+) -> str:
+    candidates = shortlist_candidates(requirements)
+    app_id = os.environ.get("RAG_APP_ID", "")
+    if candidates and (CATALOG_ANSWER_MODE == "direct" or not app_id):
+        return _direct_recommendation(candidates)
+    if not app_id:
+        return "未设置 RAG_APP_ID，无法推荐实例规格。"
+    prompt = _recommend_prompt(requirements, candidates)
+    job = speculator.claim(session_id, prompt) if session_id else None
+    text = await speculator.aresult(job) if job is not None else None
+    if text is not None:
+        current_span().set(speculation="hit")
+        if stream:
+            emit_text(text)
+        return text
+    try:
+        return await acall_rag_app(app_id, prompt, stream=stream)
+    except UpstreamError:
+        if not candidates:
+            raise
+        current_span().set(fallback="catalog")
+        return _direct_recommendation(candidates)
+
+
+SHOPPING_ROUTE_SYSTEM_PROMPT = (
+    "你是导购路由器，需要判断用户是否进入 ECS 导购流程。\n"
+    "只允许输出以下之一：ECSGuideAssistant、Other。"
+)
+
+
+def _normalize_shopping_route(text: str) -> str:
+    signals = intent_signals(text)
+    if "label_guide" in signals:
+        return "ECSGuideAssistant"
+    if "label_other" in signals:
+        return "Other"
+    return ""
+
+
+def _heuristic_shopping_route(question: str, requirements: Dict[str, str]) -> str:
+    if any(requirements.values()):
+        return "ECSGuideAssistant"
+    signals = intent_signals(question)
+    if "buy" in signals or "ecs_word" in signals:
+        return "ECSGuideAssistant"
+    return "Other"
+
+
+@traced("route_shopping")
 def _route_shopping(
     question: str,
     history: List[Dict[str, str]],
     requirements: Dict[str, str],
 ) -> str:
-    system_prompt = (
-        "你是导购路由器，需要判断用户是否进入 ECS 导购流程。\n"
-        "只允许输出以下之一：ECSGuideAssistant、Other。"
-    )
     payload = {"requirements": requirements, "question": question}
     try:
-        text = call_llm(system_prompt, json.dumps(payload, ensure_ascii=False), history=history)
-        normalized = (text or "").strip().lower()
-        if "ecs" in normalized or "guide" in normalized or "导购" in normalized:
-            return "ECSGuideAssistant"
-        if "other" in normalized or "其他" in normalized:
-            return "Other"
+        route = call_llm_parsed(
+            SHOPPING_ROUTE_SYSTEM_PROMPT,
+            json.dumps(payload, ensure_ascii=False),
+            _normalize_shopping_route,
+            history=history,
+            stage="router",
+        )
+        if route:
+            return route
     except Exception:
         pass
-    if any(requirements.values()):
-        return "ECSGuideAssistant"
-    lowered = question.lower()
-    if "推荐" in question or "选型" in question or "购买" in question or "导购" in question:
-        return "ECSGuideAssistant"
-    if re.search(r"\becs\b", lowered):
-        return "ECSGuideAssistant"
-    return "Other"
+    return _heuristic_shopping_route(question, requirements)
 
 
+@traced("route_shopping")
+async def _aroute_shopping(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+) -> str:
+    payload = {"requirements": requirements, "question": question}
+    try:
+        route = await acall_llm_parsed(
+            SHOPPING_ROUTE_SYSTEM_PROMPT,
+            json.dumps(payload, ensure_ascii=False),
+            _normalize_shopping_route,
+            history=history,
+            stage="router",
+        )
+        if route:
+            return route
+    except Exception:
+        pass
+    return _heuristic_shopping_route(question, requirements)
+
+
+@traced("shopping_flow")
 def run_shopping_flow(
     question: str,
     history: List[Dict[str, str]],
     requirements: Dict[str, str],
+    route: Optional[str] = None,
+    extracted: Optional[Dict[str, str]] = None,
+    session_id: str = "",
+) -> Tuple[str, Dict[str, str]]:
+    """route/extracted 由回合规划器预先给出时，跳过对应的 LLM 调用。
+
+    给出 session_id 时，追问最后一个字段的同时在后台预取推荐，下一轮回答与推测一致就不用再等 RAG。
+    """
+    if route not in SHOPPING_ROUTES:
+        route = _route_shopping(question, history, requirements)
+    if route != "ECSGuideAssistant":
+        return general_assistant(question, history, stream=True), requirements
+    reply, updated, ready = guide_assistant(question, history, requirements, extracted)
+    if ready:
+        speculator.observe(updated)
+        reply = recommend_assistant(updated, history, stream=True, session_id=session_id)
+    else:
+        _speculate(session_id, updated)
+    return reply, updated
+
+
+@traced("shopping_flow")
+async def arun_shopping_flow(
+    question: str,
+    history: List[Dict[str, str]],
+    requirements: Dict[str, str],
+    route: Optional[str] = None,
+    extracted: Optional[Dict[str, str]] = None,
+    session_id: str = "",
 ) -> Tuple[str, Dict[str, str]]:
-    route = _route_shopping(question, history, requirements)
+    """route/extracted 由回合规划器预先给出时，跳过对应的 LLM 调用。"""
+    if route not in SHOPPING_ROUTES:
+        route = await _aroute_shopping(question, history, requirements)
     if route != "ECSGuideAssistant":
-        return general_assistant(question, history), requirements
-    reply, updated, ready = guide_assistant(question, history, requirements)
+        return await ageneral_assistant(question, history, stream=True), requirements
+    reply, updated, ready = await aguide_assistant(question, history, requirements, extracted)
     if ready:
-        reply = recommend_assistant(updated, history)
+        speculator.observe(updated)
+        reply = await arecommend_assistant(updated, history, stream=True, session_id=session_id)
+    else:
+        _aspeculate(session_id, updated)
     return reply, updated
@@ -0,0 +1,215 @@
+﻿import asyncio
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from resilience import traffic_class
+
+SPECULATIVE_RECOMMEND_ENABLED = os.environ.get("SPECULATIVE_RECOMMEND", "off") == "on"
+SPECULATION_WORKERS = int(os.environ.get("SPECULATION_WORKERS", "8"))
+SPECULATION_TTL = float(os.environ.get("SPECULATION_TTL", "600"))
+# 可以推测的字段及初始猜测；之后用各字段实际出现最多的取值（初始猜测记一票）。
+SPECULATION_SEEDS = {
+    field: value
+    for field, value in {"地域": os.environ.get("SPECULATE_REGION_ID", "cn-hangzhou")}.items()
+    if value
+}
+
+Handle = Union["Future[str]", "asyncio.Task[str]"]
+
+
+class _Job:
+    __slots__ = ("prompt", "field", "handle", "started")
+
+    def __init__(self, prompt: str, field: str, handle: Handle):
+        self.prompt = prompt
+        self.field = field
+        self.handle = handle
+        self.started = time.monotonic()
+
+
+def _cancel(handle: Handle) -> None:
+    if isinstance(handle, asyncio.Task):
+        loop = handle.get_loop()
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(handle.cancel)
+    else:
+        handle.cancel()
+
+
+class Speculator:
+    """在导购只差最后一个字段时提前发起推荐调用；每个会话最多一个推测任务，下一轮按提示词认领。
+
+    提示词完全一致才算命中，否则取消或丢弃。后台调用按 background 流量排队，配额紧张时让位于交互式回合。
+    """
+
+    def __init__(self, workers: int = SPECULATION_WORKERS, ttl: float = SPECULATION_TTL):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="speculation")
+        self._ttl = ttl
+        self._jobs: Dict[str, _Job] = {}
+        self._values: Dict[str, Counter] = {field: Counter({value: 1}) for field, value in SPECULATION_SEEDS.items()}
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._fields: Dict[str, Counter] = {}
+        self._wait_ms = 0.0
+
+    def predict(self, field: str) -> str:
+        """字段最可能的取值；不在可推测字段中时返回空串。"""
+        with self._lock:
+            values = self._values.get(field)
+            return values.most_common(1)[0][0] if values else ""
+
+    def observe(self, requirements: Dict[str, str]) -> None:
+        """记录需求收集完成时各可推测字段的实际取值。"""
+        with self._lock:
+            for field, values in self._values.items():
+                value = requirements.get(field)
+                if value:
+                    values[value] += 1
+
+    def _replace(self, session_id: str, prompt: str) -> bool:
+        """清理过期任务；会话已有同一提示词的任务时返回 False。调用方需持有锁。"""
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if now - job.started > self._ttl:
+                del self._jobs[key]
+                _cancel(job.handle)
+                self._counts["expired"] += 1
+        previous = self._jobs.get(session_id)
+        if previous is not None:
+            if previous.prompt == prompt:
+                return False
+            del self._jobs[session_id]
+            _cancel(previous.handle)
+            self._counts["replaced"] += 1
+        return True
+
+    def start(self, session_id: str, prompt: str, field: str, call: Callable[[], str]) -> bool:
+        """在后台线程执行 call；返回是否新提交了任务。"""
+        with self._lock:
+            if not self._replace(session_id, prompt):
+                return False
+            future = self._pool.submit(copy_context().run, _in_background, call)
+            self._jobs[session_id] = _Job(prompt, field, future)
+            self._counts["started"] += 1
+        return True
+
+    def astart(self, session_id: str, prompt: str, field: str, call: Callable[[], Awaitable[str]]) -> bool:
+        """在当前事件循环中以任务执行 call；返回是否新提交了任务。"""
+
+        async def _run() -> str:
+            with traffic_class("background"):
+                return await call()
+
+        with self._lock:
+            if not self._replace(session_id, prompt):
+                return False
+            self._jobs[session_id] = _Job(prompt, field, asyncio.ensure_future(_run()))
+            self._counts["started"] += 1
+        return True
+
+    def claim(self, session_id: str, prompt: str) -> Optional[_Job]:
+        """取走会话的推测任务：提示词一致时返回它，否则取消并计为未命中。"""
+        with self._lock:
+            job = self._jobs.pop(session_id, None)
+            if job is None:
+                return None
+            hit = job.prompt == prompt
+            self._counts["hits" if hit else "misses"] += 1
+            self._fields.setdefault(job.field, Counter())["hits" if hit else "misses"] += 1
+        if not hit:
+            _cancel(job.handle)
+            return None
+        return job
+
+    def _settle(self, started: float, text: Optional[str]) -> Optional[str]:
+        with self._lock:
+            self._wait_ms += (time.monotonic() - started) * 1000
+            if text is None:
+                self._counts["failed"] += 1
+        return text
+
+    def _unstarted(self, handle: Handle) -> bool:
+        """线程池中还在排队的任务直接取消，由调用方重新发起，不必排在其他推测任务后面。"""
+        if isinstance(handle, asyncio.Task) or not handle.cancel():
+            return False
+        self._count("unstarted")
+        return True
+
+    def result(self, job: _Job) -> Optional[str]:
+        """等待已认领任务的结果；失败、尚未开始或无法在同步代码中等待（其他事件循环的任务）时返回 None。"""
+        started = time.monotonic()
+        handle = job.handle
+        if self._unstarted(handle):
+            return None
+        if not handle.done():
+            self._count("joined")
+            if isinstance(handle, asyncio.Task):
+                return self._settle(started, None)
+        try:
+            return self._settle(started, handle.result() or None)
+        except BaseException:
+            return self._settle(started, None)
+
+    async def aresult(self, job: _Job) -> Optional[str]:
+        """result 的异步版本。"""
+        started = time.monotonic()
+        handle = job.handle
+        if self._unstarted(handle):
+            return None
+        if not handle.done():
+            self._count("joined")
+            if isinstance(handle, asyncio.Task) and handle.get_loop() is not asyncio.get_running_loop():
+                return self._settle(started, None)
+        try:
+            # shield：本轮被取消时不连带取消推测任务，由 CancelledError 区分是谁被取消。
+            text = await asyncio.shield(handle if isinstance(handle, asyncio.Task) else asyncio.wrap_future(handle))
+            return self._settle(started, text or None)
+        except asyncio.CancelledError:
+            if handle.cancelled():
+                return self._settle(started, None)
+            raise
+        except Exception:
+            return self._settle(started, None)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def discard(self, session_id: str) -> None:
+        """丢弃会话的推测任务（如用户重置了对话）。"""
+        with self._lock:
+            job = self._jobs.pop(session_id, None)
+            if job is not None:
+                self._counts["discarded"] += 1
+        if job is not None:
+            _cancel(job.handle)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._counts)
+            claimed = counts.get("hits", 0) + counts.get("misses", 0)
+            return {
+                **counts,
+                "pending": len(self._jobs),
+                "hit_rate": round(counts.get("hits", 0) / claimed, 3) if claimed else None,
+                "avg_wait_ms": round(self._wait_ms / counts["hits"], 1) if counts.get("hits") else None,
+                "fields": {field: dict(tally) for field, tally in self._fields.items()},
+                "predictions": {field: values.most_common(1)[0][0] for field, values in self._values.items()},
+            }
+
+
+def _in_background(call: Callable[[], str]) -> str:
+    with traffic_class("background"):
+        return call()
+
+
+speculator = Speculator()
+
+
+def speculation_stats() -> Dict[str, Any]:
+    return speculator.stats()
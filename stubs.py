@@ -0,0 +1,373 @@
+﻿import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Union
+
+import tools
+from helpers import REGION_ALIASES
+from planning import ROUTE_SYSTEM_PROMPT, TURN_PLAN_SYSTEM_PROMPT, heuristic_flow
+from resilience import UpstreamError
+from resource_flow import PLANNER_SYSTEM_PROMPT, _heuristic_agent_order
+from shopping_flow import EXTRACTION_FIELDS, SHOPPING_ROUTE_SYSTEM_PROMPT, _heuristic_shopping_route
+
+STUB_REGIONS = ("cn-hangzhou", "cn-beijing", "cn-shanghai")
+STUB_INSTANCE_TYPES = ("ecs.g7.large", "ecs.c7.xlarge", "ecs.r7.2xlarge")
+STUB_CHUNK_SIZE = 8
+
+_SCENE_KEYWORDS = ("web", "网站", "数据库", "缓存", "大数据", "推理", "游戏", "视频")
+
+Latency = Union[float, str, Callable[[], float]]
+
+
+def latency_sampler(spec: Latency, seed: int = 0) -> Callable[[], float]:
+    """把延迟描述转成采样函数（单位：秒）。
+
+    支持：数字（固定延迟）、"uniform:低:高"、"normal:均值:标准差"、"lognormal:中位数:sigma"。
+    """
+    if callable(spec):
+        return spec
+    text = str(spec).strip()
+    kind, _, rest = text.partition(":")
+    rng = random.Random(seed)
+    if not rest:
+        value = float(kind or 0)
+        return lambda: value
+    params = [float(item) for item in rest.split(":")]
+    if kind == "uniform":
+        return lambda: rng.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda: params[0] * rng.lognormvariate(0.0, params[1])
+    raise ValueError(f"未知的延迟分布：{text}")
+
+
+def _sleep(seconds: float) -> None:
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def _stub_extraction(question: str) -> Dict[str, str]:
+    """用正则粗略抽取导购字段，只为让离线对话能推进到推荐环节。"""
+    lowered = question.lower()
+    result = {field: "" for field in EXTRACTION_FIELDS}
+    for keyword in _SCENE_KEYWORDS:
+        if keyword in lowered:
+            result["场景"] = keyword
+            break
+    if match := re.search(r"(\d+(?:\s*-\s*\d+)?)\s*(?:核|vcpu|c\b)", lowered):
+        result["vCPU"] = match.group(1).replace(" ", "")
+    if match := re.search(r"(\d+(?:\s*-\s*\d+)?)\s*(?:g|gb|gib)\b", lowered):
+        result["内存"] = f"{match.group(1).replace(' ', '')}GB"
+    if match := re.search(r"(\d+)\s*元", question):
+        result["预算"] = match.group(1)
+    for alias, region_id in REGION_ALIASES.items():
+        if alias in lowered:
+            result["地域"] = region_id
+            break
+    if "arm" in lowered or "倚天" in question:
+        result["架构"] = "arm"
+    return result
+
+
+def stub_reply(system_prompt: str, user_prompt: str) -> str:
+    """按阶段（由系统提示词识别）返回格式正确的假回复，决策复用各模块的启发式规则。"""
+    try:
+        payload = json.loads(user_prompt)
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    question = str(payload.get("question") or payload.get("用户输入") or user_prompt)
+    requirements = payload.get("requirements") or payload.get("已收集需求") or {}
+    if system_prompt == TURN_PLAN_SYSTEM_PROMPT:
+        extracted = _stub_extraction(question)
+        known = {**requirements, **{key: value for key, value in extracted.items() if value}}
+        flow = heuristic_flow(question, known)
+        plan: Dict[str, Any] = {"flow": flow, "requirements": extracted}
+        if flow == "ShoppingFlow":
+            plan["shopping_route"] = _heuristic_shopping_route(question, known)
+        elif flow == "ResourceFlow":
+            plan["resource_agents"] = [dict(step) for step in _heuristic_agent_order(question)]
+        return json.dumps(plan, ensure_ascii=False)
+    if system_prompt == ROUTE_SYSTEM_PROMPT:
+        return heuristic_flow(question, requirements)
+    if system_prompt == SHOPPING_ROUTE_SYSTEM_PROMPT:
+        return _heuristic_shopping_route(question, requirements)
+    if system_prompt == PLANNER_SYSTEM_PROMPT:
+        return json.dumps([dict(step) for step in _heuristic_agent_order(question)], ensure_ascii=False)
+    if system_prompt.startswith("你是信息抽取器"):
+        return json.dumps(_stub_extraction(question), ensure_ascii=False)
+    return f"（离线桩回复）已收到：{question[-60:]}"
+
+
+def _chunks(text: str) -> List[str]:
+    return [text[index:index + STUB_CHUNK_SIZE] for index in range(0, len(text), STUB_CHUNK_SIZE)] or [""]
+
+
+def _llm_output(text: str) -> Dict[str, Any]:
+    return {"choices": [{"message": {"role": "assistant", "content": text}}]}
+
+
+def _unavailable_error() -> UpstreamError:
+    return UpstreamError("离线桩注入故障：ServiceUnavailable", "ServiceUnavailable", 503)
+
+
+def _unavailable(stream: bool) -> Any:
+    """模拟 DashScope SDK 的失败应答：不抛异常，而是返回非 200 的响应。"""
+    response = SimpleNamespace(status_code=503, code="ServiceUnavailable", message="离线桩注入故障", output=None)
+    return iter([response]) if stream else response
+
+
+def _throttled_error() -> UpstreamError:
+    return UpstreamError("离线桩限流：Throttling", "Throttling", 429)
+
+
+def _throttled(stream: bool) -> Any:
+    response = SimpleNamespace(status_code=429, code="Throttling", message="离线桩限流", output=None)
+    return iter([response]) if stream else response
+
+
+def _rag_answer(prompt: str) -> str:
+    return f"（离线桩 RAG）推荐结果，依据：{prompt[-80:]}"
+
+
+class StubBackends:
+    """替换 DashScope 与 OpenAPI 的离线桩，记录调用次数与提示词字符数，延迟见 latency_sampler。
+
+    model_latency 按模型名覆盖 LLM 延迟（如让快速模型更快），未列出的模型使用 llm_latency。
+    failure_rate/stall_rate 用于故障注入：按比例让调用返回 503，或额外卡顿 stall_seconds 秒。
+    llm_qps 模拟服务端配额：最近 1 秒内的 LLM 调用数超过它时，立即返回 429 Throttling（0 表示不限）。
+    """
+
+    def __init__(
+        self,
+        llm_latency: Latency = 0.0,
+        rag_latency: Latency = 0.0,
+        openapi_latency: Latency = 0.0,
+        instances_per_region: int = 25,
+        seed: int = 0,
+        answer_chars: int = 0,
+        failure_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_seconds: float = 0.0,
+        model_latency: Optional[Dict[str, Latency]] = None,
+        llm_qps: float = 0.0,
+    ) -> None:
+        self.llm_latency = latency_sampler(llm_latency, seed)
+        self.rag_latency = latency_sampler(rag_latency, seed + 1)
+        self.openapi_latency = latency_sampler(openapi_latency, seed + 2)
+        self.model_latency = {
+            model: latency_sampler(spec, seed + 4 + index) for index, (model, spec) in enumerate((model_latency or {}).items())
+        }
+        self.instances_per_region = instances_per_region
+        self.answer_chars = answer_chars
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.llm_qps = llm_qps
+        self._llm_window: Deque[float] = deque()
+        self.calls: Dict[str, int] = {"llm": 0, "rag": 0, "openapi": 0}
+        self.model_calls: Dict[str, int] = {}
+        self.faults: Dict[str, int] = {"failures": 0, "stalls": 0, "throttled": 0}
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+        self._fault_rng = random.Random(seed + 3)
+
+    def _count(self, kind: str, prompt_chars: int = 0, model: str = "") -> None:
+        with self._lock:
+            self.calls[kind] += 1
+            self.prompt_chars += prompt_chars
+            if model:
+                self.model_calls[model] = self.model_calls.get(model, 0) + 1
+
+    def _llm_latency(self, model: str) -> float:
+        return self.model_latency.get(model, self.llm_latency)()
+
+    def _fault(self) -> str:
+        """按注入比例决定本次调用是否失败（"fail"）或卡顿（"stall"），正常时返回空字符串。"""
+        with self._lock:
+            roll = self._fault_rng.random()
+            if roll < self.failure_rate:
+                self.faults["failures"] += 1
+                return "fail"
+            if roll < self.failure_rate + self.stall_rate:
+                self.faults["stalls"] += 1
+                return "stall"
+        return ""
+
+    def _over_quota(self) -> bool:
+        """服务端限流：滑动 1 秒窗口内的 LLM 调用数超过 llm_qps 时拒绝本次调用（被拒的调用不计入窗口）。"""
+        if not self.llm_qps:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._llm_window and now - self._llm_window[0] >= 1.0:
+                self._llm_window.popleft()
+            if len(self._llm_window) >= self.llm_qps:
+                self.faults["throttled"] += 1
+                return True
+            self._llm_window.append(now)
+        return False
+
+    def _stall(self, fault: str) -> float:
+        return self.stall_seconds if fault == "stall" else 0.0
+
+    def _pad(self, text: str) -> str:
+        """把自由文本回复补到 answer_chars 长度，模拟真实回答的篇幅；JSON/路由类回复不变。"""
+        if not text.startswith("（离线桩") or len(text) >= self.answer_chars:
+            return text
+        filler = "。补充说明：该规格适合中小型业务，可按需升降配"
+        return text + (filler * (self.answer_chars // len(filler) + 1))[: self.answer_chars - len(text)]
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.calls, "prompt_chars": self.prompt_chars, **self.faults}
+
+    # ---- DashScope 同步 SDK ----
+
+    def _generation_call(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **_: Any) -> Any:
+        self._count("llm", sum(len(message["content"]) for message in messages), model)
+        if self._over_quota():
+            return _throttled(stream)
+        fault = self._fault()
+        text = self._pad(stub_reply(messages[0]["content"], messages[-1]["content"]))
+        _sleep(self._llm_latency(model) + self._stall(fault))
+        if fault == "fail":
+            return _unavailable(stream)
+        if stream:
+            return iter([SimpleNamespace(status_code=200, output=_llm_output(chunk)) for chunk in _chunks(text)])
+        return SimpleNamespace(status_code=200, output=_llm_output(text))
+
+    def _application_call(self, app_id: str, prompt: str, stream: bool = False, **_: Any) -> Any:
+        self._count("rag", len(prompt))
+        fault = self._fault()
+        text = self._pad(_rag_answer(prompt))
+        _sleep(self.rag_latency() + self._stall(fault))
+        if fault == "fail":
+            return _unavailable(stream)
+        if stream:
+            return iter([SimpleNamespace(status_code=200, output={"text": chunk}) for chunk in _chunks(text)])
+        return SimpleNamespace(status_code=200, output={"text": text})
+
+    # ---- DashScope HTTP（异步路径）----
+
+    def _reply_for(self, path: str, payload: Dict[str, Any]) -> str:
+        if path.startswith("apps/"):
+            self._count("rag", len(payload["input"]["prompt"]))
+            return self._pad(_rag_answer(payload["input"]["prompt"]))
+        messages = payload["input"]["messages"]
+        self._count("llm", sum(len(message["content"]) for message in messages), payload.get("model", ""))
+        return self._pad(stub_reply(messages[0]["content"], messages[-1]["content"]))
+
+    def _latency_for(self, path: str, payload: Dict[str, Any]) -> float:
+        return self.rag_latency() if path.startswith("apps/") else self._llm_latency(payload.get("model", ""))
+
+    async def _apost(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        text = self._reply_for(path, payload)
+        if not path.startswith("apps/") and self._over_quota():
+            raise _throttled_error()
+        fault = self._fault()
+        await asyncio.sleep(self._latency_for(path, payload) + self._stall(fault))
+        if fault == "fail":
+            raise _unavailable_error()
+        if path.startswith("apps/"):
+            return {"output": {"text": text}}
+        return {"output": _llm_output(text)}
+
+    async def _astream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        text = self._reply_for(path, payload)
+        if not path.startswith("apps/") and self._over_quota():
+            raise _throttled_error()
+        fault = self._fault()
+        await asyncio.sleep(self._latency_for(path, payload) + self._stall(fault))
+        if fault == "fail":
+            raise _unavailable_error()
+        for chunk in _chunks(text):
+            yield {"output": {"text": chunk}} if path.startswith("apps/") else {"output": _llm_output(chunk)}
+
+    # ---- OpenAPI ----
+
+    def _openapi_call(self) -> None:
+        self._count("openapi")
+        fault = self._fault()
+        _sleep(self.openapi_latency() + self._stall(fault))
+        if fault == "fail":
+            raise _unavailable_error()
+
+    def _ecs_client(self, region_id: str) -> Any:
+        backends = self
+
+        class _Client:
+            def describe_regions_with_options(self, request: Any, runtime: Any) -> Any:
+                backends._openapi_call()
+                regions = [SimpleNamespace(region_id=region) for region in STUB_REGIONS]
+                return SimpleNamespace(body=SimpleNamespace(regions=SimpleNamespace(region=regions)))
+
+            def describe_instances_with_options(self, request: Any, runtime: Any) -> Any:
+                backends._openapi_call()
+                page_size = request.max_results or request.page_size or 10
+                start = int(request.next_token or 0)
+                end = min(start + page_size, backends.instances_per_region)
+                items = [
+                    SimpleNamespace(
+                        instance_id=f"i-{region_id}-{index:04d}",
+                        instance_type=STUB_INSTANCE_TYPES[index % len(STUB_INSTANCE_TYPES)],
+                        status="Running" if index % 5 else "Stopped",
+                        zone_id=f"{region_id}-{'abc'[index % 3]}",
+                    )
+                    for index in range(start, end)
+                ]
+                next_token = str(end) if end < backends.instances_per_region and request.max_results else None
+                return SimpleNamespace(
+                    body=SimpleNamespace(instances=SimpleNamespace(instance=items), next_token=next_token)
+                )
+
+        return _Client()
+
+    def _bss_client(self) -> Any:
+        backends = self
+
+        class _Client:
+            def query_account_balance_with_options(self, runtime: Any) -> Any:
+                backends._openapi_call()
+                data = SimpleNamespace(
+                    available_amount="1024.00",
+                    currency="CNY",
+                    credit_amount="0.00",
+                    mybank_credit_amount="0.00",
+                    available_cash_amount="1024.00",
+                )
+                return SimpleNamespace(body=SimpleNamespace(data=data))
+
+        return _Client()
+
+    def install(self) -> "StubBackends":
+        """把桩挂到 tools 模块上；进程内生效，不可撤销，仅用于本地联调与压测。"""
+        os.environ.setdefault("DASHSCOPE_API_KEY", "stub")
+        os.environ.setdefault("RAG_APP_ID", "stub-app")
+        os.environ.setdefault("ALIBABA_CLOUD_ACCESS_KEY_ID", "stub")
+        os.environ.setdefault("ALIBABA_CLOUD_ACCESS_KEY_SECRET", "stub")
+        tools.Generation = SimpleNamespace(call=self._generation_call)
+        tools.Application = SimpleNamespace(call=self._application_call)
+        tools._apost_dashscope = self._apost
+        tools._astream_dashscope = self._astream
+        tools.ECS._client = staticmethod(self._ecs_client)
+        tools.Billing._client = staticmethod(self._bss_client)
+        # 桩的回复不能写进真实的 RAG 缓存。
+        tools.rag_cache = tools.RagResponseCache("", 0, 0)
+        return self
+
+
+def install_stub_backends(
+    llm_latency: Latency = 0.0,
+    rag_latency: Latency = 0.0,
+    openapi_latency: Latency = 0.0,
+) -> StubBackends:
+    return StubBackends(llm_latency, rag_latency, openapi_latency).install()
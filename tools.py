@@ -1,13 +1,90 @@
-﻿import os
+﻿import asyncio
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from http import HTTPStatus
-from typing import Any, Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
-from alibabacloud_bssopenapi20171214.client import Client as BssOpenApi20171214Client
-from alibabacloud_ecs20140526.client import Client as Ecs20140526Client
-from alibabacloud_ecs20140526 import models as ecs_models
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_tea_util import models as util_models
-from dashscope import Application, Generation
+from helpers import HISTORY_TOKEN_BUDGETS, SUMMARY_ROLE, estimate_tokens, fit_history
+from resilience import RETRYABLE_STATUS, UPSTREAM_TIMEOUTS, UpstreamError, call_priority, check_stream, upstream
+from tracing import current_span, record_usage, span, traced, usage_tokens
+
+# dashscope、aiohttp 与阿里云 OpenAPI SDK 导入较慢，且多数会话用不到 OpenAPI，均在首次使用时导入。
+if TYPE_CHECKING:
+    import aiohttp
+
+T = TypeVar("T")
+
+DEFAULT_HTTP_BASE_URL = "https://dashscope.aliyuncs.com/api/v1"
+DEFAULT_MODEL = os.environ.get("DASHSCOPE_MODEL", "qwen-plus")
+FAST_MODEL = os.environ.get("DASHSCOPE_FAST_MODEL", "qwen-turbo")
+MODEL_TIERING_ENABLED = os.environ.get("MODEL_TIERING", "on") != "off"
+# 配额预扣时对输出 token 数的估计（阶段未限制 max_tokens 时使用），调用结束后按实际用量修正。
+LLM_OUTPUT_TOKEN_ESTIMATE = 512
+RAG_OUTPUT_TOKEN_ESTIMATE = 1024
+HTTP_POOL_SIZE = int(os.environ.get("DASHSCOPE_HTTP_POOL_SIZE", "100"))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("DASHSCOPE_HTTP_TIMEOUT", "120"))
+RAG_CACHE_PATH = os.environ.get("RAG_CACHE_PATH", os.path.join(".cache", "rag_responses.sqlite3"))
+RAG_CACHE_TTL = float(os.environ.get("RAG_CACHE_TTL", "86400"))
+RAG_CACHE_MAX_ENTRIES = int(os.environ.get("RAG_CACHE_MAX_ENTRIES", "5000"))
+
+OPENAPI_MAX_IDLE_CONNS = int(os.environ.get("OPENAPI_MAX_IDLE_CONNS", "16"))
+OPENAPI_CACHE_SIZE = int(os.environ.get("OPENAPI_CACHE_SIZE", "256"))
+OPENAPI_CACHE_TTLS = {
+    "balance": float(os.environ.get("OPENAPI_CACHE_TTL_BALANCE", "30")),
+    "instances": float(os.environ.get("OPENAPI_CACHE_TTL_INSTANCES", "60")),
+    "regions": float(os.environ.get("OPENAPI_CACHE_TTL_REGIONS", "3600")),
+}
+ECS_PAGE_SIZE = 100
+ECS_FANOUT_WORKERS = int(os.environ.get("ECS_FANOUT_WORKERS", "8"))
+
+_token_sink: ContextVar[Optional[Callable[[str], None]]] = ContextVar("token_sink", default=None)
+_http_session: Optional["aiohttp.ClientSession"] = None
+_http_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+_client_lock = threading.Lock()
+_clients: Dict[str, Tuple[Tuple[str, ...], Any]] = {}
+
+# 首次调用 LLM/RAG 时由 _load_dashscope 填充；离线桩会直接替换这两个名字。
+Generation: Any = None
+Application: Any = None
+
+
+def _load_dashscope() -> None:
+    global Generation, Application
+    if Generation is None or Application is None:
+        import dashscope
+
+        Generation = Generation or dashscope.Generation
+        Application = Application or dashscope.Application
+
+
+def _ecs_models() -> Any:
+    from alibabacloud_ecs20140526 import models
+
+    return models
 
 
 def _require_env(name: str) -> str:
@@ -18,48 +95,76 @@ def _require_env(name: str) -> str:
     return value
 
 
-def call_llm(
+def _build_messages(
     system_prompt: str,
     user_prompt: str,
-    model: Optional[str] = None,
-    history: Optional[List[Dict[str, str]]] = None,
-) -> str:
-    """统一封装 DashScope 文本生成调用。"""
-    model_name = model or os.environ.get("DASHSCOPE_MODEL", "qwen-plus")
+    history: Optional[List[Dict[str, str]]],
+    stage: str = "answer",
+) -> List[Dict[str, str]]:
+    """按 stage 对应的 token 预算裁剪历史；滚动摘要并入系统提示词。"""
     messages = [{"role": "system", "content": system_prompt}]
     if history:
-        for msg in history:
+        for msg in fit_history(history, HISTORY_TOKEN_BUDGETS.get(stage, HISTORY_TOKEN_BUDGETS["answer"])):
             role = msg.get("role")
             content = msg.get("content")
-            if role in ("user", "assistant") and content:
+            if role == SUMMARY_ROLE and content:
+                messages[0]["content"] = f"{system_prompt}\n\n此前对话摘要：{content}"
+            elif role in ("user", "assistant") and content:
                 messages.append({"role": role, "content": content})
     messages.append({"role": "user", "content": user_prompt})
+    return messages
 
-    response = Generation.call(
-        model=model_name,
-        messages=messages,
-        result_format="message",
-    )
-    status_code = getattr(response, "status_code", None)
-    if status_code and status_code != HTTPStatus.OK:
-        raise RuntimeError(
-            f"DashScope 调用失败：{getattr(response, 'code', '')} {getattr(response, 'message', '')}"
-        )
-    output = getattr(response, "output", None)
+
+def _llm_content(output: Any) -> str:
     if isinstance(output, dict):
         choices = output.get("choices") or []
         if choices:
             message = choices[0].get("message") or {}
-            content = message.get("content")
-            if content:
-                return content
-    return str(output or response)
+            return message.get("content") or ""
+    return ""
+
+
+def _llm_text(output: Any, fallback: Any) -> str:
+    return _llm_content(output) or str(output or fallback)
+
+
+def _check_response(response: Any) -> None:
+    status_code = getattr(response, "status_code", None)
+    if status_code and status_code != HTTPStatus.OK:
+        code = getattr(response, "code", "") or ""
+        raise UpstreamError(f"DashScope 调用失败：{code} {getattr(response, 'message', '')}", code, int(status_code))
+
+
+def _dashscope_error(data: Any, status: int = 0) -> UpstreamError:
+    data = data if isinstance(data, dict) else {}
+    code = str(data.get("code", "") or "")
+    return UpstreamError(f"DashScope 调用失败：{code} {data.get('message', '')}", code, status)
+
+
+@contextmanager
+def stream_tokens(sink: Callable[[str], None]) -> Iterator[None]:
+    """在上下文内把 stream=True 的调用增量输出交给 sink。"""
+    token = _token_sink.set(sink)
+    try:
+        yield
+    finally:
+        _token_sink.reset(token)
+
 
+def emit_text(text: str) -> None:
+    """把已经拿到的完整回复交给当前 sink（如预取的结果），没有 sink 时什么也不做。"""
+    sink = _token_sink.get()
+    if sink is not None and text:
+        sink(text)
 
-def call_rag_app(app_id: str, prompt: str) -> str:
-    """调用 DashScope RAG 应用并抽取文本。"""
-    response = Application.call(app_id=app_id, prompt=prompt)
-    output = getattr(response, "output", None)
+
+def _rag_delta(output: Any) -> str:
+    if isinstance(output, dict):
+        return str(output.get("text") or "")
+    return str(getattr(output, "text", None) or "")
+
+
+def _rag_text(output: Any, fallback: Any) -> str:
     if isinstance(output, dict):
         for key in ("text", "answer", "result"):
             if key in output and output[key]:
@@ -67,35 +172,695 @@ def call_rag_app(app_id: str, prompt: str) -> str:
     text = getattr(output, "text", None)
     if text:
         return str(text)
-    return str(output or response)
+    return str(output or fallback)
 
 
-class ECS:
-    """ECS OpenAPI 封装。"""
+_INSTANCE_TYPE_PATTERN = re.compile(
+    r"\b(?:ecs\.)?([a-z][a-z0-9-]*\d[a-z0-9-]*)\.(nano|micro|small|medium|large|\d*xlarge)\b",
+    re.I,
+)
+
+
+def normalize_rag_prompt(prompt: str) -> str:
+    """规范化 RAG 提示词作为缓存 key：统一实例规格写法并压缩空白。"""
+    text = _INSTANCE_TYPE_PATTERN.sub(
+        lambda match: f"ecs.{match.group(1).lower()}.{match.group(2).lower()}",
+        prompt or "",
+    )
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class RagResponseCache:
+    """基于 SQLite 的 RAG 应答磁盘缓存。
+
+    版本标签由 RAG_APP_ID 与 RAG_KB_VERSION 组成，知识库更新后调整 RAG_KB_VERSION 即可使旧结果失效。
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.ttl > 0 and self.max_entries > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rag_cache ("
+                "key TEXT PRIMARY KEY, version TEXT NOT NULL, response TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS rag_cache_accessed ON rag_cache (accessed_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _version(app_id: str) -> str:
+        return f"{app_id}:{os.environ.get('RAG_KB_VERSION', '')}"
 
     @staticmethod
-    def _client(region_id: str) -> Ecs20140526Client:
-        access_key_id = _require_env("ALIBABA_CLOUD_ACCESS_KEY_ID")
-        access_key_secret = _require_env("ALIBABA_CLOUD_ACCESS_KEY_SECRET")
+    def _key(app_id: str, prompt: str) -> str:
+        return hashlib.sha256(f"{app_id}\n{normalize_rag_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def get(self, app_id: str, prompt: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response FROM rag_cache WHERE key = ? AND version = ? AND expires_at > ?",
+                (self._key(app_id, prompt), self._version(app_id), now),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE rag_cache SET accessed_at = ? WHERE key = ?", (now, self._key(app_id, prompt)))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, app_id: str, prompt: str, response: str) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        version = self._version(app_id)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO rag_cache (key, version, response, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self._key(app_id, prompt), version, response, now + self.ttl, now),
+            )
+            # 清理过期条目与同一应用旧版本知识库的结果。
+            conn.execute(
+                "DELETE FROM rag_cache WHERE expires_at <= ? OR (version LIKE ? AND version != ?)",
+                (now, f"{app_id}:%", version),
+            )
+            conn.execute(
+                "DELETE FROM rag_cache WHERE key IN (SELECT key FROM rag_cache "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+
+    def clear(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM rag_cache")
+            conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+rag_cache = RagResponseCache(RAG_CACHE_PATH, RAG_CACHE_TTL, RAG_CACHE_MAX_ENTRIES)
+
+
+def _prompt_chars(messages: List[Dict[str, str]]) -> int:
+    return sum(len(message.get("content") or "") for message in messages)
+
+
+class StageModel(NamedTuple):
+    """某个调用阶段使用的模型与生成参数；max_tokens/temperature 为 None 时用模型默认值。"""
+
+    model: str
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+
+    def parameters(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {}
+        if self.max_tokens is not None:
+            params["max_tokens"] = self.max_tokens
+        if self.temperature is not None:
+            params["temperature"] = self.temperature
+        return params
+
+
+def _stage_model(stage: str, model: str, max_tokens: Optional[int] = None, temperature: Optional[float] = None) -> StageModel:
+    """DASHSCOPE_MODEL_<STAGE>、LLM_MAX_TOKENS_<STAGE>、LLM_TEMPERATURE_<STAGE> 可覆盖默认值。"""
+    suffix = stage.upper()
+    max_tokens_text = os.environ.get(f"LLM_MAX_TOKENS_{suffix}", "")
+    temperature_text = os.environ.get(f"LLM_TEMPERATURE_{suffix}", "")
+    return StageModel(
+        os.environ.get(f"DASHSCOPE_MODEL_{suffix}", model),
+        int(max_tokens_text) if max_tokens_text else max_tokens,
+        float(temperature_text) if temperature_text else temperature,
+    )
+
+
+# 路由/规划/抽取只输出标签或短 JSON，用快速模型并限制输出长度；面向用户的回答与摘要用主模型。
+STAGE_MODELS = {
+    "router": _stage_model("router", FAST_MODEL, 16, 0.0),
+    "plan": _stage_model("plan", FAST_MODEL, 320, 0.0),
+    "extract": _stage_model("extract", FAST_MODEL, 200, 0.0),
+    "summary": _stage_model("summary", DEFAULT_MODEL),
+    "answer": _stage_model("answer", DEFAULT_MODEL),
+}
+
+
+def _quota_request(stage: str, prompt_tokens: int, output_tokens: int) -> Dict[str, int]:
+    """上游配额排队用的优先级与预扣 token 数。"""
+    return {"priority": call_priority(stage), "tokens": prompt_tokens + output_tokens}
+
+
+def _settle_usage(name: str, quota: Dict[str, int], usage: Any) -> None:
+    """按成功那次尝试的实际用量修正预扣；没有返回用量时保留估计值，而不是当作 0 全部退还。"""
+    record_usage(usage)
+    input_tokens, output_tokens = usage_tokens(usage)
+    actual = (input_tokens or 0) + (output_tokens or 0)
+    if actual > 0:
+        upstream(name).refund_tokens(quota["tokens"], actual)
+
+
+def stage_model(stage: str) -> StageModel:
+    if not MODEL_TIERING_ENABLED:
+        return StageModel(DEFAULT_MODEL)
+    return STAGE_MODELS.get(stage, STAGE_MODELS["answer"])
+
+
+@traced("call_llm", kind="llm")
+def call_llm(
+    system_prompt: str,
+    user_prompt: str,
+    model: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    stream: bool = False,
+    stage: str = "answer",
+) -> str:
+    """统一封装 DashScope 文本生成调用。
+
+    stream=True 且处于 stream_tokens 上下文时，增量输出会实时交给 sink，返回值仍为完整文本。
+    stage 取 router/plan/extract/answer/summary，决定带入多少历史以及使用的模型（见 STAGE_MODELS）；
+    指定 model 时使用该模型且不限制输出长度。
+    """
+    _load_dashscope()
+    tier = StageModel(model) if model else stage_model(stage)
+    model_name, parameters = tier.model, tier.parameters()
+    messages = _build_messages(system_prompt, user_prompt, history, stage)
+    quota = _quota_request(
+        stage,
+        sum(estimate_tokens(message["content"]) for message in messages),
+        tier.max_tokens or LLM_OUTPUT_TOKEN_ESTIMATE,
+    )
+    sink = _token_sink.get() if stream else None
+    current_span().set(model=model_name, prompt_chars=_prompt_chars(messages), stream=sink is not None)
+
+    if sink is not None:
+        emitted: List[str] = []
+
+        def _stream() -> Tuple[str, Any]:
+            usage = None
+            for response in Generation.call(
+                model=model_name,
+                messages=messages,
+                result_format="message",
+                stream=True,
+                incremental_output=True,
+                **parameters,
+            ):
+                _check_response(response)
+                usage = getattr(response, "usage", None) or usage
+                delta = _llm_content(getattr(response, "output", None))
+                if delta:
+                    check_stream()
+                    emitted.append(delta)
+                    sink(delta)
+            return "".join(emitted), usage
+
+        text, usage = upstream("llm").call(_stream, streaming=True, emitted=lambda: bool(emitted), **quota)
+        _settle_usage("llm", quota, usage)
+        return text
+
+    def _generate() -> Any:
+        response = Generation.call(
+            model=model_name,
+            messages=messages,
+            result_format="message",
+            **parameters,
+        )
+        _check_response(response)
+        return response
+
+    response = upstream("llm").call(_generate, **quota)
+    _settle_usage("llm", quota, getattr(response, "usage", None))
+    return _llm_text(getattr(response, "output", None), response)
+
+
+def call_llm_parsed(
+    system_prompt: str,
+    user_prompt: str,
+    parse: Callable[[str], T],
+    history: Optional[List[Dict[str, str]]] = None,
+    stage: str = "router",
+) -> T:
+    """按阶段模型调用并解析输出；快速模型的输出解析失败（parse 返回空值）时，换主模型再调用一次。"""
+    result = parse(call_llm(system_prompt, user_prompt, history=history, stage=stage))
+    if result or stage_model(stage).model == DEFAULT_MODEL:
+        return result
+    current_span().set(escalated=True)
+    return parse(call_llm(system_prompt, user_prompt, model=DEFAULT_MODEL, history=history, stage=stage))
+
+
+@traced("call_rag_app", kind="rag")
+def call_rag_app(app_id: str, prompt: str, stream: bool = False) -> str:
+    """调用 DashScope RAG 应用并抽取文本，成功结果写入磁盘缓存。"""
+    _load_dashscope()
+    sink = _token_sink.get() if stream else None
+    cached = rag_cache.get(app_id, prompt)
+    current_span().set(prompt_chars=len(prompt), cache_hit=cached is not None)
+    if cached is not None:
+        if sink is not None:
+            sink(cached)
+        return cached
+    # RAG 的回答都直接面向用户（规格问答、导购推荐），按回答阶段排队。
+    quota = _quota_request("answer", estimate_tokens(prompt), RAG_OUTPUT_TOKEN_ESTIMATE)
+    if sink is not None:
+        emitted: List[str] = []
+
+        def _stream() -> Tuple[str, Any]:
+            usage = None
+            for response in Application.call(app_id=app_id, prompt=prompt, stream=True, incremental_output=True):
+                _check_response(response)
+                usage = getattr(response, "usage", None) or usage
+                delta = _rag_delta(getattr(response, "output", None))
+                if delta:
+                    check_stream()
+                    emitted.append(delta)
+                    sink(delta)
+            return "".join(emitted), usage
+
+        text, usage = upstream("rag").call(_stream, streaming=True, emitted=lambda: bool(emitted), **quota)
+        _settle_usage("rag", quota, usage)
+        rag_cache.put(app_id, prompt, text)
+        return text
+
+    def _complete() -> Any:
+        response = Application.call(app_id=app_id, prompt=prompt)
+        # 限流/服务端错误抛出以便重试；其余错误沿用原行为，把错误信息作为回复返回且不缓存。
+        if getattr(response, "status_code", None) in RETRYABLE_STATUS:
+            _check_response(response)
+        return response
+
+    response = upstream("rag").call(_complete, **quota)
+    _settle_usage("rag", quota, getattr(response, "usage", None))
+    text = _rag_text(getattr(response, "output", None), response)
+    status_code = getattr(response, "status_code", None)
+    if not status_code or status_code == HTTPStatus.OK:
+        rag_cache.put(app_id, prompt, text)
+    return text
+
+
+async def _get_http_session() -> "aiohttp.ClientSession":
+    """返回当前事件循环共享的 HTTP 连接池。"""
+    import aiohttp
+
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300)
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS),
+            trust_env=True,
+        )
+        _http_session_loop = loop
+    return _http_session
+
+
+async def close_http_session() -> None:
+    """关闭共享 HTTP 连接池，事件循环退出前调用。"""
+    global _http_session, _http_session_loop
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+    _http_session_loop = None
+
+
+async def _apost_dashscope(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """通过共享连接池调用 DashScope HTTP 接口。"""
+    api_key = _require_env("DASHSCOPE_API_KEY")
+    base_url = os.environ.get("DASHSCOPE_HTTP_BASE_URL", DEFAULT_HTTP_BASE_URL).rstrip("/")
+    session = await _get_http_session()
+    async with session.post(
+        f"{base_url}/{path}",
+        json=payload,
+        headers={"Authorization": f"Bearer {api_key}"},
+    ) as response:
+        data = await response.json(content_type=None)
+        if response.status != HTTPStatus.OK:
+            raise _dashscope_error(data, response.status)
+    return data if isinstance(data, dict) else {}
+
+
+async def _astream_dashscope(path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """以 SSE 方式调用 DashScope HTTP 接口，逐条产出事件数据。"""
+    api_key = _require_env("DASHSCOPE_API_KEY")
+    base_url = os.environ.get("DASHSCOPE_HTTP_BASE_URL", DEFAULT_HTTP_BASE_URL).rstrip("/")
+    session = await _get_http_session()
+    async with session.post(
+        f"{base_url}/{path}",
+        json=payload,
+        headers={"Authorization": f"Bearer {api_key}", "X-DashScope-SSE": "enable"},
+    ) as response:
+        if response.status != HTTPStatus.OK:
+            raise _dashscope_error(await response.json(content_type=None), response.status)
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            if isinstance(data, dict) and data.get("code") and not data.get("output"):
+                raise _dashscope_error(data)
+            yield data
+
+
+@traced("call_llm", kind="llm")
+async def acall_llm(
+    system_prompt: str,
+    user_prompt: str,
+    model: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    stream: bool = False,
+    stage: str = "answer",
+) -> str:
+    """call_llm 的异步版本，复用共享连接池。"""
+    tier = StageModel(model) if model else stage_model(stage)
+    model_name = tier.model
+    payload: Dict[str, Any] = {
+        "model": model_name,
+        "input": {"messages": _build_messages(system_prompt, user_prompt, history, stage)},
+        "parameters": {"result_format": "message", **tier.parameters()},
+    }
+    quota = _quota_request(
+        stage,
+        sum(estimate_tokens(message["content"]) for message in payload["input"]["messages"]),
+        tier.max_tokens or LLM_OUTPUT_TOKEN_ESTIMATE,
+    )
+    sink = _token_sink.get() if stream else None
+    current_span().set(
+        model=model_name,
+        prompt_chars=_prompt_chars(payload["input"]["messages"]),
+        stream=sink is not None,
+    )
+    path = "services/aigc/text-generation/generation"
+    if sink is not None:
+        payload["parameters"]["incremental_output"] = True
+        emitted: List[str] = []
+
+        async def _stream() -> Tuple[str, Any]:
+            usage = None
+            async for data in _astream_dashscope(path, payload):
+                usage = data.get("usage") or usage
+                delta = _llm_content(data.get("output"))
+                if delta:
+                    emitted.append(delta)
+                    sink(delta)
+            return "".join(emitted), usage
+
+        text, usage = await upstream("llm").acall(_stream, streaming=True, emitted=lambda: bool(emitted), **quota)
+        _settle_usage("llm", quota, usage)
+        return text
+    data = await upstream("llm").acall(lambda: _apost_dashscope(path, payload), **quota)
+    _settle_usage("llm", quota, data.get("usage"))
+    return _llm_text(data.get("output"), data)
+
+
+async def acall_llm_parsed(
+    system_prompt: str,
+    user_prompt: str,
+    parse: Callable[[str], T],
+    history: Optional[List[Dict[str, str]]] = None,
+    stage: str = "router",
+) -> T:
+    """call_llm_parsed 的异步版本。"""
+    result = parse(await acall_llm(system_prompt, user_prompt, history=history, stage=stage))
+    if result or stage_model(stage).model == DEFAULT_MODEL:
+        return result
+    current_span().set(escalated=True)
+    return parse(await acall_llm(system_prompt, user_prompt, model=DEFAULT_MODEL, history=history, stage=stage))
+
+
+@traced("call_rag_app", kind="rag")
+async def acall_rag_app(app_id: str, prompt: str, stream: bool = False) -> str:
+    """call_rag_app 的异步版本，复用共享连接池；磁盘缓存的读写放到线程中，不阻塞事件循环。"""
+    sink = _token_sink.get() if stream else None
+    cached = await asyncio.to_thread(rag_cache.get, app_id, prompt) if rag_cache.enabled else None
+    current_span().set(prompt_chars=len(prompt), cache_hit=cached is not None)
+    if cached is not None:
+        if sink is not None:
+            sink(cached)
+        return cached
+    payload: Dict[str, Any] = {"input": {"prompt": prompt}, "parameters": {}}
+    path = f"apps/{app_id}/completion"
+    quota = _quota_request("answer", estimate_tokens(prompt), RAG_OUTPUT_TOKEN_ESTIMATE)
+    if sink is not None:
+        payload["parameters"]["incremental_output"] = True
+        emitted: List[str] = []
+
+        async def _stream() -> Tuple[str, Any]:
+            usage = None
+            async for data in _astream_dashscope(path, payload):
+                usage = data.get("usage") or usage
+                delta = _rag_delta(data.get("output"))
+                if delta:
+                    emitted.append(delta)
+                    sink(delta)
+            return "".join(emitted), usage
+
+        text, usage = await upstream("rag").acall(_stream, streaming=True, emitted=lambda: bool(emitted), **quota)
+    else:
+        data = await upstream("rag").acall(lambda: _apost_dashscope(path, payload), **quota)
+        usage = data.get("usage")
+        text = _rag_text(data.get("output"), data)
+    _settle_usage("rag", quota, usage)
+    if rag_cache.enabled:
+        await asyncio.to_thread(rag_cache.put, app_id, prompt, text)
+    return text
+
+
+class TTLCache:
+    """线程安全的 TTL + LRU 缓存；同一 key 的并发请求只触发一次上游调用。"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Tuple[Any, ...], Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_load(self, key: Tuple[Any, ...], ttl: float, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            value = loader()
+        except BaseException as exc:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(exc)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+            if ttl > 0 and self.max_size > 0:
+                self._entries[key] = (time.monotonic() + ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, api: Optional[str] = None) -> None:
+        """清除指定 API（key 的第一个元素）或全部缓存。"""
+        with self._lock:
+            if api is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == api]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "size": len(self._entries),
+            }
+
+
+_openapi_cache = TTLCache(OPENAPI_CACHE_SIZE)
+
+
+def _cached_openapi_call(api: str, params: Tuple[Any, ...], loader: Callable[[], Any]) -> Any:
+    # 缓存 key 带上 AccessKey，避免不同账号共用结果。
+    key = (api, _require_env("ALIBABA_CLOUD_ACCESS_KEY_ID")) + params
+    with span(f"openapi.{api}", kind="openapi") as current:
+        loaded = []
+
+        def _load() -> Any:
+            loaded.append(True)
+            return loader()
+
+        result = _openapi_cache.get_or_load(key, OPENAPI_CACHE_TTLS.get(api, 0), _load)
+        current.set(cache_hit=not loaded)
+        return result
+
+
+def invalidate_openapi_cache(api: Optional[str] = None) -> None:
+    """清除 OpenAPI 结果缓存，api 取值 balance / instances，None 表示全部。"""
+    _openapi_cache.invalidate(api)
+
+
+def openapi_cache_stats() -> Dict[str, int]:
+    """返回 OpenAPI 结果缓存的命中/未命中/合并请求计数。"""
+    return _openapi_cache.stats()
+
+
+def _openapi_credentials() -> Tuple[str, ...]:
+    """每次读取当前凭证，环境变量更新后会自动重建客户端。"""
+    return (
+        _require_env("ALIBABA_CLOUD_ACCESS_KEY_ID"),
+        _require_env("ALIBABA_CLOUD_ACCESS_KEY_SECRET"),
+        os.environ.get("ALIBABA_CLOUD_SECURITY_TOKEN", ""),
+    )
+
+
+def _openapi_client(endpoint: str, factory: Callable[[Any], Any]) -> Any:
+    """按 endpoint 复用 OpenAPI 客户端，凭证变化时重建。"""
+    credentials = _openapi_credentials()
+    with _client_lock:
+        cached = _clients.get(endpoint)
+        if cached and cached[0] == credentials:
+            return cached[1]
+        from alibabacloud_tea_openapi import models as open_api_models
+
+        access_key_id, access_key_secret, security_token = credentials
         config = open_api_models.Config(
             access_key_id=access_key_id,
             access_key_secret=access_key_secret,
-            endpoint=f"ecs.{region_id}.aliyuncs.com",
+            security_token=security_token or None,
+            endpoint=endpoint,
+            max_idle_conns=OPENAPI_MAX_IDLE_CONNS,
         )
-        return Ecs20140526Client(config)
+        client = factory(config)
+        _clients[endpoint] = (credentials, client)
+        return client
+
+
+def _runtime_options() -> Any:
+    from alibabacloud_tea_util import models as util_models
+
+    timeout_ms = int(UPSTREAM_TIMEOUTS["openapi"] * 1000)
+    return util_models.RuntimeOptions(
+        keep_alive=True,
+        max_idle_conns=OPENAPI_MAX_IDLE_CONNS,
+        connect_timeout=timeout_ms,
+        read_timeout=timeout_ms,
+    )
+
+
+def refresh_clients() -> None:
+    """丢弃所有缓存的 OpenAPI 客户端，下次调用时按当前凭证重建。"""
+    with _client_lock:
+        _clients.clear()
+
+
+def warm_up_clients(region_ids: Iterable[str]) -> None:
+    """预建客户端并发起一次轻量请求，提前完成 TLS 握手；失败不影响后续调用。"""
+    for region_id in region_ids:
+        try:
+            client = ECS._client(region_id)
+            client.describe_regions_with_options(
+                _ecs_models().DescribeRegionsRequest(),
+                _runtime_options(),
+            )
+        except Exception:
+            continue
+    try:
+        Billing._client()
+    except Exception:
+        pass
+
+
+class InstanceRecord(NamedTuple):
+    """单台 ECS 实例的精简记录。"""
+
+    instance_id: str
+    instance_type: str
+    status: str
+    zone_id: str
+    region_id: str
+
+
+class InstanceSummary(NamedTuple):
+    """实例聚合结果：总数、分组计数与少量示例。"""
+
+    total: int
+    regions: List[str]
+    by_status: Dict[str, int]
+    by_type: Dict[str, int]
+    by_zone: Dict[str, int]
+    samples: List[InstanceRecord]
+
+
+class ECS:
+    """ECS OpenAPI 封装。"""
+
+    @staticmethod
+    def _client(region_id: str) -> Any:
+        from alibabacloud_ecs20140526.client import Client
+
+        return _openapi_client(f"ecs.{region_id}.aliyuncs.com", Client)
 
     @staticmethod
     def query_instances(region_id: str, page_size: int = 10) -> List[Dict[str, Any]]:
-        """查询指定地域的 ECS 实例信息。"""
+        """查询指定地域的 ECS 实例信息（结果按 OPENAPI_CACHE_TTL_INSTANCES 缓存）。"""
+        return _cached_openapi_call(
+            "instances",
+            (region_id, page_size),
+            lambda: ECS._query_instances(region_id, page_size),
+        )
+
+    @staticmethod
+    def _query_instances(region_id: str, page_size: int) -> List[Dict[str, Any]]:
         client = ECS._client(region_id)
-        request = ecs_models.DescribeInstancesRequest(
+        request = _ecs_models().DescribeInstancesRequest(
             region_id=region_id,
             page_size=page_size,
         )
-        response = client.describe_instances_with_options(
-            request,
-            util_models.RuntimeOptions(),
-        )
+        response = upstream("openapi").call(lambda: client.describe_instances_with_options(request, _runtime_options()))
         instances: List[Dict[str, Any]] = []
         body = getattr(response, "body", None)
         instance_list = body.instances.instance if body and getattr(body, "instances", None) else []
@@ -111,26 +876,152 @@ class ECS:
             )
         return instances
 
+    @staticmethod
+    def list_regions() -> List[str]:
+        """返回账号可用的 ECS 地域列表（按 OPENAPI_CACHE_TTL_REGIONS 缓存）。"""
+        return _cached_openapi_call("regions", (), ECS._list_regions)
+
+    @staticmethod
+    def _list_regions() -> List[str]:
+        default_region = os.environ.get("DEFAULT_REGION_ID") or "cn-hangzhou"
+        client = ECS._client(default_region)
+        response = upstream("openapi").call(
+            lambda: client.describe_regions_with_options(_ecs_models().DescribeRegionsRequest(), _runtime_options())
+        )
+        body = getattr(response, "body", None)
+        regions = body.regions.region if body and getattr(body, "regions", None) else []
+        return [item.region_id for item in regions if getattr(item, "region_id", None)]
+
+    @staticmethod
+    def iter_instances(region_id: str, page_size: int = ECS_PAGE_SIZE) -> Iterator[InstanceRecord]:
+        """按 NextToken 逐页拉取指定地域的全部实例。"""
+        client = ECS._client(region_id)
+        next_token: Optional[str] = None
+        while True:
+            request = _ecs_models().DescribeInstancesRequest(
+                region_id=region_id,
+                max_results=page_size,
+                next_token=next_token,
+            )
+            response = upstream("openapi").call(
+                lambda: client.describe_instances_with_options(request, _runtime_options())
+            )
+            body = getattr(response, "body", None)
+            instance_list = body.instances.instance if body and getattr(body, "instances", None) else []
+            for item in instance_list:
+                yield InstanceRecord(
+                    getattr(item, "instance_id", "") or "",
+                    getattr(item, "instance_type", "") or "",
+                    getattr(item, "status", "") or "",
+                    getattr(item, "zone_id", "") or "",
+                    region_id,
+                )
+            next_token = getattr(body, "next_token", None) if body else None
+            if not next_token:
+                return
+
+    @staticmethod
+    def iter_all_instances(region_ids: Optional[List[str]] = None) -> Iterator[InstanceRecord]:
+        """并发遍历多个地域（默认全部地域），按到达顺序产出实例记录。"""
+        regions = region_ids if region_ids is not None else ECS.list_regions()
+        if len(regions) == 1:
+            yield from ECS.iter_instances(regions[0])
+            return
+        done = object()
+        records: "queue.Queue[Any]" = queue.Queue(maxsize=ECS_PAGE_SIZE * 4)
+        stop = threading.Event()
+
+        def _put(item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _worker(region_id: str) -> None:
+            try:
+                for record in ECS.iter_instances(region_id):
+                    if not _put(record):
+                        return
+            except Exception as exc:
+                _put(exc)
+            finally:
+                _put(done)
+
+        pool = ThreadPoolExecutor(max_workers=max(1, min(ECS_FANOUT_WORKERS, len(regions))))
+        try:
+            for region_id in regions:
+                pool.submit(_worker, region_id)
+            remaining = len(regions)
+            while remaining:
+                item = records.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            pool.shutdown(wait=False)
+
+    @staticmethod
+    def summarize_instances(region_id: Optional[str] = None, sample_size: int = 10) -> InstanceSummary:
+        """流式聚合实例：按状态/规格/可用区计数，仅保留前 sample_size 条示例。
+
+        region_id 为空时汇总全部地域；结果按 OPENAPI_CACHE_TTL_INSTANCES 缓存。
+        """
+        return _cached_openapi_call(
+            "instances",
+            ("summary", region_id or "*", sample_size),
+            lambda: ECS._summarize_instances(region_id, sample_size),
+        )
+
+    @staticmethod
+    def _summarize_instances(region_id: Optional[str], sample_size: int) -> InstanceSummary:
+        regions = [region_id] if region_id else ECS.list_regions()
+        by_status: Counter = Counter()
+        by_type: Counter = Counter()
+        by_zone: Counter = Counter()
+        samples: List[InstanceRecord] = []
+        total = 0
+        for record in ECS.iter_all_instances(regions):
+            total += 1
+            by_status[record.status] += 1
+            by_type[record.instance_type] += 1
+            by_zone[record.zone_id] += 1
+            if len(samples) < sample_size:
+                samples.append(record)
+        return InstanceSummary(
+            total=total,
+            regions=regions,
+            by_status=dict(by_status.most_common()),
+            by_type=dict(by_type.most_common()),
+            by_zone=dict(by_zone.most_common()),
+            samples=samples,
+        )
+
 
 class Billing:
     """BSS OpenAPI 封装。"""
 
     @staticmethod
-    def _client() -> BssOpenApi20171214Client:
-        access_key_id = _require_env("ALIBABA_CLOUD_ACCESS_KEY_ID")
-        access_key_secret = _require_env("ALIBABA_CLOUD_ACCESS_KEY_SECRET")
-        config = open_api_models.Config(
-            access_key_id=access_key_id,
-            access_key_secret=access_key_secret,
-            endpoint="business.aliyuncs.com",
-        )
-        return BssOpenApi20171214Client(config)
+    def _client() -> Any:
+        from alibabacloud_bssopenapi20171214.client import Client
+
+        return _openapi_client("business.aliyuncs.com", Client)
 
     @staticmethod
     def get_balance() -> Dict[str, Any]:
-        """查询账户余额。"""
+        """查询账户余额（结果按 OPENAPI_CACHE_TTL_BALANCE 缓存）。"""
+        return _cached_openapi_call("balance", (), Billing._get_balance)
+
+    @staticmethod
+    def _get_balance() -> Dict[str, Any]:
         client = Billing._client()
-        response = client.query_account_balance_with_options(util_models.RuntimeOptions())
+        response = upstream("openapi").call(lambda: client.query_account_balance_with_options(_runtime_options()))
         body = getattr(response, "body", None)
         data = getattr(body, "data", None) if body else None
         return {
@@ -0,0 +1,297 @@
+﻿import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Protocol, Tuple
+
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "")
+TRACE_PATH = os.environ.get("TRACE_PATH", os.path.join(".cache", "traces.jsonl"))
+
+# 延迟直方图的桶上界（毫秒），最后一个桶收纳所有更慢的调用。
+HISTOGRAM_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+_session_id: ContextVar[str] = ContextVar("trace_session_id", default="")
+_flow: ContextVar[str] = ContextVar("trace_flow", default="")
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_current_span", default=None)
+
+
+class Exporter(Protocol):
+    def export(self, record: Dict[str, Any]) -> None:
+        ...
+
+
+class Span:
+    """一次上游调用或流程阶段的记录；属性可在执行过程中通过 set 补充。"""
+
+    __slots__ = ("name", "kind", "span_id", "parent_id", "session_id", "flow", "attributes", "started")
+
+    def __init__(self, name: str, kind: str, attributes: Dict[str, Any]):
+        parent = _current.get()
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else ""
+        self.session_id = _session_id.get()
+        self.flow = _flow.get()
+        self.attributes = attributes
+        self.started = time.time()
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_record(self, duration_ms: float, outcome: str, error: str) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "session_id": self.session_id,
+            # 规划阶段结束后才知道 flow，读取当前值而不是开始时的值。
+            "flow": _flow.get() or self.flow,
+            "start": round(self.started, 6),
+            "duration_ms": round(duration_ms, 3),
+            "outcome": outcome,
+            "error": error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class LatencyHistogram:
+    """固定桶的延迟直方图，分位数取所在桶的上界（不超过观测到的最大值）。"""
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, duration_ms: float, ok: bool) -> None:
+        self.buckets[bisect_left(HISTOGRAM_BOUNDS_MS, duration_ms)] += 1
+        self.count += 1
+        self.errors += 0 if ok else 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                if index < len(HISTOGRAM_BOUNDS_MS):
+                    return round(min(float(HISTOGRAM_BOUNDS_MS[index]), self.max_ms), 3)
+                return round(self.max_ms, 3)
+        return self.max_ms
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+class InMemoryExporter:
+    """把 span 记录保存在列表中，供测试与调试读取。"""
+
+    def __init__(self) -> None:
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def export(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records.clear()
+
+
+class JsonLinesExporter:
+    """每个 span 一行 JSON，追加写入文件。"""
+
+    def __init__(self, path: str = TRACE_PATH) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._handle = open(path, "a", encoding="utf-8")
+
+    def export(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._handle.write(line + "\n")
+            self._handle.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._handle.close()
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.exporters: List[Exporter] = []
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def finish(self, span: Span, duration_ms: float, error: Optional[BaseException]) -> None:
+        outcome = "ok" if error is None else "error"
+        with self._lock:
+            key = (span.kind, span.name)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.observe(duration_ms, error is None)
+        if self.exporters:
+            record = span.to_record(duration_ms, outcome, type(error).__name__ if error else "")
+            for exporter in self.exporters:
+                try:
+                    exporter.export(record)
+                except Exception:
+                    continue
+
+    def histograms(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {f"{kind}:{name}": histogram.summary() for (kind, name), histogram in sorted(self._histograms.items())}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+
+
+tracer = Tracer()
+
+
+def configure(*exporters: Exporter, enabled: bool = True) -> None:
+    """开启（或关闭）追踪并替换导出器；不传导出器时只在进程内聚合直方图。"""
+    tracer.exporters = list(exporters)
+    tracer.enabled = enabled
+
+
+def _configure_from_env() -> None:
+    if TRACE_EXPORTER == "jsonl":
+        configure(JsonLinesExporter(TRACE_PATH))
+    elif TRACE_EXPORTER == "memory":
+        configure(InMemoryExporter())
+    elif TRACE_EXPORTER == "histogram":
+        configure()
+
+
+_configure_from_env()
+
+
+def bind_session(session_id: str) -> None:
+    """标记当前上下文所属的会话，之后创建的 span 都会带上它。"""
+    _session_id.set(session_id or "")
+
+
+def bind_flow(flow: str) -> None:
+    _flow.set(flow or "")
+
+
+def current_span() -> Any:
+    """返回当前 span；未开启追踪时返回空实现，调用 set 没有开销。"""
+    if not tracer.enabled:
+        return _NOOP_SPAN
+    return _current.get() or _NOOP_SPAN
+
+
+@contextmanager
+def span(name: str, kind: str = "stage", **attributes: Any) -> Iterator[Any]:
+    if not tracer.enabled:
+        yield _NOOP_SPAN
+        return
+    current = Span(name, kind, attributes)
+    token = _current.set(current)
+    started = time.perf_counter()
+    error: Optional[BaseException] = None
+    try:
+        yield current
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        _current.reset(token)
+        tracer.finish(current, (time.perf_counter() - started) * 1000, error)
+
+
+def traced(name: str, kind: str = "stage") -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """函数装饰器：为每次调用记录一个 span，同步/异步函数均可使用。"""
+
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with span(name, kind):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with span(name, kind):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def usage_tokens(usage: Any) -> Tuple[Optional[int], Optional[int]]:
+    """从 DashScope 返回的 usage 中取 (input_tokens, output_tokens)。"""
+    if not usage:
+        return None, None
+    get = usage.get if isinstance(usage, dict) else lambda key, default=None: getattr(usage, key, default)
+    input_tokens = get("input_tokens")
+    output_tokens = get("output_tokens")
+    if input_tokens is None and output_tokens is None:
+        # RAG 应用按模型分别统计；没有按模型的统计时视为未返回用量。
+        models = [item for item in get("models") or [] if isinstance(item, dict)]
+        if not models:
+            return None, None
+        input_tokens = sum((item.get("input_tokens") or 0) for item in models)
+        output_tokens = sum((item.get("output_tokens") or 0) for item in models)
+    return input_tokens, output_tokens
+
+
+def record_usage(usage: Any) -> None:
+    """把 DashScope 返回的 usage（input_tokens/output_tokens）记到当前 span。"""
+    if not tracer.enabled or not usage:
+        return
+    input_tokens, output_tokens = usage_tokens(usage)
+    current_span().set(input_tokens=input_tokens, output_tokens=output_tokens)
+
+
+def histograms() -> Dict[str, Dict[str, float]]:
+    """按 kind:name 汇总的进程内延迟直方图。"""
+    return tracer.histograms()
@@ -0,0 +1,372 @@
+﻿import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import os
+import threading
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from resilience import UpstreamError
+
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "0"))
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", "1"))
+WORKER_START_TIMEOUT = float(os.environ.get("WORKER_START_TIMEOUT", "60"))
+HASH_RING_REPLICAS = 64
+
+
+class WorkerLost(RuntimeError):
+    """处理回合的 worker 进程退出，或当前没有可用的 worker。"""
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """一致性哈希环：每个 worker 占 replicas 个虚拟节点，增删 worker 时只有约 1/N 的会话换归属。"""
+
+    def __init__(self, members: Iterable[int], replicas: int = HASH_RING_REPLICAS):
+        self.members = sorted(set(members))
+        points = sorted((_hash(f"worker-{member}#{replica}"), member) for member in self.members for replica in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key: str) -> Optional[int]:
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[index]
+
+
+# ---- worker 进程 ----
+
+
+def _share_quota(workers: int) -> None:
+    """客户端配额按 worker 数均分，整个池的上游调用速率仍不超过 UPSTREAM_RATE_*/UPSTREAM_TPM_*。"""
+    from resilience import UPSTREAM_RATES, UPSTREAM_TPM, set_quota
+
+    for name, rate in UPSTREAM_RATES.items():
+        tokens_per_minute = UPSTREAM_TPM.get(name, 0.0)
+        if rate or tokens_per_minute:
+            set_quota(name, rate / workers, tokens_per_minute / workers)
+
+
+def _worker_main(conn: Any, index: int, workers: int, stub_latency: Optional[str]) -> None:
+    _share_quota(workers)
+    if stub_latency is not None:
+        from stubs import install_stub_backends
+
+        install_stub_backends(stub_latency, stub_latency, stub_latency)
+    asyncio.run(_serve(conn, index))
+
+
+async def _serve(conn: Any, index: int) -> None:
+    from resilience import upstream_stats
+    from speculation import speculation_stats
+    from tools import close_http_session
+    from tracing import histograms
+    from workflow import ainvoke_reply, astream_reply, build_app
+
+    app = build_app()
+    loop = asyncio.get_running_loop()
+    inbox: "asyncio.Queue[Any]" = asyncio.Queue()
+    tasks: Dict[int, "asyncio.Task[None]"] = {}
+
+    def _read() -> None:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = ("stop",)
+            loop.call_soon_threadsafe(inbox.put_nowait, message)
+            if message[0] == "stop":
+                return
+
+    async def _turn(request_id: int, thread_id: str, question: str, stream: bool) -> None:
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            if stream:
+                async for kind, text in astream_reply(app, question, config):
+                    conn.send((kind, request_id, text))
+            else:
+                conn.send(("reply", request_id, await ainvoke_reply(app, question, config)))
+        except asyncio.CancelledError:
+            pass
+        except UpstreamError as exc:
+            conn.send(("error", request_id, "upstream", str(exc), exc.code, exc.status))
+        except Exception as exc:
+            conn.send(("error", request_id, type(exc).__name__, str(exc), "", 0))
+        finally:
+            tasks.pop(request_id, None)
+
+    threading.Thread(target=_read, name="worker-inbox", daemon=True).start()
+    conn.send(("ready", 0, os.getpid()))
+    try:
+        while True:
+            message = await inbox.get()
+            kind = message[0]
+            if kind == "turn":
+                _, request_id, thread_id, question, stream = message
+                tasks[request_id] = asyncio.create_task(_turn(request_id, thread_id, question, stream))
+            elif kind == "cancel":
+                task = tasks.get(message[1])
+                if task is not None:
+                    task.cancel()
+            elif kind == "ring":
+                ring = HashRing(message[1])
+                evict = getattr(app.checkpointer, "evict_cached", None)
+                if evict is not None:
+                    evict(lambda thread_id: ring.owner(thread_id) == index)
+            elif kind == "stats":
+                stats = {
+                    "pid": os.getpid(),
+                    "upstreams": upstream_stats(),
+                    "latency": histograms(),
+                    "speculation": speculation_stats(),
+                }
+                conn.send(("reply", message[1], stats))
+            elif kind == "stop":
+                break
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await close_http_session()
+        conn.close()
+
+
+# ---- 调度端 ----
+
+
+class _Worker:
+    __slots__ = ("index", "process", "conn", "pid", "ready", "restarts", "pending", "send_lock")
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Any = None
+        self.conn: Any = None
+        self.pid = 0
+        self.ready: Optional["asyncio.Future[None]"] = None
+        self.restarts = 0
+        self.pending: Dict[int, "asyncio.Queue[Tuple[str, Any]]"] = {}
+        self.send_lock = threading.Lock()
+
+    def send(self, message: Tuple[Any, ...]) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class WorkerPool:
+    """多进程 worker 池的调度端：按 thread_id 一致性哈希把会话分片到各 worker 进程，绕开单进程 GIL。
+
+    - 每个 worker 进程各自编译对话图、持有所负责会话的 checkpointer 热缓存，会话状态落在共享的 SQLite 中；
+    - 调度端只转发回合与回传增量输出，同一会话的回合顺序由调用方保证（见 server.TurnScheduler）；
+    - worker 退出时，它的会话按哈希环迁移到其余 worker，重启完成后再迁回；哈希环每次变化都通知各 worker
+      把不再归自己负责的会话移出热缓存，避免会话迁回时读到过期的缓存。
+
+    需在事件循环中使用：先 await start()，结束时 await close()。
+    """
+
+    def __init__(self, workers: int, stub_latency: Optional[str] = None, restart_delay: float = WORKER_RESTART_DELAY):
+        if workers < 1:
+            raise ValueError("workers 至少为 1")
+        self.stub_latency = stub_latency
+        self.restart_delay = restart_delay
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(workers)]
+        self._ring = HashRing([])
+        self._ids = itertools.count(1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closing = False
+        self.stats = {"turns": 0, "lost_turns": 0, "restarts": 0, "rebalances": 0}
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        await asyncio.gather(*(self._spawn(worker) for worker in self._workers))
+
+    async def _spawn(self, worker: _Worker) -> None:
+        parent_conn, child_conn = self._context.Pipe()
+        worker.conn = parent_conn
+        worker.ready = self._loop.create_future()
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(child_conn, worker.index, len(self._workers), self.stub_latency),
+            name=f"chat-worker-{worker.index}",
+            daemon=True,
+        )
+        await self._loop.run_in_executor(None, worker.process.start)
+        child_conn.close()
+        threading.Thread(target=self._read, args=(worker, parent_conn), name=f"pool-reader-{worker.index}", daemon=True).start()
+        try:
+            await asyncio.wait_for(asyncio.shield(worker.ready), WORKER_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            worker.process.kill()
+            raise WorkerLost(f"worker {worker.index} 启动超时")
+        self._rebalance()
+
+    def _read(self, worker: _Worker, conn: Any) -> None:
+        """每个 worker 一个读线程，把消息转交给事件循环；管道断开说明 worker 已退出。"""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                self._loop.call_soon_threadsafe(self._lost, worker, conn)
+                return
+            self._loop.call_soon_threadsafe(self._deliver, worker, message)
+
+    def _deliver(self, worker: _Worker, message: Tuple[Any, ...]) -> None:
+        kind, request_id = message[0], message[1]
+        if kind == "ready":
+            worker.pid = message[2]
+            if not worker.ready.done():
+                worker.ready.set_result(None)
+            return
+        queue = worker.pending.get(request_id)
+        if queue is None:
+            return
+        if kind == "error":
+            _, _, name, text, code, status = message
+            error: Exception = UpstreamError(text, code, status) if name == "upstream" else RuntimeError(text)
+            queue.put_nowait(("error", error))
+        else:
+            queue.put_nowait((kind, message[2]))
+
+    def _lost(self, worker: _Worker, conn: Any) -> None:
+        if conn is not worker.conn:
+            return
+        was_alive = self._alive(worker)
+        if worker.ready is not None and not worker.ready.done():
+            # 启动中退出：由 _spawn 的调用方处理（首次启动直接报错，重启时再试）。
+            worker.ready.set_exception(WorkerLost(f"worker {worker.index} 启动失败"))
+            worker.ready.exception()
+        worker.ready = None
+        for queue in worker.pending.values():
+            self.stats["lost_turns"] += 1
+            queue.put_nowait(("error", WorkerLost(f"worker {worker.index} 已退出")))
+        worker.pending.clear()
+        self._rebalance()
+        if was_alive and not self._closing:
+            self._loop.create_task(self._restart(worker))
+
+    async def _restart(self, worker: _Worker) -> None:
+        while not self._closing:
+            await asyncio.sleep(self.restart_delay)
+            worker.restarts += 1
+            self.stats["restarts"] += 1
+            try:
+                await self._spawn(worker)
+                return
+            except WorkerLost:
+                continue
+
+    def _alive(self, worker: _Worker) -> bool:
+        return worker.ready is not None and worker.ready.done() and not worker.ready.exception()
+
+    def _rebalance(self) -> None:
+        """按存活的 worker 重建哈希环，并通知各 worker 清理不再归自己负责的会话缓存。"""
+        members = [worker.index for worker in self._workers if self._alive(worker)]
+        if members == self._ring.members:
+            return
+        self._ring = HashRing(members)
+        self.stats["rebalances"] += 1
+        for worker in self._workers:
+            if self._alive(worker):
+                try:
+                    worker.send(("ring", members))
+                except (OSError, ValueError):
+                    pass
+
+    def owner(self, thread_id: str) -> Optional[int]:
+        return self._ring.owner(thread_id)
+
+    def _route(self, thread_id: str) -> _Worker:
+        index = self._ring.owner(thread_id)
+        if index is None:
+            raise WorkerLost("没有可用的 worker")
+        return self._workers[index]
+
+    async def _request(self, worker: _Worker, message: Tuple[Any, ...]) -> AsyncIterator[Tuple[str, Any]]:
+        request_id = message[1]
+        queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+        worker.pending[request_id] = queue
+        finished = False
+        try:
+            worker.send(message)
+            while True:
+                kind, value = await queue.get()
+                finished = kind in ("reply", "error")
+                if kind == "error":
+                    raise value
+                yield kind, value
+                if finished:
+                    return
+        except (OSError, ValueError) as exc:
+            finished = True
+            raise WorkerLost(f"worker {worker.index} 不可用：{exc}") from exc
+        finally:
+            worker.pending.pop(request_id, None)
+            if not finished and self._alive(worker):
+                # 调用方取消（如单轮超时），让 worker 也停止这一轮。
+                try:
+                    worker.send(("cancel", request_id))
+                except (OSError, ValueError):
+                    pass
+
+    async def astream(self, thread_id: str, question: str) -> AsyncIterator[Tuple[str, str]]:
+        """在会话所属的 worker 上运行一轮，产出与 workflow.astream_reply 相同的 ("token"/"reply", 文本)。"""
+        self.stats["turns"] += 1
+        worker = self._route(thread_id)
+        async for kind, text in self._request(worker, ("turn", next(self._ids), thread_id, question, True)):
+            yield kind, text
+
+    async def ainvoke(self, thread_id: str, question: str) -> str:
+        """在会话所属的 worker 上运行一轮，返回完整回复。"""
+        self.stats["turns"] += 1
+        worker = self._route(thread_id)
+        reply = ""
+        async for _, reply in self._request(worker, ("turn", next(self._ids), thread_id, question, False)):
+            pass
+        return reply
+
+    async def worker_stats(self) -> List[Dict[str, Any]]:
+        """各 worker 进程内的上游统计与延迟直方图。"""
+
+        async def _one(worker: _Worker) -> Dict[str, Any]:
+            stats: Dict[str, Any] = {}
+            try:
+                async for _, stats in self._request(worker, ("stats", next(self._ids))):
+                    pass
+            except RuntimeError as exc:
+                return {"index": worker.index, "error": str(exc)}
+            return {"index": worker.index, **stats}
+
+        return list(await asyncio.gather(*(_one(worker) for worker in self._workers if self._alive(worker))))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "workers": [
+                {
+                    "index": worker.index,
+                    "pid": worker.pid,
+                    "alive": self._alive(worker),
+                    "in_flight": len(worker.pending),
+                    "restarts": worker.restarts,
+                }
+                for worker in self._workers
+            ],
+        }
+
+    async def close(self) -> None:
+        self._closing = True
+        for worker in self._workers:
+            if self._alive(worker):
+                try:
+                    worker.send(("stop",))
+                except (OSError, ValueError):
+                    pass
+        for worker in self._workers:
+            if worker.process is not None:
+                await self._loop.run_in_executor(None, worker.process.join, 10)
+                if worker.process.is_alive():
+                    worker.process.kill()
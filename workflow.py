@@ -1,62 +1,295 @@
-﻿from typing import Dict, List, Tuple, TypedDict
+﻿import os
+import threading
+from typing import Annotated, Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypedDict
 
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableLambda
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.config import get_config, get_stream_writer
 from langgraph.graph import END, StateGraph
 
-from agents import general_assistant
-from helpers import is_reset_command, trim_history
-from planning import route_task
-from resource_flow import run_resource_flow
-from shopping_flow import run_shopping_flow
+from agents import ageneral_assistant, general_assistant
+from helpers import is_reset_command
+from history_summary import model_history, roll_history, summarizer
+from planning import aplan_turn, plan_turn
+from resource_flow import arun_resource_flow, run_resource_flow
+from session_store import SESSION_DURABILITY, create_checkpointer
+from shopping_flow import arun_shopping_flow, run_shopping_flow
+from speculation import speculator
+from tools import stream_tokens, warm_up_clients
+from tracing import bind_flow, bind_session
 
 History = List[Dict[str, str]]
+# 列表型状态的增量更新：先追加 append，再从头部丢弃 drop 条（滑出原文窗口、并入摘要或重置）。
+ListPatch = Dict[str, Any]
+
+
+def _apply_list_patch(current: History, patch: ListPatch) -> History:
+    return (list(current) + list(patch.get("append", [])))[patch.get("drop", 0) :]
+
+
+def _apply_dict_patch(current: Dict[str, str], patch: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """值为 None 的键表示删除。"""
+    merged = dict(current)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
 
 
 class ConversationState(TypedDict, total=False):
+    """会话状态。history/pending/requirements 由 reducer 合并节点返回的增量，
+    checkpoint 的 writes 中只记录本轮的变化，而不是整段历史。"""
+
     question: str
-    history: History
-    requirements: Dict[str, str]
+    history: Annotated[History, _apply_list_patch]
+    requirements: Annotated[Dict[str, str], _apply_dict_patch]
     reply: str
+    # 滚动摘要，以及已滑出原文窗口、等待并入摘要的消息。
+    summary: str
+    pending: Annotated[History, _apply_list_patch]
+    # 本轮的规划结果（见 planning.TurnPlan），供流程节点与条件边使用。
+    plan: Dict[str, Any]
+
+
+RESET_REPLY = "已重置导购状态，请重新描述您的需求。"
+RESET_FLOW = "Reset"
+FLOW_NODES = {"ShoppingFlow": "shopping", "ResourceFlow": "resource", RESET_FLOW: "reset"}
+
+
+def _list_patch(old: History, new: History) -> Optional[ListPatch]:
+    """把 old -> new 表示成 _apply_list_patch 的增量；new 需是 old + 追加内容的后缀，无变化时返回 None。"""
+    if new == old:
+        return None
+    for drop in range(len(old) + 1):
+        kept = len(old) - drop
+        if old[drop:] == new[:kept]:
+            return {"drop": drop, "append": new[kept:]}
+    return {"drop": len(old), "append": new}
+
+
+def _dict_patch(old: Dict[str, str], new: Dict[str, str]) -> Optional[Dict[str, Optional[str]]]:
+    patch: Dict[str, Optional[str]] = {key: value for key, value in new.items() if old.get(key) != value}
+    patch.update({key: None for key in old if key not in new})
+    return patch or None
+
+
+def _bind_session() -> str:
+    configurable = get_config().get("configurable", {})
+    session_id = str(configurable.get("thread_id", ""))
+    bind_session(session_id)
+    bind_flow("")
+    return session_id
+
 
+def _model_history(state: ConversationState) -> History:
+    return model_history(state.get("summary", ""), state.get("pending", []), state.get("history", []))
 
-def run_turn(
-    question: str,
-    history: History,
-    requirements: Dict[str, str],
-) -> Tuple[str, History, Dict[str, str]]:
+
+def _token_writer() -> Callable[[str], None]:
+    writer = get_stream_writer()
+    return lambda token: writer({"token": token})
+
+
+# ---- 节点：plan -> 流程节点（shopping/resource/general/reset）-> finish ----
+
+
+def _plan_node(state: ConversationState) -> ConversationState:
+    question = state.get("question", "")
+    _bind_session()
     if is_reset_command(question):
-        return "已重置导购状态，请重新描述您的需求。", [], {}
-    history_for_model = trim_history(history)
-    route = route_task(question, history_for_model, requirements)
-    if route == "ShoppingFlow":
-        reply, requirements = run_shopping_flow(question, history_for_model, requirements)
-    elif route == "ResourceFlow":
-        reply = run_resource_flow(question, history_for_model)
-    else:
-        reply = general_assistant(question, history_for_model)
-    new_history = list(history)
-    new_history.append({"role": "user", "content": question})
-    new_history.append({"role": "assistant", "content": reply})
-    new_history = trim_history(new_history, max_messages=20)
-    return reply, new_history, requirements
+        return {"plan": {"flow": RESET_FLOW}}
+    return {"plan": plan_turn(question, _model_history(state), state.get("requirements", {}))}
 
 
-def _run_turn_node(state: ConversationState) -> ConversationState:
+async def _aplan_node(state: ConversationState) -> ConversationState:
     question = state.get("question", "")
+    _bind_session()
+    if is_reset_command(question):
+        return {"plan": {"flow": RESET_FLOW}}
+    return {"plan": await aplan_turn(question, _model_history(state), state.get("requirements", {}))}
+
+
+def _next_node(state: ConversationState) -> str:
+    return FLOW_NODES.get(state.get("plan", {}).get("flow", ""), "general")
+
+
+def _flow_update(state: ConversationState, reply: str, requirements: Optional[Dict[str, str]] = None) -> ConversationState:
+    update: ConversationState = {"reply": reply}
+    if requirements is not None:
+        patch = _dict_patch(state.get("requirements", {}), requirements)
+        if patch:
+            update["requirements"] = patch
+    return update
+
+
+def _shopping_node(state: ConversationState) -> ConversationState:
+    session_id = _bind_session()
+    bind_flow("ShoppingFlow")
+    plan = state.get("plan", {})
+    with stream_tokens(_token_writer()):
+        reply, requirements = run_shopping_flow(
+            state.get("question", ""),
+            _model_history(state),
+            state.get("requirements", {}),
+            route=plan.get("shopping_route"),
+            extracted=plan.get("requirements"),
+            session_id=session_id,
+        )
+    return _flow_update(state, reply, requirements)
+
+
+async def _ashopping_node(state: ConversationState) -> ConversationState:
+    session_id = _bind_session()
+    bind_flow("ShoppingFlow")
+    plan = state.get("plan", {})
+    with stream_tokens(_token_writer()):
+        reply, requirements = await arun_shopping_flow(
+            state.get("question", ""),
+            _model_history(state),
+            state.get("requirements", {}),
+            route=plan.get("shopping_route"),
+            extracted=plan.get("requirements"),
+            session_id=session_id,
+        )
+    return _flow_update(state, reply, requirements)
+
+
+def _resource_node(state: ConversationState) -> ConversationState:
+    _bind_session()
+    bind_flow("ResourceFlow")
+    with stream_tokens(_token_writer()):
+        reply = run_resource_flow(
+            state.get("question", ""), _model_history(state), order=state.get("plan", {}).get("resource_agents")
+        )
+    return _flow_update(state, reply)
+
+
+async def _aresource_node(state: ConversationState) -> ConversationState:
+    _bind_session()
+    bind_flow("ResourceFlow")
+    with stream_tokens(_token_writer()):
+        reply = await arun_resource_flow(
+            state.get("question", ""), _model_history(state), order=state.get("plan", {}).get("resource_agents")
+        )
+    return _flow_update(state, reply)
+
+
+def _general_node(state: ConversationState) -> ConversationState:
+    _bind_session()
+    bind_flow("GeneralFlow")
+    with stream_tokens(_token_writer()):
+        reply = general_assistant(state.get("question", ""), _model_history(state), stream=True)
+    return _flow_update(state, reply)
+
+
+async def _ageneral_node(state: ConversationState) -> ConversationState:
+    _bind_session()
+    bind_flow("GeneralFlow")
+    with stream_tokens(_token_writer()):
+        reply = await ageneral_assistant(state.get("question", ""), _model_history(state), stream=True)
+    return _flow_update(state, reply)
+
+
+def _reset_node(state: ConversationState) -> ConversationState:
+    return _flow_update(state, RESET_REPLY, {})
+
+
+def _finish_node(state: ConversationState) -> ConversationState:
+    """把本轮问答并入历史，滚动原文窗口与摘要；只返回有变化的字段。"""
+    session_id = _bind_session()
     history = state.get("history", [])
-    requirements = state.get("requirements", {})
-    reply, new_history, new_requirements = run_turn(question, history, requirements)
-    return {
-        "question": question,
-        "history": new_history,
-        "requirements": new_requirements,
-        "reply": reply,
-    }
+    pending = state.get("pending", [])
+    summary = state.get("summary", "")
+    if state.get("plan", {}).get("flow") == RESET_FLOW:
+        summarizer.discard(session_id)
+        speculator.discard(session_id)
+        new_summary, new_pending, new_history = roll_history(session_id, "", [], [])
+    else:
+        turn = [
+            {"role": "user", "content": state.get("question", "")},
+            {"role": "assistant", "content": state.get("reply", "")},
+        ]
+        new_summary, new_pending, new_history = roll_history(session_id, summary, pending, history + turn)
+    update: ConversationState = {}
+    history_patch = _list_patch(history, new_history)
+    if history_patch is not None:
+        update["history"] = history_patch
+    pending_patch = _list_patch(pending, new_pending)
+    if pending_patch is not None:
+        update["pending"] = pending_patch
+    if new_summary != summary:
+        update["summary"] = new_summary
+    return update
+
+
+def _warm_up_regions() -> List[str]:
+    regions = os.environ.get("OPENAPI_WARMUP_REGIONS", "")
+    return [region.strip() for region in regions.split(",") if region.strip()]
 
 
-def build_app():
+def build_app(
+    warm_up_regions: Optional[Iterable[str]] = None,
+    checkpointer: Optional[BaseCheckpointSaver] = None,
+):
+    """编译对话图；invoke 走同步节点，ainvoke 走异步节点。
+
+    warm_up_regions（默认读取 OPENAPI_WARMUP_REGIONS）非空时，后台预建这些地域的 OpenAPI 客户端。
+    checkpointer 默认按 SESSION_STORE 创建（见 session_store.create_checkpointer）。
+    """
+    regions = list(warm_up_regions) if warm_up_regions is not None else _warm_up_regions()
+    if regions:
+        threading.Thread(target=warm_up_clients, args=(regions,), daemon=True).start()
     graph = StateGraph(ConversationState)
-    graph.add_node("turn", _run_turn_node)
-    graph.set_entry_point("turn")
-    graph.add_edge("turn", END)
-    return graph.compile(checkpointer=MemorySaver())
+    graph.add_node("plan", RunnableLambda(_plan_node, afunc=_aplan_node))
+    graph.add_node("shopping", RunnableLambda(_shopping_node, afunc=_ashopping_node))
+    graph.add_node("resource", RunnableLambda(_resource_node, afunc=_aresource_node))
+    graph.add_node("general", RunnableLambda(_general_node, afunc=_ageneral_node))
+    graph.add_node("reset", _reset_node)
+    graph.add_node("finish", _finish_node)
+    graph.set_entry_point("plan")
+    graph.add_conditional_edges("plan", _next_node, ["shopping", "resource", "general", "reset"])
+    for node in ("shopping", "resource", "general", "reset"):
+        graph.add_edge(node, "finish")
+    graph.add_edge("finish", END)
+    return graph.compile(checkpointer=checkpointer or create_checkpointer())
+
+
+def invoke_reply(app: Any, question: str, config: Dict[str, Any]) -> str:
+    """运行一轮对话，返回完整回复；checkpoint 写入时机见 SESSION_DURABILITY。"""
+    return app.invoke({"question": question}, config=config, durability=SESSION_DURABILITY).get("reply", "")
+
+
+async def ainvoke_reply(app: Any, question: str, config: Dict[str, Any]) -> str:
+    """invoke_reply 的异步版本。"""
+    result = await app.ainvoke({"question": question}, config=config, durability=SESSION_DURABILITY)
+    return result.get("reply", "")
+
+
+def stream_reply(app: Any, question: str, config: Dict[str, Any]) -> Iterator[Tuple[str, str]]:
+    """运行一轮对话并逐步产出 ("token", 增量文本)，最后产出 ("reply", 完整回复)。"""
+    reply = ""
+    stream = app.stream(
+        {"question": question}, config=config, stream_mode=["custom", "values"], durability=SESSION_DURABILITY
+    )
+    for mode, chunk in stream:
+        if mode == "custom":
+            yield "token", chunk.get("token", "")
+        else:
+            reply = chunk.get("reply", "")
+    yield "reply", reply
+
+
+async def astream_reply(app: Any, question: str, config: Dict[str, Any]) -> AsyncIterator[Tuple[str, str]]:
+    """stream_reply 的异步版本。"""
+    reply = ""
+    stream = app.astream(
+        {"question": question}, config=config, stream_mode=["custom", "values"], durability=SESSION_DURABILITY
+    )
+    async for mode, chunk in stream:
+        if mode == "custom":
+            yield "token", chunk.get("token", "")
+        else:
+            reply = chunk.get("reply", "")
+    yield "reply", reply